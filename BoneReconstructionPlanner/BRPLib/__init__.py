@@ -1,5 +1,11 @@
 # BRPLib - Bone Reconstruction Planner Library
 # This package contains helper functions and GUI widgets for the Bone Reconstruction Planner module
 
+from .memoryBudget import *
+from .stageTimings import *
+from .meshTransport import *
 from .helperFunctions import *
 from .guiWidgets import *
+from .meshExport import *
+from .mandiblePlanesOptimizer import *
+from .planVariants import *
@@ -5,6 +5,12 @@
 from __main__ import vtk, slicer, qt
 import numpy as np
 import logging
+import collections
+import itertools
+import hashlib
+from .memoryBudget import *
+from .stageTimings import *
+from .meshTransport import *
 
 def getIntersectionBetweenModelAnd1Plane(modelNode,planeNode,intersectionModel):
   plane = vtk.vtkPlane()
@@ -33,62 +39,67 @@ def getFurthestIntersectionBetweenModelAnd1Plane(modelNode,planeNode,intersectio
 
   intersectionModel.SetAndObservePolyData(furthestRegionPD)
 
-def extractFurthestRegion(polyData, point):
-    # Label all connected regions
-    connectivity = vtk.vtkConnectivityFilter()
-    connectivity.SetInputData(polyData)
-    connectivity.SetExtractionModeToAllRegions()
-    connectivity.ColorRegionsOn()
-    connectivity.Update()
-
-    numRegions = connectivity.GetNumberOfExtractedRegions()
-
-    maxDist = -1
-    furthestRegionId = 0
-
-    for regionId in range(numRegions):
-        # Extract each region individually
-        regionExtractor = vtk.vtkConnectivityFilter()
-        regionExtractor.SetInputData(polyData)
-        regionExtractor.SetExtractionModeToSpecifiedRegions()
-        regionExtractor.AddSpecifiedRegion(regionId)
-        regionExtractor.Update()
-
-        # Convert to polydata (vtkConnectivityFilter outputs vtkUnstructuredGrid)
-        surfaceFilter = vtk.vtkDataSetSurfaceFilter()
-        surfaceFilter.SetInputConnection(regionExtractor.GetOutputPort())
-        surfaceFilter.Update()
-
-        regionPolyData = surfaceFilter.GetOutput()
-        if regionPolyData.GetNumberOfPoints() == 0:
-            continue
+def labelConnectedRegions(polyData):
+  """
+  Label all the connected regions of polyData in a single connectivity pass.
+  Returns the labeled polydata (with a "RegionId" point and cell array), the region id of
+  each of its points as a numpy array and the number of regions.
+  """
+  from vtk.util.numpy_support import vtk_to_numpy
+  # a polydata input gives a polydata output with the region ids as point and cell data
+  connectivityFilter = vtk.vtkConnectivityFilter()
+  connectivityFilter.SetInputData(polyData)
+  connectivityFilter.SetExtractionModeToAllRegions()
+  connectivityFilter.ColorRegionsOn()
+  connectivityFilter.Update()
 
-        # Find closest point in this region to the reference point
-        pointLocator = vtk.vtkPointLocator()
-        pointLocator.SetDataSet(regionPolyData)
-        pointLocator.BuildLocator()
-        closestPointId = pointLocator.FindClosestPoint(point)
-        closestPoint = regionPolyData.GetPoint(closestPointId)
+  labeledPolyData = connectivityFilter.GetOutput()
+  numberOfRegions = connectivityFilter.GetNumberOfExtractedRegions()
+  if labeledPolyData.GetNumberOfPoints() == 0:
+    return labeledPolyData, np.zeros(0, dtype=int), numberOfRegions
+  pointsRegionIds = vtk_to_numpy(labeledPolyData.GetPointData().GetArray("RegionId")).astype(int)
+  return labeledPolyData, pointsRegionIds, numberOfRegions
 
-        import math
-        dist = math.sqrt(vtk.vtkMath.Distance2BetweenPoints(point, closestPoint))
+def getRegionsDistancesToPoint(labeledPolyData, pointsRegionIds, numberOfRegions, point):
+  """
+  Distance from point to the closest point of each region labeled by labelConnectedRegions,
+  infinity for regions without points
+  """
+  if numberOfRegions == 0 or len(pointsRegionIds) == 0:
+    return np.full(numberOfRegions, np.inf)
+  from vtk.util.numpy_support import vtk_to_numpy
+  points = vtk_to_numpy(labeledPolyData.GetPoints().GetData())
+  pointsDistances = np.linalg.norm(points - np.asarray(point, dtype=float), axis=1)
+  regionsDistances = np.full(numberOfRegions, np.inf)
+  np.minimum.at(regionsDistances, pointsRegionIds, pointsDistances)
+  return regionsDistances
 
-        if dist > maxDist:
-            maxDist = dist
-            furthestRegionId = regionId
+def extractLabeledRegion(labeledPolyData, regionId):
+  """
+  Polydata of one of the regions labeled by labelConnectedRegions
+  """
+  threshold = vtk.vtkThreshold()
+  threshold.SetInputData(labeledPolyData)
+  threshold.SetInputArrayToProcess(0, 0, 0, vtk.vtkDataObject.FIELD_ASSOCIATION_CELLS, "RegionId")
+  threshold.SetLowerThreshold(regionId-0.1)
+  threshold.SetUpperThreshold(regionId+0.1)
 
-    # Extract the furthest region
-    finalExtractor = vtk.vtkConnectivityFilter()
-    finalExtractor.SetInputData(polyData)
-    finalExtractor.SetExtractionModeToSpecifiedRegions()
-    finalExtractor.AddSpecifiedRegion(furthestRegionId)
-    finalExtractor.Update()
+  geometryFilter = vtk.vtkGeometryFilter()
+  geometryFilter.SetInputConnection(threshold.GetOutputPort())
+  geometryFilter.Update()
+  return geometryFilter.GetOutput()
 
-    toPolyData = vtk.vtkDataSetSurfaceFilter()
-    toPolyData.SetInputConnection(finalExtractor.GetOutputPort())
-    toPolyData.Update()
+def extractFurthestRegion(polyData, point):
+  """
+  Connected region of polyData whose closest point is the furthest from point
+  """
+  labeledPolyData, pointsRegionIds, numberOfRegions = labelConnectedRegions(polyData)
+  if numberOfRegions == 0:
+    return vtk.vtkPolyData()
 
-    return toPolyData.GetOutput()
+  regionsDistances = getRegionsDistancesToPoint(labeledPolyData, pointsRegionIds, numberOfRegions, point)
+  regionsDistances[np.isinf(regionsDistances)] = -1
+  return extractLabeledRegion(labeledPolyData, int(np.argmax(regionsDistances)))
 
 def getIntersectionBetweenModelAnd1PlaneWithNormalAndOrigin(modelNode,normal,origin,intersectionModel):
   plane = vtk.vtkPlane()
@@ -102,6 +113,50 @@ def getIntersectionBetweenModelAnd1PlaneWithNormalAndOrigin(modelNode,normal,ori
 
   intersectionModel.SetAndObservePolyData(cutter.GetOutput())
 
+def getCrossSectionCentroid(polyData, normal, origin):
+  """
+  Centroid of the points of the cross section of polyData by the plane, None if the plane misses it
+  """
+  plane = vtk.vtkPlane()
+  plane.SetOrigin(origin)
+  plane.SetNormal(normal)
+
+  cutter = vtk.vtkCutter()
+  cutter.SetInputData(polyData)
+  cutter.SetCutFunction(plane)
+  cutter.Update()
+
+  crossSectionPoints = cutter.GetOutput().GetPoints()
+  if crossSectionPoints is None or crossSectionPoints.GetNumberOfPoints() == 0:
+    return None
+  from vtk.util.numpy_support import vtk_to_numpy
+  return np.average(vtk_to_numpy(crossSectionPoints.GetData()).astype(float), axis=0)
+
+def centerLineInsideModel(polyData, lineStartPos, lineEndPos, tolerance, maximumNumberOfIterations, lineLength=None):
+  """
+  Move each end of the line to the centroid of the cross section of polyData by the plane perpendicular
+  to the line at that end, repeatedly, until no end moves more than tolerance.
+  If lineLength is given the end is placed at that distance from the start along the new direction.
+  Returns lineStartPos, lineEndPos, the number of iterations used and whether it converged.
+  The positions are None if a plane missed the model.
+  """
+  lineStartPos = np.asarray(lineStartPos, dtype=float)
+  lineEndPos = np.asarray(lineEndPos, dtype=float)
+  for iteration in range(1, maximumNumberOfIterations + 1):
+    lineDirection = (lineEndPos-lineStartPos)/np.linalg.norm(lineEndPos-lineStartPos)
+    newLineStartPos = getCrossSectionCentroid(polyData, lineDirection, lineStartPos)
+    newLineEndPos = getCrossSectionCentroid(polyData, lineDirection, lineEndPos)
+    if newLineStartPos is None or newLineEndPos is None:
+      return None, None, iteration, False
+    if lineLength is not None:
+      newLineEndPos = newLineStartPos + lineLength*(newLineEndPos-newLineStartPos)/np.linalg.norm(newLineEndPos-newLineStartPos)
+
+    displacement = max(np.linalg.norm(newLineStartPos-lineStartPos), np.linalg.norm(newLineEndPos-lineEndPos))
+    lineStartPos, lineEndPos = newLineStartPos, newLineEndPos
+    if displacement < tolerance:
+      return lineStartPos, lineEndPos, iteration, True
+  return lineStartPos, lineEndPos, maximumNumberOfIterations, False
+
 def getCutHalfBetweenModelAnd1PlaneWithNormalAndOrigin(modelNode,normal,origin,intersectionModel):
   plane = vtk.vtkPlane()
   plane.SetOrigin(origin)
@@ -144,130 +199,271 @@ def getIntersectionBetweenModelAnd1TransformedPlane(modelNode,transform,planeNod
 
   intersectionModel.SetAndObservePolyData(cutter.GetOutput())
 
-def getAverageNormalFromModel(model):
-  if model.GetMesh().GetPoints() is None:
-    return None
-  
-  pointsOfModel = slicer.util.arrayFromModelPoints(model)
-  normalsOfModel = slicer.util.arrayFromModelPointData(model, 'Normals')
-  modelMesh = model.GetMesh()
-
-  averageNormal = np.array([0,0,0])
-  for pointID in range(len(pointsOfModel)):
-    normalAtPointID = normalsOfModel[pointID]
-    averageNormal = averageNormal + normalAtPointID
-  
-  averageNormal = averageNormal/len(pointsOfModel)
-
-  return averageNormal
-
-def getAverageNormalFromModelPoint(model,point):
-  normalsOfModel = slicer.util.arrayFromModelPointData(model, 'Normals')
-  
-  modelMesh = model.GetMesh()
-  pointID = modelMesh.FindPoint(point)
-  normalAtPointID = normalsOfModel[pointID]
+SURFACE_NORMALS_CACHE_SIZE = 8
+_surfaceNormalsCache = collections.OrderedDict()
 
-  cylinder = vtk.vtkCylinder()
-  cylinder.SetRadius(3)
-  cylinder.SetCenter(point)
-  cylinder.SetAxis(normalAtPointID)
-
-  clipper = vtk.vtkClipPolyData()
-  clipper.SetInputData(model.GetPolyData())
-  clipper.InsideOutOn()
-  clipper.SetClipFunction(cylinder)
-  clipper.Update()
-
-  connectivityFilter = vtk.vtkConnectivityFilter()
-  connectivityFilter.SetInputData(clipper.GetOutput())
-  connectivityFilter.SetClosestPoint(point)
-  connectivityFilter.SetExtractionModeToClosestPointRegion()
-  connectivityFilter.Update()
+def getSurfaceTrianglesNormalsAndLocator(polyData):
+  """
+  Triangulated copy of polyData with its points, the area weighted normal (cross product of two edges, its
+  norm is twice the area) and the centroid of each triangle and a cell locator over it.
+  They are computed once and reused until polyData is modified, which is detected by a change of its MTime.
+  """
+  from vtk.util.numpy_support import vtk_to_numpy
+  cacheKey = polyData.GetAddressAsString("vtkPolyData")
+  modifiedTime = polyData.GetMTime()
+  cachedEntry = _surfaceNormalsCache.get(cacheKey)
+  if cachedEntry is not None and cachedEntry[0] == modifiedTime:
+    _surfaceNormalsCache.move_to_end(cacheKey)
+    return cachedEntry[1]
 
-  cylinderIntersectionModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','cylinderIntersection')
-  cylinderIntersectionModel.CreateDefaultDisplayNodes()
-  cylinderIntersectionModel.SetAndObservePolyData(
-    calculateNormals(connectivityFilter.GetOutput())
-  )
+  triangleFilter = vtk.vtkTriangleFilter()
+  triangleFilter.SetInputData(polyData)
+  triangleFilter.PassVertsOff()
+  triangleFilter.PassLinesOff()
+  triangleFilter.Update()
+  trianglesPolyData = triangleFilter.GetOutput()
 
-  averageNormal = getAverageNormalFromModel(cylinderIntersectionModel)
+  if trianglesPolyData.GetNumberOfPolys() == 0:
+    surfaceTriangles = None
+  else:
+    points = vtk_to_numpy(trianglesPolyData.GetPoints().GetData()).astype(float)
+    triangles = vtk_to_numpy(trianglesPolyData.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    trianglesPoints = points[triangles]
+    weightedNormals = np.cross(trianglesPoints[:, 1] - trianglesPoints[:, 0], trianglesPoints[:, 2] - trianglesPoints[:, 0])
+
+    cellLocator = vtk.vtkStaticCellLocator()
+    cellLocator.SetDataSet(trianglesPolyData)
+    cellLocator.BuildLocator()
+
+    pointNormals = trianglesPolyData.GetPointData().GetNormals()
+    surfaceTriangles = {
+      "polyData": trianglesPolyData,
+      "points": points,
+      "triangles": triangles,
+      "weightedNormals": weightedNormals,
+      "centroids": trianglesPoints.mean(axis=1),
+      "pointNormals": vtk_to_numpy(pointNormals) if pointNormals is not None else None,
+      "cellLocator": cellLocator,
+    }
+
+  _surfaceNormalsCache[cacheKey] = (modifiedTime, surfaceTriangles)
+  while len(_surfaceNormalsCache) > SURFACE_NORMALS_CACHE_SIZE:
+    _surfaceNormalsCache.popitem(last=False)
+  return surfaceTriangles
+
+def getAverageNormalFromPolyData(polyData, center=None, radius=None):
+  """
+  Area weighted average of the normals of the triangles of polyData, as a unit vector.
+  If center and radius are given only the triangles with a vertex or the centroid within radius of center
+  and that face the same side as the surface at center are used (so the other side of a thin
+  piece is ignored) and the result points to the same side as the point normals at center.
+  Returns None if there are no triangles to average.
+  """
+  if polyData is None or polyData.GetNumberOfCells() == 0:
+    return None
+  surfaceTriangles = getSurfaceTrianglesNormalsAndLocator(polyData)
+  if surfaceTriangles is None:
+    return None
 
-  slicer.mrmlScene.RemoveNode(cylinderIntersectionModel)
+  weightedNormals = surfaceTriangles["weightedNormals"]
+  if center is None or radius is None:
+    averageNormal = weightedNormals.sum(axis=0)
+  else:
+    center = np.asarray(center, dtype=float)
+    closestPoint = [0.,0.,0.]
+    closestCellId = vtk.reference(0)
+    subId = vtk.reference(0)
+    distance2 = vtk.reference(0.)
+    surfaceTriangles["cellLocator"].FindClosestPoint(center, closestPoint, closestCellId, subId, distance2)
+    referenceNormal = weightedNormals[int(closestCellId)]
+    if surfaceTriangles["pointNormals"] is not None:
+      referenceNormal = surfaceTriangles["pointNormals"][surfaceTriangles["triangles"][int(closestCellId), 0]]
+
+    neighborCellIds = vtk.vtkIdList()
+    neighborhoodBounds = np.stack([center - radius, center + radius], axis=1).ravel()
+    surfaceTriangles["cellLocator"].FindCellsWithinBounds(neighborhoodBounds, neighborCellIds)
+    neighborCells = np.array([neighborCellIds.GetId(i) for i in range(neighborCellIds.GetNumberOfIds())], dtype=int)
+    if len(neighborCells) == 0:
+      return None
+    neighborNormals = weightedNormals[neighborCells]
+    neighborTrianglesPoints = surfaceTriangles["points"][surfaceTriangles["triangles"][neighborCells]]
+    distancesToCenter = np.linalg.norm(
+      np.concatenate([neighborTrianglesPoints, surfaceTriangles["centroids"][neighborCells, None]], axis=1) - center, axis=2
+    ).min(axis=1)
+    inNeighborhood = (
+      ((distancesToCenter <= radius) | (neighborCells == int(closestCellId))) &
+      (neighborNormals @ referenceNormal > 0)
+    )
+    averageNormal = neighborNormals[inNeighborhood].sum(axis=0)
+    if averageNormal @ referenceNormal < 0:
+      averageNormal = -averageNormal
 
-  if averageNormal is None:
+  averageNormalNorm = np.linalg.norm(averageNormal)
+  if averageNormalNorm == 0:
     return None
+  return averageNormal/averageNormalNorm
 
-  if vtk.vtkMath.Dot(averageNormal, normalAtPointID) < 0:
-    averageNormal *= -1
+def getAverageNormalFromModel(model):
+  return getAverageNormalFromPolyData(model.GetPolyData())
 
-  return averageNormal
+def getAverageNormalFromModelPoint(model,point):
+  return getAverageNormalFromPolyData(model.GetPolyData(), point, radius=3)
 
 def getAverageNormalFromModelPoint2(model,point):
-  cropRadius = 2
-  geodesicCropRadius = cropRadius*2
-
-  normalsOfModel = slicer.util.arrayFromModelPointData(model, 'Normals')
-  
-  modelMesh = model.GetMesh()
-  pointID = modelMesh.FindPoint(point)
-  normalAtPointID = normalsOfModel[pointID]
-
-  geodesicCroppedModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','geodesicCroppedModel')
-  geodesicCroppedModel.CreateDefaultDisplayNodes()
-
-  auxiliarFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode','auxiliarGeodesicCropFiducial')
-  auxiliarFiducial.CreateDefaultDisplayNodes()
-  auxiliarFiducial.AddControlPoint(point)
-
-  dynamicModelerNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLDynamicModelerNode")
-  dynamicModelerNode.SetToolName("Select by points")
-  dynamicModelerNode.SetNodeReferenceID("SelectByPoints.InputModel", model.GetID())
-  dynamicModelerNode.SetNodeReferenceID("SelectByPoints.InputFiducial", auxiliarFiducial.GetID())
-  dynamicModelerNode.SetNodeReferenceID("SelectByPoints.SelectedFacesModel", geodesicCroppedModel.GetID())
-  dynamicModelerNode.SetAttribute("SelectionDistance",str(geodesicCropRadius))
-  dynamicModelerNode.SetAttribute("SelectionAlgorithm","SphereRadius")
-
-  slicer.modules.dynamicmodeler.logic().RunDynamicModelerTool(dynamicModelerNode)
-
-  cylinder = vtk.vtkCylinder()
-  cylinder.SetRadius(cropRadius)
-  cylinder.SetCenter(point)
-  cylinder.SetAxis(normalAtPointID)
-
-  clipper = vtk.vtkClipPolyData()
-  clipper.SetInputData(geodesicCroppedModel.GetPolyData())
-  clipper.InsideOutOn()
-  clipper.SetClipFunction(cylinder)
-  clipper.Update()
-
-  connectivityFilter = vtk.vtkConnectivityFilter()
-  connectivityFilter.SetInputData(clipper.GetOutput())
-  connectivityFilter.SetClosestPoint(point)
-  connectivityFilter.SetExtractionModeToClosestPointRegion()
-  connectivityFilter.Update()
-
-  cylinderIntersectionModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','cylinderIntersection')
-  cylinderIntersectionModel.CreateDefaultDisplayNodes()
-  cylinderIntersectionModel.SetAndObservePolyData(
-    calculateNormals(connectivityFilter.GetOutput())
-  )
+  return getAverageNormalFromPolyData(model.GetPolyData(), point, radius=2)
 
-  averageNormal = getAverageNormalFromModel(cylinderIntersectionModel)
+SURFACE_DISTANCES_CACHE_SIZE = 16
+_surfaceDistancesCache = collections.OrderedDict()
 
-  slicer.mrmlScene.RemoveNode(geodesicCroppedModel)
-  slicer.mrmlScene.RemoveNode(auxiliarFiducial)
-  slicer.mrmlScene.RemoveNode(dynamicModelerNode)
-  slicer.mrmlScene.RemoveNode(cylinderIntersectionModel)
-
-  if averageNormal is None:
+def getSurfaceImplicitDistance(polyData):
+  """
+  vtkImplicitPolyDataDistance of polyData (negative inside the surface), its cell locator is built
+  once and reused until polyData is modified, which is detected by a change of its MTime
+  """
+  cacheKey = polyData.GetAddressAsString("vtkPolyData")
+  modifiedTime = polyData.GetMTime()
+  cachedEntry = _surfaceDistancesCache.get(cacheKey)
+  if cachedEntry is not None and cachedEntry[0] == modifiedTime:
+    _surfaceDistancesCache.move_to_end(cacheKey)
+    return cachedEntry[1]
+
+  implicitDistance = vtk.vtkImplicitPolyDataDistance()
+  implicitDistance.SetInput(polyData)
+
+  _surfaceDistancesCache[cacheKey] = (modifiedTime, implicitDistance)
+  while len(_surfaceDistancesCache) > SURFACE_DISTANCES_CACHE_SIZE:
+    _surfaceDistancesCache.popitem(last=False)
+  return implicitDistance
+
+def getSignedDistancesOfPointsToSurface(points, surfacePolyData):
+  """
+  Signed distance of each (N, 3) point to the closed surface, negative for the points inside it
+  """
+  from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+  points = np.ascontiguousarray(points, dtype=float).reshape(-1, 3)
+  if len(points) == 0:
+    return np.zeros(0)
+  distances = vtk.vtkDoubleArray()
+  getSurfaceImplicitDistance(surfacePolyData).FunctionValue(numpy_to_vtk(points, deep=True), distances)
+  return vtk_to_numpy(distances).copy()
+
+def polyDatasCollide(polyData1, polyData2):
+  """
+  True if a cell of polyData1 intersects a cell of polyData2 (exact test of vtkCollisionDetectionFilter)
+  """
+  collisionDetection = vtk.vtkCollisionDetectionFilter()
+  collisionDetection.SetInputData(0, polyData1)
+  collisionDetection.SetInputData(1, polyData2)
+  identityMatrix = vtk.vtkMatrix4x4()
+  collisionDetection.SetMatrix(0, identityMatrix)
+  collisionDetection.SetMatrix(1, identityMatrix)
+  collisionDetection.SetBoxTolerance(0.0)
+  collisionDetection.SetCellTolerance(0.0)
+  collisionDetection.SetNumberOfCellsPerNode(2)
+  collisionDetection.SetCollisionModeToFirstContact()
+  collisionDetection.Update()
+  return collisionDetection.GetNumberOfContacts() > 0
+
+def getBoundsIntersection(bounds1, bounds2):
+  """
+  Intersection of two bounds ([xmin,xmax,ymin,ymax,zmin,zmax]), None if they do not intersect
+  """
+  bounds = [
+    (max if i % 2 == 0 else min)(bounds1[i], bounds2[i]) for i in range(6)
+  ]
+  if any(bounds[2*i] > bounds[2*i + 1] for i in range(3)):
     return None
+  return bounds
 
-  if vtk.vtkMath.Dot(averageNormal, normalAtPointID) < 0:
-    averageNormal *= -1
-
-  return averageNormal
-
+def getSurfacePointsInsideBounds(polyData, bounds, samplingDistance):
+  """
+  (N, 3) points sampled every samplingDistance over the part of the surface of polyData inside bounds
+  """
+  from vtk.util.numpy_support import vtk_to_numpy
+  # clipped by each face plane, not extracted, so the parts inside bounds of large cells that
+  # cross them with no point inside are kept
+  clippedPolyData = polyData
+  for i in range(3):
+    for side in range(2):
+      normal = [0., 0., 0.]
+      normal[i] = 1. if side == 0 else -1.
+      origin = [0., 0., 0.]
+      origin[i] = bounds[2*i + side]
+      plane = vtk.vtkPlane()
+      plane.SetOrigin(origin)
+      plane.SetNormal(normal)
+      clipper = vtk.vtkClipPolyData()
+      clipper.SetInputData(clippedPolyData)
+      clipper.SetClipFunction(plane)
+      clipper.Update()
+      clippedPolyData = clipper.GetOutput()
+
+  pointSampler = vtk.vtkPolyDataPointSampler()
+  pointSampler.SetInputData(clippedPolyData)
+  pointSampler.SetDistance(samplingDistance)
+  pointSampler.GenerateVertexPointsOn()
+  pointSampler.GenerateEdgePointsOn()
+  pointSampler.GenerateInteriorPointsOn()
+  pointSampler.Update()
+
+  points = pointSampler.GetOutput().GetPoints()
+  if points is None:
+    return np.zeros((0, 3))
+  return vtk_to_numpy(points.GetData())
+
+def getClearanceBetweenPolyDatas(polyData1, polyData2, samplingDistance=0.1):
+  """
+  Minimum distance between the surfaces of two closed meshes, measured from the points of each
+  one to the surface of the other. The distance of the point nearest to the other mesh center is
+  an upper bound of the clearance, so only the points closer than it to the other mesh bounds are
+  queried.
+  Meshes can overlap with no point of one inside the other (crossing edges or faces), so when their
+  bounds intersect an exact cell intersection test is run too. If they overlap the clearance is
+  minus the deepest penetration of the surface of one mesh into the other, measured on points
+  sampled every samplingDistance over the surfaces in the overlapping bounds, so it is exact within
+  samplingDistance.
+  """
+  from vtk.util.numpy_support import vtk_to_numpy
+  clearance = np.inf
+  for pointsPolyData, surfacePolyData in ((polyData1, polyData2), (polyData2, polyData1)):
+    if pointsPolyData.GetNumberOfPoints() == 0 or surfacePolyData.GetNumberOfCells() == 0:
+      continue
+    points = vtk_to_numpy(pointsPolyData.GetPoints().GetData())
+    surfaceBounds = np.reshape(surfacePolyData.GetBounds(), (3, 2))
+
+    nearestToCenterPoint = points[np.argmin(np.linalg.norm(points - surfaceBounds.mean(axis=1), axis=1))]
+    clearance = min(clearance, getSignedDistancesOfPointsToSurface(nearestToCenterPoint, surfacePolyData)[0])
+
+    searchDistance = max(clearance, 0.)
+    distancesToBounds = np.linalg.norm(
+      np.maximum(0., np.maximum(surfaceBounds[:, 0] - points, points - surfaceBounds[:, 1])), axis=1
+    )
+    candidatePoints = points[distancesToBounds <= searchDistance]
+    if len(candidatePoints) > 0:
+      clearance = min(clearance, getSignedDistancesOfPointsToSurface(candidatePoints, surfacePolyData).min())
+
+  if polyData1.GetNumberOfCells() == 0 or polyData2.GetNumberOfCells() == 0:
+    return float(clearance)
+  overlappingBounds = getBoundsIntersection(polyData1.GetBounds(), polyData2.GetBounds())
+  if overlappingBounds is None or (clearance > 0 and not polyDatasCollide(polyData1, polyData2)):
+    return float(clearance)
+
+  for pointsPolyData, surfacePolyData in ((polyData1, polyData2), (polyData2, polyData1)):
+    sampledPoints = getSurfacePointsInsideBounds(pointsPolyData, overlappingBounds, samplingDistance)
+    if len(sampledPoints) > 0:
+      clearance = min(clearance, getSignedDistancesOfPointsToSurface(sampledPoints, surfacePolyData).min())
+  # touching surfaces give -0.
+  return float(clearance) if clearance < 0 else 0.
+
+def getClearancesBetweenConsecutivePolyDatas(polyDataList):
+  """
+  Clearance between each polydata and the next one of the list, that are the only adjacent pairs
+  for pieces placed one after the other (e.g. the fibula pieces along the fibula)
+  """
+  return [
+    getClearanceBetweenPolyDatas(polyDataList[i], polyDataList[i+1])
+    for i in range(len(polyDataList) - 1)
+  ]
 
 def getClosestModelPointToPosition(model,position):
   pointsLocator = vtk.vtkPointLocator()
@@ -299,30 +495,24 @@ def getPointOfATwoPointsModelThatMakesLineDirectionSimilarToVector(twoPointsMode
   else:
     return points[0]
 
-def nearestPointOverLineWithTheVectorDirection(pointsModel, vector):
+def getExtremePointsIndicesAlongDirection(points, direction):
   """
-  Given array1 and array2 of 3D points in numpy, 
-  create a matrix from substracting every ith point in array1 
-  to every jth point in array2
-  
+  Indices of the points with the smallest and the largest projection over direction
+  """
+  projections = np.asarray(points, dtype=float) @ np.asarray(direction, dtype=float)
+  return int(np.argmin(projections)), int(np.argmax(projections))
 
+def nearestPointOverLineWithTheVectorDirection(pointsModel, vector):
+  """
+  Point of pointsModel that is furthest along vector, i.e. the one that maximizes
+  (points[i] - points[j]).vector over all the pairs of points
   """
   pointsData = pointsModel.GetPolyData().GetPoints().GetData()
   from vtk.util.numpy_support import vtk_to_numpy
   points = vtk_to_numpy(pointsData)
 
-  # result[i, j] = array1[i] - array2[j], shape: (N, M, 3)
-  result = points[:, np.newaxis, :] - points[np.newaxis, :, :]
-  
-  unitVector = vector/np.linalg.norm(vector)
-  
-  dots = np.dot(result, unitVector)
-
-  # find the ith and jth that maximize the dot product
-  maxDotIndex = np.unravel_index(np.argmax(dots), dots.shape)
-  # return points[maxDotIndex[0]], points[maxDotIndex[1]]
-
-  return points[maxDotIndex[0]]
+  _, furthestPointIndex = getExtremePointsIndicesAlongDirection(points, vector)
+  return points[furthestPointIndex]
 
 def projectBoxesOverFibulaLine(boxesModelsList, fibulaLineMarkup):
   #fibulaLine = vtk.vtkLine()
@@ -350,36 +540,74 @@ def projectBoxesOverFibulaLine(boxesModelsList, fibulaLineMarkup):
 
   return projectedPointsOfStartingBoxPoints, projectedPointsOfEndingBoxPoints
 
+def getPointsArray(points):
+  """
+  Points as a (N, 3) float numpy array, points may be a vtkPoints or anything numpy can convert
+  """
+  if isinstance(points, vtk.vtkPoints):
+    from vtk.util.numpy_support import vtk_to_numpy
+    if points.GetNumberOfPoints() == 0:
+      return np.zeros((0, 3))
+    return vtk_to_numpy(points.GetData()).astype(float)
+  return np.asarray(points, dtype=float).reshape(-1, 3)
+
 def getMostDistantPoints(points1, points2):
-  # using math to get the two most distant points between projectedPointsOfStartingBoxPoints and projectedPointsOfEndingBoxPoints
-  maxDistance = -1
-  for i in range(points1.GetNumberOfPoints()):
-    pointOfStartingBox = points1.GetPoint(i)
-    for j in range(points2.GetNumberOfPoints()):
-      pointOfEndingBox = points2.GetPoint(j)
-      distance = np.linalg.norm(np.array(pointOfStartingBox)-np.array(pointOfEndingBox))
-      if distance > maxDistance:
-        maxDistance = distance
-        furthestPointOfStartingBox = pointOfStartingBox
-        furthestPointOfEndingBox = pointOfEndingBox 
-  
-  return furthestPointOfStartingBox, furthestPointOfEndingBox
+  """
+  The point of points1 and the point of points2 that are furthest apart.
+  If all the points lie on a line (e.g. they were projected over the fibula line) only the
+  extreme points of each set along that line can be the answer so just those are compared,
+  otherwise all the pairs are compared by blocks that fit in the memory budget.
+  """
+  points1 = getPointsArray(points1)
+  points2 = getPointsArray(points2)
+  if len(points1) == 0 or len(points2) == 0:
+    return None, None
+
+  allPoints = np.concatenate([points1, points2])
+  lineDirection = allPoints[np.argmax(np.linalg.norm(allPoints - allPoints[0], axis=1))] - allPoints[0]
+  lineLength = np.linalg.norm(lineDirection)
+  if lineLength > 0:
+    lineDirection = lineDirection/lineLength
+    offsets = allPoints - allPoints[0]
+    distancesToLine = np.linalg.norm(offsets - np.outer(offsets @ lineDirection, lineDirection), axis=1)
+    if distancesToLine.max() <= 1e-6*max(1., lineLength):
+      points1 = points1[list(getExtremePointsIndicesAlongDirection(points1, lineDirection))]
+      points2 = points2[list(getExtremePointsIndicesAlongDirection(points2, lineDirection))]
+
+  rowsPerBlock = getAffordableNumberOfItems(points2.nbytes, len(points1))
+  maximumDistance = -1
+  for blockStart in range(0, len(points1), rowsPerBlock):
+    distances = np.linalg.norm(points1[blockStart:blockStart+rowsPerBlock, np.newaxis] - points2[np.newaxis], axis=2)
+    maximumIndex = np.unravel_index(np.argmax(distances), distances.shape)
+    if distances[maximumIndex] > maximumDistance:
+      maximumDistance = distances[maximumIndex]
+      furthestPointOfPoints1 = points1[blockStart + maximumIndex[0]]
+      furthestPointOfPoints2 = points2[maximumIndex[1]]
+
+  return furthestPointOfPoints1, furthestPointOfPoints2
+
+def projectPointsOntoLine(points, p1, p2):
+  """
+  Projects the (N, 3) points onto the infinite line defined by p1->p2.
+  Returns the projected points and their line parameters t (p1 + t*(p2 - p1)).
+  """
+  p1, p2 = np.asarray(p1, dtype=float), np.asarray(p2, dtype=float)
+  d = p2 - p1
+  t = (np.asarray(points, dtype=float) - p1) @ d / np.dot(d, d)   # no clamping
+  return p1 + np.outer(t, d), t
 
 def projectPolyDataPointsOntoLine(polyData, p1, p2):
   """
   Projects each point of polyData onto the infinite line defined by p1->p2.
   Returns a new vtkPoints with the projected positions.
   """
+  from vtk.util.numpy_support import numpy_to_vtk
   projectedPoints = vtk.vtkPoints()
-  projectedPoints.SetNumberOfPoints(polyData.GetNumberOfPoints())
-
-  p1, p2 = np.array(p1), np.array(p2)
-  d = p2 - p1
-  for i in range(polyData.GetNumberOfPoints()):
-      p = np.array(polyData.GetPoint(i))
-      t = np.dot(p - p1, d) / np.dot(d, d)   # no clamping
-      projectedPoints.SetPoint(i, p1 + t * d)
+  if polyData.GetNumberOfPoints() == 0:
+    return projectedPoints
 
+  projectedPointsArray, _ = projectPointsOntoLine(getPointsArray(polyData.GetPoints()), p1, p2)
+  projectedPoints.SetData(numpy_to_vtk(projectedPointsArray, deep=True))
   return projectedPoints
 
 def getLineNorm(line):
@@ -389,14 +617,47 @@ def getLineNorm(line):
   line.GetNthControlPointPosition(1, lineEndPos)
   return np.linalg.norm(lineEndPos-lineStartPos)
 
-def createBox(X, Y, Z, name, defaultVisible = True, highResolution = True):
-  miterBox = slicer.mrmlScene.CreateNodeByClass('vtkMRMLModelNode')
-  miterBox.SetName(slicer.mrmlScene.GetUniqueNameByString(name))
-  slicer.mrmlScene.AddNode(miterBox)
-  miterBox.CreateDefaultDisplayNodes()
-  miterBox.GetDisplayNode().SetVisibility(defaultVisible)
-  miterBox.GetDisplayNode().SetInterpolation(slicer.vtkMRMLModelDisplayNode.FlatInterpolation)
-  #
+TEMPLATE_MESHES_CACHE_SIZE = 32
+_templateMeshesCache = collections.OrderedDict()
+
+def getTemplateMeshInstance(templateKey, createTemplateMesh, templateToInstanceTransform=None):
+  """
+  Mesh returned by createTemplateMesh() for templateKey (kind of mesh and the dimensions it depends
+  on) placed by templateToInstanceTransform, or a copy of it if no transform is given.
+  Each template is only generated once, the instance can be transformed or hardened by the caller
+  without altering the cached mesh.
+  """
+  templateMesh = _templateMeshesCache.get(templateKey)
+  if templateMesh is None:
+    templateMesh = vtk.vtkPolyData()
+    templateMesh.DeepCopy(createTemplateMesh())
+    _templateMeshesCache[templateKey] = templateMesh
+    while len(_templateMeshesCache) > TEMPLATE_MESHES_CACHE_SIZE:
+      _templateMeshesCache.popitem(last=False)
+  else:
+    _templateMeshesCache.move_to_end(templateKey)
+
+  if templateToInstanceTransform is None:
+    meshCopy = vtk.vtkPolyData()
+    meshCopy.DeepCopy(templateMesh)
+    return meshCopy
+
+  transformFilter = vtk.vtkTransformPolyDataFilter()
+  transformFilter.SetInputData(templateMesh)
+  transformFilter.SetTransform(templateToInstanceTransform)
+  transformFilter.Update()
+  return transformFilter.GetOutput()
+
+def getScaleTransform(scaleX, scaleY, scaleZ):
+  scaleTransform = vtk.vtkTransform()
+  scaleTransform.Scale(scaleX, scaleY, scaleZ)
+  return scaleTransform
+
+def getTemplateDimensionsKey(*dimensions):
+  # dimensions that only differ by floating point noise share the template
+  return tuple(round(float(dimension), 6) for dimension in dimensions)
+
+def createBoxMesh(X, Y, Z, highResolution = True):
   miterBoxSource = vtk.vtkCubeSource()
   miterBoxSource.SetXLength(X)
   miterBoxSource.SetYLength(Y)
@@ -404,16 +665,38 @@ def createBox(X, Y, Z, name, defaultVisible = True, highResolution = True):
   triangleFilter = vtk.vtkTriangleFilter()
   triangleFilter.SetInputConnection(miterBoxSource.GetOutputPort())
   #
+  if not highResolution:
+    triangleFilter.Update()
+    return triangleFilter.GetOutput()
+  #
   maximumEdgeLengthMm = 1
   adaptiveSubdivisionFilter = vtk.vtkAdaptiveSubdivisionFilter()
   adaptiveSubdivisionFilter.SetInputConnection(triangleFilter.GetOutputPort())
   adaptiveSubdivisionFilter.SetMaximumEdgeLength(maximumEdgeLengthMm)
   adaptiveSubdivisionFilter.SetMaximumTriangleArea(adaptiveSubdivisionFilter.GetMaximumTriangleAreaMaxValue()) # set to infinity
+  adaptiveSubdivisionFilter.Update()
+  return adaptiveSubdivisionFilter.GetOutput()
+
+def createBox(X, Y, Z, name, defaultVisible = True, highResolution = True):
+  miterBox = slicer.mrmlScene.CreateNodeByClass('vtkMRMLModelNode')
+  miterBox.SetName(slicer.mrmlScene.GetUniqueNameByString(name))
+  slicer.mrmlScene.AddNode(miterBox)
+  miterBox.CreateDefaultDisplayNodes()
+  miterBox.GetDisplayNode().SetVisibility(defaultVisible)
+  miterBox.GetDisplayNode().SetInterpolation(slicer.vtkMRMLModelDisplayNode.FlatInterpolation)
   #
   if highResolution:
-    miterBox.SetPolyDataConnection(adaptiveSubdivisionFilter.GetOutputPort())
+    # the subdivision down to 1mm edges depends on the dimensions, so there is a template per dimension set
+    miterBox.SetAndObservePolyData(getTemplateMeshInstance(
+      ("box",) + getTemplateDimensionsKey(X, Y, Z),
+      lambda: createBoxMesh(X, Y, Z)
+    ))
   else:
-    miterBox.SetPolyDataConnection(triangleFilter.GetOutputPort())
+    miterBox.SetAndObservePolyData(getTemplateMeshInstance(
+      ("unitBox",),
+      lambda: createBoxMesh(1, 1, 1, highResolution=False),
+      getScaleTransform(X, Y, Z)
+    ))
 
   rectanglet = slicer.mrmlScene.CreateNodeByClass('vtkMRMLModelNode')
   rectanglet.SetName(slicer.mrmlScene.GetUniqueNameByString(name + "_rectanglet"))
@@ -431,12 +714,7 @@ def createBox(X, Y, Z, name, defaultVisible = True, highResolution = True):
   
   return miterBox, rectanglet
 
-def createCylinder(name,R,H=50):
-  cylinder = slicer.mrmlScene.CreateNodeByClass('vtkMRMLModelNode')
-  cylinder.SetName(slicer.mrmlScene.GetUniqueNameByString(name))
-  slicer.mrmlScene.AddNode(cylinder)
-  cylinder.CreateDefaultDisplayNodes()
-  #
+def createCylinderMesh(R,H=50):
   lineSource = vtk.vtkLineSource()
   lineSource.SetPoint1(0, 0, H/2)
   lineSource.SetPoint2(0, 0, -H/2)
@@ -456,9 +734,21 @@ def createCylinder(name,R,H=50):
   #
   normalsFilter = vtk.vtkPolyDataNormals()
   normalsFilter.SetInputConnection(triangleFilter.GetOutputPort())
+  normalsFilter.Update()
+  return normalsFilter.GetOutput()
+
+def createCylinder(name,R,H=50):
+  cylinder = slicer.mrmlScene.CreateNodeByClass('vtkMRMLModelNode')
+  cylinder.SetName(slicer.mrmlScene.GetUniqueNameByString(name))
+  slicer.mrmlScene.AddNode(cylinder)
+  cylinder.CreateDefaultDisplayNodes()
   #
-  #cylinder.SetPolyDataConnection(triangleFilter.GetOutputPort())
-  cylinder.SetPolyDataConnection(normalsFilter.GetOutputPort())
+  # the axis is divided in 1mm segments, so there is a template of unit radius per height
+  cylinder.SetAndObservePolyData(getTemplateMeshInstance(
+    ("unitRadiusCylinder",) + getTemplateDimensionsKey(H),
+    lambda: createCylinderMesh(1, H),
+    getScaleTransform(R, R, 1)
+  ))
   cylinder.SetAttribute('radius',str(R))
   cylinder.SetAttribute('height',str(H))
   return cylinder
@@ -498,6 +788,192 @@ def getSegmentStatistics(segmentID, segmentationNode):
   principalZAxis = np.array(stats[segmentID, "LabelmapSegmentStatisticsPlugin.principal_axis_z"])
   return obbOrigin, obbDiameters, principalZAxis
 
+def getPrincipalAxisAndExtentFromPoints(points):
+  """
+  Principal component analysis of a point cloud (N x 3). Returns the centroid, the unit
+  direction of largest variance and the minimum and maximum projections of the points
+  over that direction measured from the centroid.
+  """
+  points = np.asarray(points, dtype=float)
+  centroid = points.mean(axis=0)
+  centeredPoints = points - centroid
+  covarianceMatrix = centeredPoints.T @ centeredPoints
+  # eigh returns the eigenvalues in ascending order
+  eigenvalues, eigenvectors = np.linalg.eigh(covarianceMatrix)
+  principalAxis = eigenvectors[:, -1]
+  projections = centeredPoints @ principalAxis
+  return centroid, principalAxis, projections.min(), projections.max()
+
+def getRotationMinimizingFrames(curvePoints, initialXAxis):
+  """
+  Tangents (Z), X and Y axes of a frame at each curve point (N x 3) that is transported along the curve
+  without twisting, starting with initialXAxis (projected perpendicular to the first tangent).
+  The rotations between consecutive tangents are composed with a prefix product so there is no loop over the points.
+  """
+  curvePoints = np.asarray(curvePoints, dtype=float)
+  segmentsLengths = np.linalg.norm(np.diff(curvePoints, axis=0), axis=1)
+  arcLengths = np.concatenate([[0.], np.cumsum(segmentsLengths)])
+  tangents = np.gradient(curvePoints, arcLengths, axis=0)
+  tangents /= np.linalg.norm(tangents, axis=1)[:, None]
+
+  # rotation of each tangent to the next one by the Rodrigues formula: R = I + K + K^2/(1 + cos)
+  crossProducts = np.cross(tangents[:-1], tangents[1:])
+  cosines = np.einsum("ij,ij->i", tangents[:-1], tangents[1:])
+  skewMatrices = np.zeros((len(crossProducts), 3, 3))
+  skewMatrices[:, 0, 1], skewMatrices[:, 0, 2] = -crossProducts[:, 2], crossProducts[:, 1]
+  skewMatrices[:, 1, 0], skewMatrices[:, 1, 2] = crossProducts[:, 2], -crossProducts[:, 0]
+  skewMatrices[:, 2, 0], skewMatrices[:, 2, 1] = -crossProducts[:, 1], crossProducts[:, 0]
+  # a tangent that reverses its direction has no unique minimal rotation, the frame is kept there
+  reversedTangents = cosines < -1 + 1e-6
+  skewMatrices[reversedTangents] = 0.
+  rotations = np.eye(3) + skewMatrices + (skewMatrices @ skewMatrices)/np.maximum(1. + cosines, 1e-6)[:, None, None]
+
+  # cumulativeRotations[i] = rotations[i-1] @ ... @ rotations[0]
+  cumulativeRotations = np.concatenate([np.eye(3)[None], rotations])
+  step = 1
+  while step < len(cumulativeRotations):
+    cumulativeRotations[step:] = cumulativeRotations[step:] @ cumulativeRotations[:-step]
+    step *= 2
+
+  initialXAxis = np.asarray(initialXAxis, dtype=float)
+  initialXAxis = initialXAxis - (initialXAxis @ tangents[0])*tangents[0]
+  initialXAxis /= np.linalg.norm(initialXAxis)
+  xAxes = cumulativeRotations @ initialXAxis
+  # remove the numerical drift so the frames stay orthonormal
+  xAxes -= np.einsum("ij,ij->i", xAxes, tangents)[:, None]*tangents
+  xAxes /= np.linalg.norm(xAxes, axis=1)[:, None]
+  yAxes = np.cross(tangents, xAxes)
+  return tangents, xAxes, yAxes
+
+def sweepProfileAlongCurve(profilePointsXY, curvePoints, initialXAxis, tipsBevelRadius=0., numberOfTipsBevelSegments=8):
+  """
+  Closed triangle mesh made by sweeping a convex profile (P x 2, clockwise) along the curve points (N x 3).
+  The profile axes follow the rotation minimizing frames of the curve, see getRotationMinimizingFrames.
+  Within tipsBevelRadius of both ends the profile is narrowed along its Y axis following a quarter circle so the
+  tips are rounded. Cross sections that would fold back over the previous one on tight bends are skipped.
+  Returns the points (M x 3) and the triangles (T x 3) of the mesh.
+  """
+  profilePointsXY = np.asarray(profilePointsXY, dtype=float)
+  curvePoints = np.asarray(curvePoints, dtype=float)
+  segmentsLengths = np.linalg.norm(np.diff(curvePoints, axis=0), axis=1)
+  curvePoints = curvePoints[np.concatenate([[True], segmentsLengths > 1e-6])]
+  arcLengths = np.concatenate([[0.], np.cumsum(np.linalg.norm(np.diff(curvePoints, axis=0), axis=1))])
+  curveLength = arcLengths[-1]
+
+  profileHalfLength = np.abs(profilePointsXY[:, 1]).max()
+  tipsBevelRadius = min(tipsBevelRadius, profileHalfLength, curveLength/2)
+  if tipsBevelRadius > 0:
+    # resample the tips so the rounding is not limited by the spacing of the curve points
+    tipsDistances = tipsBevelRadius*(1. - np.cos(np.linspace(0., np.pi/2, numberOfTipsBevelSegments + 1)))
+    innerArcLengths = arcLengths[(arcLengths > tipsBevelRadius) & (arcLengths < curveLength - tipsBevelRadius)]
+    sectionsArcLengths = np.unique(np.concatenate([tipsDistances, innerArcLengths, curveLength - tipsDistances]))
+    curvePoints = np.stack([np.interp(sectionsArcLengths, arcLengths, curvePoints[:, i]) for i in range(3)], axis=1)
+    distancesToTip = np.minimum(sectionsArcLengths, curveLength - sectionsArcLengths)
+    distancesFromBevelCenter = np.clip(tipsBevelRadius - distancesToTip, 0., None)
+    profileYScales = (
+      profileHalfLength - tipsBevelRadius + np.sqrt(tipsBevelRadius**2 - distancesFromBevelCenter**2)
+    )/profileHalfLength
+  else:
+    profileYScales = np.ones(len(curvePoints))
+
+  tangents, xAxes, yAxes = getRotationMinimizingFrames(curvePoints, initialXAxis)
+  sections = (
+    curvePoints[:, None, :] +
+    profilePointsXY[None, :, 0, None]*xAxes[:, None, :] +
+    (profileYScales[:, None]*profilePointsXY[None, :, 1])[:, :, None]*yAxes[:, None, :]
+  )
+
+  keptSections = np.arange(len(sections))
+  while len(keptSections) > 2:
+    centroids = sections[keptSections].mean(axis=1)
+    directions = np.diff(centroids, axis=0)
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    projections = np.einsum("ijk,ik->ij", sections[keptSections[:-1]], directions)
+    nextProjections = np.einsum("ijk,ik->ij", sections[keptSections[1:]], directions)
+    foldedBack = nextProjections.min(axis=1) < projections.max(axis=1)
+    if not foldedBack.any():
+      break
+    # drop the second section of each folded pair, but always keep the last one
+    sectionsToDrop = np.nonzero(foldedBack)[0] + 1
+    sectionsToDrop[sectionsToDrop == len(keptSections) - 1] -= 1
+    keptSections = np.delete(keptSections, np.unique(sectionsToDrop[sectionsToDrop > 0]))
+  sections = sections[keptSections]
+
+  numberOfSections, numberOfProfilePoints = sections.shape[:2]
+  profileIndices = np.arange(numberOfProfilePoints)
+  nextProfileIndices = np.roll(profileIndices, -1)
+  previousSectionsOffsets = (np.arange(numberOfSections - 1)*numberOfProfilePoints)[:, None]
+  nextSectionsOffsets = previousSectionsOffsets + numberOfProfilePoints
+  sideTriangles = np.stack([
+    np.stack([nextSectionsOffsets + profileIndices, nextSectionsOffsets + nextProfileIndices, previousSectionsOffsets + profileIndices], axis=-1),
+    np.stack([previousSectionsOffsets + profileIndices, nextSectionsOffsets + nextProfileIndices, previousSectionsOffsets + nextProfileIndices], axis=-1),
+  ], axis=2).reshape(-1, 3)
+
+  # the profile is convex so the caps are triangle fans, the end cap is reversed to face outward
+  fanIndices = np.arange(1, numberOfProfilePoints - 1)
+  startCapTriangles = np.stack([np.zeros_like(fanIndices), fanIndices, fanIndices + 1], axis=1)
+  endCapTriangles = (numberOfSections - 1)*numberOfProfilePoints + startCapTriangles[:, [0, 2, 1]]
+
+  triangles = np.concatenate([startCapTriangles, sideTriangles, endCapTriangles])
+  return sections.reshape(-1, 3), triangles
+
+def numpyToVtkIdTypeArray(array):
+  from vtk.util import numpy_support
+  idType = numpy_support.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE]
+  return numpy_support.numpy_to_vtkIdTypeArray(np.ascontiguousarray(array, dtype=idType).ravel(), deep=1)
+
+def createPolyDataFromPointsAndTriangles(points, triangles):
+  from vtk.util import numpy_support
+  vtkPoints = vtk.vtkPoints()
+  vtkPoints.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(points, dtype=float), deep=1))
+  triangles = np.asarray(triangles)
+  cellArray = vtk.vtkCellArray()
+  cellArray.SetData(numpyToVtkIdTypeArray(np.arange(0, 3*len(triangles) + 1, 3)), numpyToVtkIdTypeArray(triangles))
+  polyData = vtk.vtkPolyData()
+  polyData.SetPoints(vtkPoints)
+  polyData.SetPolys(cellArray)
+  return polyData
+
+def getTransformedBounds(bounds, matrix):
+  """
+  Axis aligned bounds ([xmin,xmax,ymin,ymax,zmin,zmax]) of the corners of bounds transformed by the 4x4 matrix (numpy array)
+  """
+  corners = np.array(list(itertools.product(bounds[0:2], bounds[2:4], bounds[4:6])))
+  transformedCorners = corners @ matrix[:3, :3].T + matrix[:3, 3]
+  return np.stack([transformedCorners.min(axis=0), transformedCorners.max(axis=0)], axis=1).ravel()
+
+class BoundsSpatialHash:
+  """
+  Uniform grid of cubic cells that finds which of the inserted axis aligned bounds
+  ([xmin,xmax,ymin,ymax,zmin,zmax]) intersect a query. Only the items registered on the cells
+  covered by the query are tested, so the cost does not grow with the items inserted elsewhere.
+  """
+  def __init__(self, cellSize):
+    self.cellSize = cellSize
+    self.cells = collections.defaultdict(list)
+    self.itemsBounds = {}
+
+  def getCellsKeys(self, bounds):
+    bounds = np.asarray(bounds, dtype=float)
+    lowerCell = np.floor(bounds[0::2]/self.cellSize).astype(int)
+    upperCell = np.floor(bounds[1::2]/self.cellSize).astype(int)
+    return itertools.product(*[range(lower, upper + 1) for lower, upper in zip(lowerCell, upperCell)])
+
+  def insert(self, item, bounds):
+    self.itemsBounds[item] = np.asarray(bounds, dtype=float)
+    for cellKey in self.getCellsKeys(bounds):
+      self.cells[cellKey].append(item)
+
+  def getIntersectingItems(self, bounds):
+    bounds = np.asarray(bounds, dtype=float)
+    candidateItems = set()
+    for cellKey in self.getCellsKeys(bounds):
+      candidateItems.update(self.cells.get(cellKey, ()))
+    return [
+      item for item in candidateItems
+      if np.all(self.itemsBounds[item][0::2] <= bounds[1::2]) and np.all(bounds[0::2] <= self.itemsBounds[item][1::2])
+    ]
+
 def calculateSurfaceArea(polydata):
   triangleFilter = vtk.vtkTriangleFilter()
   triangleFilter.SetInputData(polydata)
@@ -554,8 +1030,81 @@ def getIntersectionPointsOfEachModelByMode(intersectionA,intersectionB,measureme
   elif measurementMode == "distal2distal":
     return intersectionAtoBSimilarVectors[-1][2], intersectionAtoBSimilarVectors[-1][3]
   
+def createDecimatedModelCopy(modelNode, targetReduction):
+  """
+  Hidden temporary model with a decimated copy of the mesh of modelNode under the same parent transform
+  """
+  triangleFilter = vtk.vtkTriangleFilter()
+  triangleFilter.SetInputData(modelNode.GetPolyData())
+  decimation = vtk.vtkQuadricDecimation()
+  decimation.SetInputConnection(triangleFilter.GetOutputPort())
+  decimation.SetTargetReduction(targetReduction)
+  decimation.VolumePreservationOn()
+  decimation.Update()
+
+  decimatedModel = slicer.mrmlScene.AddNewNodeByClass(
+    'vtkMRMLModelNode', slicer.mrmlScene.GetUniqueNameByString('temp_decimated_' + modelNode.GetName()))
+  decimatedModel.SetHideFromEditors(True)
+  decimatedModel.SetAndObservePolyData(decimation.GetOutput())
+  decimatedModel.SetAndObserveTransformNodeID(modelNode.GetTransformNodeID())
+  return decimatedModel
+
 class combineModelsRobustLogic:
+  # both backends allocate many times the size of their input meshes (corefinement with exact
+  # arithmetic, intersection contours, retries), estimated over the inputs memory size
+  MEMORY_FACTOR = 20
+  MAXIMUM_INPUT_REDUCTION = 0.9
+
+  @timedStage("booleanOperation", monitorMemory=True)
   def process(
+      inputModelA,
+      inputModelB,
+      outputModel,
+      operation,
+      numberOfRetries = 5,
+      translateRandomly = 3,
+      triangulateInputs = False,
+      decimateInputsOverMemoryBudget = True
+    ):
+    """
+    Run the boolean operation on the full resolution input models if it fits in the memory
+    budget, otherwise on temporary decimated copies of them and report it in the status bar.
+    Outputs that are printed (surgical guides) should pass decimateInputsOverMemoryBudget = False
+    so they are always made from the full resolution inputs. See processInputModels.
+    """
+    estimatedBytes = combineModelsRobustLogic.MEMORY_FACTOR*(
+      getPolyDataMemorySize(inputModelA.GetPolyData()) + getPolyDataMemorySize(inputModelB.GetPolyData())
+    )
+    if (
+      fitsInMemoryBudget(estimatedBytes, "Boolean operation between " + inputModelA.GetName() + " and " + inputModelB.GetName()) or
+      not decimateInputsOverMemoryBudget
+    ):
+      combineModelsRobustLogic.processInputModels(
+        inputModelA, inputModelB, outputModel, operation, numberOfRetries, translateRandomly, triangulateInputs)
+      return
+
+    targetReduction = min(
+      combineModelsRobustLogic.MAXIMUM_INPUT_REDUCTION,
+      1. - getMemoryBudget()/estimatedBytes
+    )
+    message = (
+      f"{outputModel.GetName()} is made from copies of {inputModelA.GetName()} and {inputModelB.GetName()} "
+      f"decimated by {targetReduction:.0%} to stay within the memory budget."
+    )
+    logging.warning(message)
+    slicer.util.showStatusMessage(message, 5000)
+    decimatedInputModels = [
+      createDecimatedModelCopy(inputModel, targetReduction) for inputModel in [inputModelA, inputModelB]
+    ]
+    try:
+      combineModelsRobustLogic.processInputModels(
+        decimatedInputModels[0], decimatedInputModels[1], outputModel, operation,
+        numberOfRetries, translateRandomly, triangulateInputs)
+    finally:
+      for decimatedInputModel in decimatedInputModels:
+        slicer.mrmlScene.RemoveNode(decimatedInputModel)
+
+  def processInputModels(
       inputModelA,
       inputModelB,
       outputModel,
@@ -628,92 +1177,182 @@ class combineModelsRobustLogic:
       non-self-intersecting 2-manifolds first. CGAL corefinement fails on
       invalid inputs, so only disable this for meshes known to be valid.
     """
+    vespaJob = combineModelsRobustLogic.startVESPA(
+      inputModelA, inputModelB, outputModel, operation, repairInputs)
+    combineModelsRobustLogic.finishVESPA(vespaJob)
+
+  def startVESPA(
+      inputModelA,
+      inputModelB,
+      outputModel,
+      operation,
+      repairInputs = True
+    ):
+    """
+    Start one boolean operation with the SlicerVESPA CLI executable and return the
+    job to pass to finishVESPA. The operands are passed to it as binary files in a
+    RAM backed directory (see startCLIWithPolyData), no CLI or temporary model
+    nodes are added to the scene. See processWithVESPA.
+    """
     if operation not in combineModelsRobustLogic.VESPA_OPERATIONS:
       raise ValueError("Invalid operation: " + operation)
     cliOperation, swapOperands = combineModelsRobustLogic.VESPA_OPERATIONS[operation]
 
-    # The CLI reads each node's stored mesh, ignoring parent transform nodes,
+    # The CLI reads each operand as stored, ignoring parent transform nodes,
     # so bake the transform of each input into the output model's frame first
     # (same semantics as the CombineModels module)
-    temporaryInputModels = []
-    cliNode = None
-    try:
-      cliInputModels = []
-      for inputModel in [inputModelA, inputModelB]:
-        transformToOutput = vtk.vtkGeneralTransform()
-        slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(
-          inputModel.GetParentTransformNode(), outputModel.GetParentTransformNode(),
-          transformToOutput)
-        transformerToOutput = vtk.vtkTransformPolyDataFilter()
-        transformerToOutput.SetTransform(transformToOutput)
-        transformerToOutput.SetInputData(inputModel.GetPolyData())
-        transformerToOutput.Update()
-        temporaryInputModel = slicer.mrmlScene.AddNewNodeByClass(
-          'vtkMRMLModelNode', slicer.mrmlScene.GetUniqueNameByString('temp_' + inputModel.GetName()))
-        temporaryInputModel.SetHideFromEditors(True)
-        temporaryInputModel.SetAndObservePolyData(transformerToOutput.GetOutput())
-        temporaryInputModels.append(temporaryInputModel)
-        cliInputModels.append(temporaryInputModel)
-
-      # Empty inputs would make the CLI fail; resolve those cases directly
-      # (same rules as the CombineModels module)
-      polydataA = cliInputModels[0].GetPolyData()
-      polydataB = cliInputModels[1].GetPolyData()
-      modelAEmpty = polydataA.GetNumberOfPoints() == 0
-      modelBEmpty = polydataB.GetNumberOfPoints() == 0
-      if modelAEmpty or modelBEmpty:
-        if operation == "union":
-          result = vtk.vtkPolyData()
-          if not modelAEmpty:
-            result.DeepCopy(polydataA)
-          elif not modelBEmpty:
-            result.DeepCopy(polydataB)
-        elif operation == "intersection":
-          result = vtk.vtkPolyData()
-        elif operation == "difference":
-          result = vtk.vtkPolyData()
-          if not modelAEmpty and modelBEmpty:
-            result.DeepCopy(polydataA)
-        elif operation == "difference2":
-          result = vtk.vtkPolyData()
-          if not modelBEmpty and modelAEmpty:
-            result.DeepCopy(polydataB)
-        outputModel.SetAndObservePolyData(result)
-        if outputModel.GetDisplayNode() is None:
-          outputModel.CreateDefaultDisplayNodes()
-        return
-
-      if swapOperands:
-        cliInputModels.reverse()
-
-      parameters = {
-        "firstPoly": cliInputModels[0],
-        "secondPoly": cliInputModels[1],
-        "output": outputModel,
-        "operation": cliOperation,
-        "repairInputs": repairInputs,
-      }
-      cliNode = slicer.cli.runSync(slicer.modules.vespabooleanoperation, None, parameters)
-      if cliNode.GetStatus() & cliNode.ErrorsMask:
-        errorText = cliNode.GetErrorText()
-        raise RuntimeError("VESPA BooleanOperation CLI failed: " + errorText)
-    finally:
-      if cliNode is not None:
-        slicer.mrmlScene.RemoveNode(cliNode)
-      for temporaryInputModel in temporaryInputModels:
-        slicer.mrmlScene.RemoveNode(temporaryInputModel)
+    operands = []
+    for inputModel in [inputModelA, inputModelB]:
+      transformToOutput = vtk.vtkGeneralTransform()
+      slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(
+        inputModel.GetParentTransformNode(), outputModel.GetParentTransformNode(),
+        transformToOutput)
+      transformerToOutput = vtk.vtkTransformPolyDataFilter()
+      transformerToOutput.SetTransform(transformToOutput)
+      transformerToOutput.SetInputData(inputModel.GetPolyData())
+      transformerToOutput.Update()
+      operands.append(transformerToOutput.GetOutput())
+
+    vespaJob = {"outputModel": outputModel, "cliJob": None, "result": None}
+
+    # Empty inputs would make the CLI fail; resolve those cases directly
+    # (same rules as the CombineModels module)
+    polydataA, polydataB = operands
+    modelAEmpty = polydataA.GetNumberOfPoints() == 0
+    modelBEmpty = polydataB.GetNumberOfPoints() == 0
+    if modelAEmpty or modelBEmpty:
+      result = vtk.vtkPolyData()
+      if operation == "union":
+        if not modelAEmpty:
+          result.DeepCopy(polydataA)
+        elif not modelBEmpty:
+          result.DeepCopy(polydataB)
+      elif operation == "difference":
+        if not modelAEmpty and modelBEmpty:
+          result.DeepCopy(polydataA)
+      elif operation == "difference2":
+        if not modelBEmpty and modelAEmpty:
+          result.DeepCopy(polydataB)
+      vespaJob["result"] = result
+      return vespaJob
+
+    if swapOperands:
+      operands.reverse()
+
+    parameters = {
+      "firstPoly": operands[0],
+      "secondPoly": operands[1],
+      "operation": cliOperation,
+      "repairInputs": repairInputs,
+    }
+    vespaJob["cliJob"] = startCLIWithPolyData(slicer.modules.vespabooleanoperation.path, parameters, "output")
+    return vespaJob
+
+  def isVESPARunning(vespaJob):
+    return vespaJob["cliJob"] is not None and isCLIRunning(vespaJob["cliJob"])
+
+  def finishVESPA(vespaJob):
+    """
+    Wait for a job started by startVESPA and set its result as the output model mesh.
+    Raises RuntimeError if its CLI did not complete successfully.
+    """
+    if vespaJob["cliJob"] is not None:
+      try:
+        vespaJob["result"] = finishCLIWithPolyData(vespaJob["cliJob"])
+      except RuntimeError as e:
+        raise RuntimeError("VESPA BooleanOperation CLI failed: " + str(e))
+      finally:
+        vespaJob["cliJob"] = None
+
+    outputModel = vespaJob["outputModel"]
+    outputModel.SetAndObservePolyData(vespaJob["result"])
     # Callers use the display node right after process(); the CombineModels
     # module guaranteed one, so keep that behavior
     if outputModel.GetDisplayNode() is None:
       outputModel.CreateDefaultDisplayNodes()
 
-def saveExecutedMethodWithTelemetry(method):
+  @timedStage("concurrentBooleanOperations", monitorMemory=True)
+  def processConcurrently(jobs, maximumNumberOfConcurrentJobs = None, pollIntervalS = 0.01):
+    """
+    Run independent boolean operations, jobs is a list of (inputModelA, inputModelB, outputModel, operation).
+    With SlicerVESPA every operation is a separate CLI process, so up to maximumNumberOfConcurrentJobs
+    of them (by default one per spare CPU core, as many as fit in the memory budget) run at the
+    same time. Each result is written to the outputModel of its job, so results keep the jobs order.
+    Jobs that do not fit in the memory budget, or whose CLI fails, and all the jobs when SlicerVESPA
+    is not installed, are run one after another with process().
+    The call returns when all the jobs are done. While the CLIs run the application keeps processing
+    events so the views are repainted, but user input is held until the call returns so the plan
+    can not be modified in the middle of the operations.
+    """
+    import os
+    import time
+
+    sequentialJobs = []
+    concurrentJobs = []
+    maximumJobBytes = 0
+    for job in jobs:
+      inputModelA, inputModelB, outputModel, operation = job
+      estimatedBytes = combineModelsRobustLogic.MEMORY_FACTOR*(
+        getPolyDataMemorySize(inputModelA.GetPolyData()) + getPolyDataMemorySize(inputModelB.GetPolyData())
+      )
+      if (
+        not hasattr(slicer.modules, 'vespabooleanoperation') or
+        operation not in combineModelsRobustLogic.VESPA_OPERATIONS or
+        not fitsInMemoryBudget(estimatedBytes)
+      ):
+        sequentialJobs.append(job)
+      else:
+        concurrentJobs.append(job)
+        maximumJobBytes = max(maximumJobBytes, estimatedBytes)
+
+    if maximumNumberOfConcurrentJobs is None:
+      maximumNumberOfConcurrentJobs = max(1, (os.cpu_count() or 2) - 1)
+    maximumNumberOfConcurrentJobs = getAffordableNumberOfItems(maximumJobBytes, maximumNumberOfConcurrentJobs)
+
+    pendingJobs = collections.deque(concurrentJobs)
+    runningJobs = []
+    while pendingJobs or runningJobs:
+      while pendingJobs and len(runningJobs) < maximumNumberOfConcurrentJobs:
+        job = pendingJobs.popleft()
+        try:
+          runningJobs.append((job, combineModelsRobustLogic.startVESPA(*job)))
+        except Exception as e:
+          logging.exception("VESPA (CGAL) boolean operation could not be started: " + str(e))
+          sequentialJobs.append(job)
+
+      stillRunningJobs = []
+      for job, vespaJob in runningJobs:
+        if combineModelsRobustLogic.isVESPARunning(vespaJob):
+          stillRunningJobs.append((job, vespaJob))
+          continue
+        try:
+          combineModelsRobustLogic.finishVESPA(vespaJob)
+        except Exception as e:
+          logging.exception(
+            "VESPA (CGAL) boolean operation failed, it will be retried with process(): " + str(e))
+          sequentialJobs.append(job)
+      runningJobs = stillRunningJobs
+
+      if runningJobs:
+        slicer.app.processEvents(qt.QEventLoop.ExcludeUserInputEvents)
+        time.sleep(pollIntervalS)
+
+    for inputModelA, inputModelB, outputModel, operation in sequentialJobs:
+      combineModelsRobustLogic.process(inputModelA, inputModelB, outputModel, operation)
+
+def saveExecutedMethodWithTelemetry(method=None, monitorMemory=False):
+    """
+    Record each call of the decorated logic method as a stage of stageTimings and log it as a usage event.
+    Use @saveExecutedMethodWithTelemetry(monitorMemory=True) on the memory heavy methods to record their peak memory.
+    """
+    if method is None:
+      return lambda method: saveExecutedMethodWithTelemetry(method, monitorMemory)
     PREVIEW_RELEASE_OCTOBER_6TH_2024 = 33047
     def decorated_method(self, *args, **kwargs):
-        result = method(self, *args, **kwargs)
+        with stageTimings.stage(method.__name__, monitorMemory):
+          result = method(self, *args, **kwargs)
         if int(slicer.app.revision) >= PREVIEW_RELEASE_OCTOBER_6TH_2024:
           slicer.app.logUsageEvent("BoneReconstructionPlanner", method.__name__)
-        #print("Saved method name: " + method.__name__)
         return result
 
     return decorated_method
@@ -758,6 +1397,50 @@ def setFolderItemVisibility(folderItemID, visibility):
   folderPlugin = pluginHandler.pluginByName("Folder")
   folderPlugin.setDisplayVisibility(folderItemID, visibility)
 
+def applyDisplayStates(displayStates):
+  """
+  Apply display properties to several display nodes at once.
+  displayStates is a list of (displayNode, propertiesDict) where propertiesDict maps
+  a property name to its value, e.g. {"Visibility": True, "Interpolation": ...}
+  calls displayNode.SetVisibility(True) and displayNode.SetInterpolation(...).
+  Each display node fires a single modified event and views are rendered once at the end.
+  """
+  with slicer.util.RenderBlocker():
+    for displayNode, propertiesDict in displayStates:
+      if displayNode is None:
+        continue
+      wasModified = displayNode.StartModify()
+      for propertyName, propertyValue in propertiesDict.items():
+        getattr(displayNode, "Set" + propertyName)(propertyValue)
+      displayNode.EndModify(wasModified)
+
+def setDisplayNodesProperties(displayNodes, **propertiesDict):
+  """
+  Apply the same display properties (e.g. Visibility=False) to several display nodes at once
+  """
+  applyDisplayStates([(displayNode, propertiesDict) for displayNode in displayNodes])
+
+def getModelDisplayNodesUnderFolder(folderName, recursive=True):
+  """
+  Return the display nodes of the models under a subject hierarchy folder
+  """
+  shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+  folderSubjectHierarchyID = shNode.GetItemByName(folderName)
+  if folderSubjectHierarchyID == shNode.GetInvalidItemID():
+    return []
+  childIDs = vtk.vtkIdList()
+  shNode.GetItemChildren(folderSubjectHierarchyID, childIDs, recursive)
+
+  displayNodes = []
+  for i in range(childIDs.GetNumberOfIds()):
+    dataNode = shNode.GetItemDataNode(childIDs.GetId(i))
+    if (dataNode is None) or not(dataNode.IsA("vtkMRMLModelNode")):
+      continue
+    displayNode = dataNode.GetDisplayNode()
+    if displayNode:
+      displayNodes.append(displayNode)
+  return displayNodes
+
 def setFolderItemExpanded(folderItemID, expanded):
   shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
   shNode.SetItemExpanded(folderItemID, expanded)
@@ -978,7 +1661,6 @@ def compareSegmentRepresentations(segment1, segment2):
 
 def compareSegmentRepresentationsV2(segment1, segment2):
     """Compare the actual segment data"""
-    import numpy as np
     
     # Get binary labelmap representation
     rep1 = segment1.GetRepresentation(
@@ -991,23 +1673,7 @@ def compareSegmentRepresentationsV2(segment1, segment2):
     if rep1 is None or rep2 is None:
         return rep1 == rep2
     
-    # Convert vtkOrientedImageData to numpy arrays
-    from vtk.util import numpy_support
-    array1 = numpy_support.vtk_to_numpy(rep1.GetPointData().GetScalars())
-    array2 = numpy_support.vtk_to_numpy(rep2.GetPointData().GetScalars())
-    
-    # Reshape arrays to match image dimensions
-    dims1 = rep1.GetDimensions()
-    dims2 = rep2.GetDimensions()
-    
-    # Check if dimensions match
-    if dims1 != dims2:
-        return False
-    
-    array1 = array1.reshape(dims1[::-1])  # VTK uses (x,y,z), numpy uses (z,y,x)
-    array2 = array2.reshape(dims2[::-1])
-    
-    return np.array_equal(array1, array2)
+    return areImageDataContentsEqual(rep1, rep2)
 
 def areVolumesEqual(vol1, vol2):
     """Compare two volume nodes for equality"""
@@ -1016,18 +1682,108 @@ def areVolumesEqual(vol1, vol2):
     if vol1 is None or vol2 is None:
         return vol1 == vol2
     
-    # Compare image data dimensions
-    imgData1 = vol1.GetImageData()
-    imgData2 = vol2.GetImageData()
-    
-    if imgData1.GetDimensions() != imgData2.GetDimensions():
-        return False
-    
-    # Compare voxel data
-    array1 = slicer.util.arrayFromVolume(vol1)
-    array2 = slicer.util.arrayFromVolume(vol2)
-    
-    return np.array_equal(array1, array2)
+    return areImageDataContentsEqual(vol1.GetImageData(), vol2.GetImageData())
+
+IMAGE_FINGERPRINTS_CACHE_SIZE = 64
+_imageFingerprintsCache = collections.OrderedDict()
+
+def getImageDataScalarsArray(imageData):
+  from vtk.util import numpy_support
+  scalars = imageData.GetPointData().GetScalars()
+  if scalars is None:
+    return np.zeros(0)
+  return numpy_support.vtk_to_numpy(scalars)
+
+def getImageDataFingerprint(imageData):
+  """
+  Content fingerprint of an image: dimensions, scalar type, number of components and a
+  128 bit digest of the voxels. It is computed once and reused until the image or its
+  scalars are modified, which is detected by a change of the image MTime.
+  """
+  if imageData is None:
+    return None
+
+  cacheKey = imageData.GetAddressAsString("vtkImageData")
+  modifiedTime = imageData.GetMTime()
+  cachedFingerprint = _imageFingerprintsCache.get(cacheKey)
+  if cachedFingerprint is not None and cachedFingerprint[0] == modifiedTime:
+    _imageFingerprintsCache.move_to_end(cacheKey)
+    return cachedFingerprint[1]
+
+  # the digest reads the voxels in place, without copying them out of the image
+  array = getImageDataScalarsArray(imageData)
+  digest = hashlib.blake2b(digest_size=16)
+  digest.update(np.ascontiguousarray(array))
+  fingerprint = (
+    tuple(imageData.GetDimensions()),
+    str(array.dtype),
+    imageData.GetNumberOfScalarComponents(),
+    digest.hexdigest()
+  )
+
+  # MTime values are unique over the session, so an image later allocated at the
+  # same address can not match an old entry
+  _imageFingerprintsCache[cacheKey] = (modifiedTime, fingerprint)
+  while len(_imageFingerprintsCache) > IMAGE_FINGERPRINTS_CACHE_SIZE:
+    _imageFingerprintsCache.popitem(last=False)
+  return fingerprint
+
+# Model node attribute with the signature of the inputs its polydata was generated from
+INPUTS_SIGNATURE_ATTRIBUTE_NAME = "inputsSignature"
+
+def getInputsSignature(*inputs):
+  """
+  Digest of the inputs a derived model is generated from: world positions of the control points
+  of markups nodes, point coordinates of model nodes and the value of any other input (e.g. parameters)
+  """
+  hasher = hashlib.blake2b(digest_size=16)
+  for input in inputs:
+    if isinstance(input, slicer.vtkMRMLMarkupsNode):
+      hasher.update(b"markups")
+      if input.GetNumberOfControlPoints() > 0:
+        hasher.update(np.ascontiguousarray(slicer.util.arrayFromMarkupsControlPoints(input, world=True)).tobytes())
+    elif isinstance(input, slicer.vtkMRMLModelNode):
+      hasher.update(b"model")
+      polyData = input.GetPolyData()
+      if polyData is not None and polyData.GetNumberOfPoints() > 0:
+        hasher.update(np.ascontiguousarray(slicer.util.arrayFromModelPoints(input)).tobytes())
+        hasher.update(str(polyData.GetNumberOfCells()).encode())
+    else:
+      hasher.update(repr(input).encode())
+    hasher.update(b"|")
+  return hasher.hexdigest()
+
+def isDerivedModelUpToDate(modelNode, inputsSignature):
+  return (
+    modelNode is not None and
+    modelNode.GetPolyData() is not None and
+    modelNode.GetAttribute(INPUTS_SIGNATURE_ATTRIBUTE_NAME) == inputsSignature
+  )
+
+def setDerivedModelInputsSignature(modelNode, inputsSignature):
+  modelNode.SetAttribute(INPUTS_SIGNATURE_ATTRIBUTE_NAME, inputsSignature)
+
+def areImageDataContentsEqual(imageData1, imageData2, verifyMatchingFingerprints=False):
+  """
+  Compare dimensions and voxel values of two images through their cached fingerprints.
+  Voxels are compared one by one only if the scalar types differ (the digests can not
+  be compared) or if verifyMatchingFingerprints is set to rule out a digest collision.
+  """
+  if imageData1 is None or imageData2 is None:
+    return imageData1 == imageData2
+
+  fingerprint1 = getImageDataFingerprint(imageData1)
+  fingerprint2 = getImageDataFingerprint(imageData2)
+  dimensions1, scalarType1, numberOfComponents1, digest1 = fingerprint1
+  dimensions2, scalarType2, numberOfComponents2, digest2 = fingerprint2
+
+  if dimensions1 != dimensions2 or numberOfComponents1 != numberOfComponents2:
+    return False
+  if scalarType1 == scalarType2 and digest1 != digest2:
+    return False
+  if scalarType1 == scalarType2 and not verifyMatchingFingerprints:
+    return True
+  return np.array_equal(getImageDataScalarsArray(imageData1), getImageDataScalarsArray(imageData2))
 
 def ensureExplicitCellArraysStorage(polyData):
   # VTK >= 9.6 may store cell arrays with implicit ("fixed-size") offsets, and
@@ -1081,6 +1837,111 @@ def _getReusableSegmentEditorWidget():
     _reusableSegmentEditorWidget = widget
   return _reusableSegmentEditorWidget
 
+def getPolyDataFingerprint(polyData):
+  """
+  128 bit digest of the points and polygons of polyData
+  """
+  from vtk.util.numpy_support import vtk_to_numpy
+  digest = hashlib.blake2b(digest_size=16)
+  if polyData.GetPoints() is not None:
+    digest.update(np.ascontiguousarray(vtk_to_numpy(polyData.GetPoints().GetData())))
+  digest.update(b"|")
+  polys = polyData.GetPolys()
+  if polys is not None and polys.GetNumberOfCells() > 0:
+    digest.update(np.ascontiguousarray(vtk_to_numpy(polys.GetOffsetsArray())))
+    digest.update(np.ascontiguousarray(vtk_to_numpy(polys.GetConnectivityArray())))
+  return digest.hexdigest()
+
+def getLatticeExtentFromBounds(bounds, spacing, padding=0.):
+  """
+  Extent of the voxels of the grid of the given spacing with a voxel at the RAS origin
+  that cover bounds enlarged by padding on every side
+  """
+  extent = []
+  for i in range(3):
+    extent.append(int(np.floor((bounds[2*i] - padding)/spacing)))
+    extent.append(int(np.ceil((bounds[2*i + 1] + padding)/spacing)))
+  return extent
+
+def getNumberOfVoxelsOfExtent(extent):
+  return int(np.prod([max(0, extent[2*i + 1] - extent[2*i] + 1) for i in range(3)], dtype=np.int64))
+
+def isExtentInsideExtent(innerExtent, outerExtent):
+  return all(
+    outerExtent[2*i] <= innerExtent[2*i] and innerExtent[2*i + 1] <= outerExtent[2*i + 1] for i in range(3)
+  )
+
+def rasterizeSurfaceOnLattice(surfacePolyData, spacing, extent):
+  """
+  Binary (1 inside) unsigned char vtkImageData of the closed surface over extent of the grid
+  of the given spacing with a voxel at the RAS origin
+  """
+  whiteImage = vtk.vtkImageData()
+  whiteImage.SetExtent(extent)
+  whiteImage.SetSpacing(spacing, spacing, spacing)
+  whiteImage.SetOrigin(0, 0, 0)
+  whiteImage.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+  whiteImage.GetPointData().GetScalars().Fill(1)
+
+  pol2stenc = vtk.vtkPolyDataToImageStencil()
+  pol2stenc.SetInputData(surfacePolyData)
+  pol2stenc.SetOutputOrigin(0, 0, 0)
+  pol2stenc.SetOutputSpacing(spacing, spacing, spacing)
+  pol2stenc.SetOutputWholeExtent(extent)
+  pol2stenc.Update()
+
+  imgstenc = vtk.vtkImageStencil()
+  imgstenc.SetInputData(whiteImage)
+  imgstenc.SetStencilConnection(pol2stenc.GetOutputPort())
+  imgstenc.ReverseStencilOff()
+  imgstenc.SetBackgroundValue(0)
+  imgstenc.Update()
+
+  rasterizedSurface = vtk.vtkImageData()
+  rasterizedSurface.ShallowCopy(imgstenc.GetOutput())
+  return rasterizedSurface
+
+# the kept rasterization is counted in the voxel budget of createHollowWithMargin
+RASTERIZED_SURFACES_CACHE_SIZE = 1
+_rasterizedSurfacesCache = collections.OrderedDict()
+
+def getRasterizedSurface(surfacePolyData, spacing, extent, padding, maximumNumberOfVoxels):
+  """
+  Copy of the binary rasterization of the closed surface over extent of the grid of the given
+  spacing with a voxel at the RAS origin (see rasterizeSurfaceOnLattice).
+  The whole surface, enlarged by padding, is rasterized once per surface geometry and spacing if it
+  fits in maximumNumberOfVoxels and kept, later calls only crop it to their extent. Otherwise only
+  extent is rasterized, and kept for calls with the same or a smaller extent.
+  """
+  cacheKey = (getPolyDataFingerprint(surfacePolyData), round(spacing, 9))
+  rasterizedSurface = _rasterizedSurfacesCache.get(cacheKey)
+  if rasterizedSurface is not None and isExtentInsideExtent(extent, rasterizedSurface.GetExtent()):
+    _rasterizedSurfacesCache.move_to_end(cacheKey)
+  else:
+    # release the superseded rasterizations first so they are never held together with the new one
+    rasterizedSurface = None
+    _rasterizedSurfacesCache.pop(cacheKey, None)
+    while len(_rasterizedSurfacesCache) >= RASTERIZED_SURFACES_CACHE_SIZE:
+      _rasterizedSurfacesCache.popitem(last=False)
+    surfaceExtent = getLatticeExtentFromBounds(surfacePolyData.GetBounds(), spacing, padding)
+    wholeExtent = [
+      (min if i % 2 == 0 else max)(surfaceExtent[i], extent[i]) for i in range(6)
+    ]
+    if getNumberOfVoxelsOfExtent(wholeExtent) > maximumNumberOfVoxels:
+      wholeExtent = list(extent)
+    rasterizedSurface = rasterizeSurfaceOnLattice(surfacePolyData, spacing, wholeExtent)
+    _rasterizedSurfacesCache[cacheKey] = rasterizedSurface
+
+  # a copy, so editing the returned image can not alter the cached one
+  extractVOI = vtk.vtkExtractVOI()
+  extractVOI.SetInputData(rasterizedSurface)
+  extractVOI.SetVOI(extent)
+  extractVOI.Update()
+  croppedRasterizedSurface = vtk.vtkImageData()
+  croppedRasterizedSurface.DeepCopy(extractVOI.GetOutput())
+  return croppedRasterizedSurface
+
+@timedStage(monitorMemory=True)
 def createHollowWithMargin(
     segmentationNode,
     fibulaSegmentName,
@@ -1153,6 +2014,12 @@ def createHollowWithMargin(
   # (plus a pad), and a hard voxel budget caps the total size; if honoring the
   # margin would exceed the budget we coarsen the spacing and warn instead.
   MAX_LABELMAP_VOXELS = 200_000_000   # ~200 MB uint8 budget; tune as needed
+  # the uint8 grid and its stencil plus the float distance maps of the Margin
+  # and Hollow effects, and the uint8 rasterization of the whole fibula kept by
+  # getRasterizedSurface; the voxel budget shrinks to what the memory budget allows
+  BYTES_PER_VOXEL = 13
+  maximumNumberOfVoxels = getAffordableNumberOfItems(
+      BYTES_PER_VOXEL, MAX_LABELMAP_VOXELS, minimumNumberOfItems=1_000_000)
 
   fibulaLabelmap = slicer.vtkOrientedImageData()
   slicer.vtkSlicerSegmentationsModuleLogic.GetSegmentBinaryLabelmapRepresentation(
@@ -1179,70 +2046,54 @@ def createHollowWithMargin(
   boundsPoly.GetBounds(bounds)
 
   pad = marginSizeMm + vesselThicknessMm + 2.0 * marginSizeMm
-  extentMm = [(bounds[2 * i + 1] - bounds[2 * i]) + 2.0 * pad for i in range(3)]
+  # the spacing is chosen for the whole fibula, not for the clipped region, so
+  # it does not change when the bounding planes move and the kept rasterization
+  # of the fibula is reused
+  fibulaBounds = [0.0] * 6
+  fibulaPoly.GetBounds(fibulaBounds)
+  extentMm = [(fibulaBounds[2 * i + 1] - fibulaBounds[2 * i]) + 2.0 * pad for i in range(3)]
 
   # finest isotropic spacing we can afford within the voxel budget,
   # but no finer than needed to resolve the smallest feature the effects must
   # render (margin and/or shell thickness both snap to voxels)
   affordableSpacing = (
-      extentMm[0] * extentMm[1] * extentMm[2] / MAX_LABELMAP_VOXELS
+      extentMm[0] * extentMm[1] * extentMm[2] / maximumNumberOfVoxels
   ) ** (1.0 / 3.0)
   features = [f for f in (marginSizeMm, vesselThicknessMm) if f > 0]
   desiredSpacing = (min(features) / 2.0) if features else originalSpacing
   # never coarsen below the native spacing (no benefit, only lost detail)
   desiredSpacing = min(desiredSpacing, originalSpacing)
   fineSpacing = max(desiredSpacing, affordableSpacing)
+  # the grid voxels that cover the rounded fibula extent must fit too, otherwise
+  # only the clipped region would be rasterized and kept
+  while getNumberOfVoxelsOfExtent(
+      getLatticeExtentFromBounds(fibulaBounds, fineSpacing, pad)) > maximumNumberOfVoxels:
+    fineSpacing *= 1.01
 
   if marginSizeMm > 0 and fineSpacing > marginSizeMm:
     logging.warning(
         f"createHollowWithMargin: margin {marginSizeMm}mm cannot be represented "
-        f"within the {MAX_LABELMAP_VOXELS} voxel budget for this geometry; "
+        f"within the {maximumNumberOfVoxels} voxel budget for this geometry; "
         f"using {fineSpacing:.3f}mm spacing (margin will be coarse).")
 
-  dims = [max(1, int(np.ceil(extentMm[i] / fineSpacing))) for i in range(3)]
-
-  # axis-aligned (identity-direction) fine geometry in RAS, as an
-  # image-to-world matrix (spacing on the diagonal, grid origin in translation)
-  imageToWorld = vtk.vtkMatrix4x4()
-  imageToWorld.SetElement(0, 0, fineSpacing)
-  imageToWorld.SetElement(1, 1, fineSpacing)
-  imageToWorld.SetElement(2, 2, fineSpacing)
-  imageToWorld.SetElement(0, 3, bounds[0] - pad)
-  imageToWorld.SetElement(1, 3, bounds[2] - pad)
-  imageToWorld.SetElement(2, 3, bounds[4] - pad)
-
   # Rasterize the SMOOTH fibula closed surface directly onto the fine grid,
   # instead of nearest-neighbor upsampling the coarse binary labelmap. NN
   # upsampling cannot add detail: it bakes the original ~1mm voxel steps into
   # the fine grid as sharp flat faces, so the margined surface comes out
   # visibly staircased. Rasterizing the surface yields steps at the fine
   # spacing (sub-visible) and matches the fibula surface used elsewhere.
-  # the fine grid has identity directions (axis-aligned in RAS), so the
-  # surface can be voxelized with a plain image stencil in RAS coordinates.
-  origin = (bounds[0] - pad, bounds[2] - pad, bounds[4] - pad)
-  whiteImage = vtk.vtkImageData()
-  whiteImage.SetExtent(0, dims[0] - 1, 0, dims[1] - 1, 0, dims[2] - 1)
-  whiteImage.SetSpacing(fineSpacing, fineSpacing, fineSpacing)
-  whiteImage.SetOrigin(*origin)
-  whiteImage.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
-  whiteImage.GetPointData().GetScalars().Fill(1)
-
-  pol2stenc = vtk.vtkPolyDataToImageStencil()
-  pol2stenc.SetInputData(fibulaPoly)
-  pol2stenc.SetOutputOrigin(origin)
-  pol2stenc.SetOutputSpacing(fineSpacing, fineSpacing, fineSpacing)
-  pol2stenc.SetOutputWholeExtent(whiteImage.GetExtent())
-  pol2stenc.Update()
-
-  imgstenc = vtk.vtkImageStencil()
-  imgstenc.SetInputData(whiteImage)
-  imgstenc.SetStencilConnection(pol2stenc.GetOutputPort())
-  imgstenc.ReverseStencilOff()
-  imgstenc.SetBackgroundValue(0)
-  imgstenc.Update()
-
+  # The fine grid is axis-aligned in RAS with a voxel at the origin, so the
+  # whole fibula is rasterized once per spacing and later guide base
+  # regenerations (e.g. new miter boxes or angle) only crop it to the region
+  # between the bounding planes.
+  fineExtent = getLatticeExtentFromBounds(bounds, fineSpacing, pad)
   resampledFibula = slicer.vtkOrientedImageData()
-  resampledFibula.DeepCopy(imgstenc.GetOutput())
+  resampledFibula.ShallowCopy(getRasterizedSurface(fibulaPoly, fineSpacing, fineExtent, pad, maximumNumberOfVoxels))
+  # image-to-world matrix: spacing on the diagonal, the grid voxel (0,0,0) is at the RAS origin
+  imageToWorld = vtk.vtkMatrix4x4()
+  imageToWorld.SetElement(0, 0, fineSpacing)
+  imageToWorld.SetElement(1, 1, fineSpacing)
+  imageToWorld.SetElement(2, 2, fineSpacing)
   resampledFibula.SetGeometryFromImageToWorldMatrix(imageToWorld)
 
   # --- Run the Margin/Hollow effects on a temporary segmentation node whose
@@ -1334,46 +2185,7 @@ def createHollowWithMargin(
 
   return hollowSegmentID
 
-def createAdaptedBox(X, Y, Z, name, boxX, boxZ, referenceZ, highResolution = True):
-  import math
-
-  alpha = math.acos(boxZ @ referenceZ.T)
-  delta = Z*math.tan(alpha)
-
-  comparisonVector = np.cross(boxZ, referenceZ)
-  comparisonVector = comparisonVector/np.linalg.norm(comparisonVector)
-
-  points = []
-  if (comparisonVector @ boxX.T) > 0:
-    points.append(np.array([X/2, Y/2 - delta, Z/2,], dtype=float))
-    points.append(np.array([X/2, Y/2, -Z/2,], dtype=float))
-    points.append(np.array([X/2, -Y/2, -Z/2,], dtype=float))
-    points.append(np.array([X/2, -Y/2 - delta, Z/2,], dtype=float))
-    
-    points.append(np.array([-X/2, Y/2 - delta, Z/2,], dtype=float))
-    points.append(np.array([-X/2, -Y/2 - delta, Z/2,], dtype=float))
-    points.append(np.array([-X/2, -Y/2, -Z/2,], dtype=float))
-    points.append(np.array([-X/2, Y/2, -Z/2,], dtype=float))
-  
-  else:
-    points.append(np.array([X/2, Y/2, Z/2,], dtype=float))
-    points.append(np.array([X/2, Y/2 - delta, -Z/2,], dtype=float))
-    points.append(np.array([X/2, -Y/2 - delta, -Z/2,], dtype=float))
-    points.append(np.array([X/2, -Y/2, Z/2,], dtype=float))
-
-    points.append(np.array([-X/2, Y/2, Z/2,], dtype=float))
-    points.append(np.array([-X/2, -Y/2, Z/2,], dtype=float))
-    points.append(np.array([-X/2, -Y/2 - delta, -Z/2,], dtype=float))
-    points.append(np.array([-X/2, Y/2 - delta, -Z/2,], dtype=float))
-
-
-  points_vtk = vtk.vtkPoints()
-  pointID = 0
-
-  for i in range(len(points)):
-    points_vtk.InsertNextPoint(points[i])
-    pointID += 1
-
+def createAdaptedBoxMesh(points_vtk, highResolution = True):
   cellArray = vtk.vtkCellArray()
 
   facesPointsIDs = []
@@ -1422,17 +2234,60 @@ def createAdaptedBox(X, Y, Z, name, boxX, boxZ, referenceZ, highResolution = Tru
   adaptiveSubdivisionFilter.SetMaximumEdgeLength(maximumEdgeLengthMm)
   adaptiveSubdivisionFilter.SetMaximumTriangleArea(adaptiveSubdivisionFilter.GetMaximumTriangleAreaMaxValue()) # set to infinity
 
+  if not highResolution:
+    return normalsFilter.GetOutput()
+  adaptiveSubdivisionFilter.Update()
+  return adaptiveSubdivisionFilter.GetOutput()
+
+def createAdaptedBox(X, Y, Z, name, boxX, boxZ, referenceZ, highResolution = True):
+  import math
+
+  alpha = math.acos(boxZ @ referenceZ.T)
+  delta = Z*math.tan(alpha)
+
+  comparisonVector = np.cross(boxZ, referenceZ)
+  comparisonVector = comparisonVector/np.linalg.norm(comparisonVector)
+
+  points = []
+  if (comparisonVector @ boxX.T) > 0:
+    points.append(np.array([X/2, Y/2 - delta, Z/2,], dtype=float))
+    points.append(np.array([X/2, Y/2, -Z/2,], dtype=float))
+    points.append(np.array([X/2, -Y/2, -Z/2,], dtype=float))
+    points.append(np.array([X/2, -Y/2 - delta, Z/2,], dtype=float))
+    
+    points.append(np.array([-X/2, Y/2 - delta, Z/2,], dtype=float))
+    points.append(np.array([-X/2, -Y/2 - delta, Z/2,], dtype=float))
+    points.append(np.array([-X/2, -Y/2, -Z/2,], dtype=float))
+    points.append(np.array([-X/2, Y/2, -Z/2,], dtype=float))
+  
+  else:
+    points.append(np.array([X/2, Y/2, Z/2,], dtype=float))
+    points.append(np.array([X/2, Y/2 - delta, -Z/2,], dtype=float))
+    points.append(np.array([X/2, -Y/2 - delta, -Z/2,], dtype=float))
+    points.append(np.array([X/2, -Y/2, Z/2,], dtype=float))
+
+    points.append(np.array([-X/2, Y/2, Z/2,], dtype=float))
+    points.append(np.array([-X/2, -Y/2, Z/2,], dtype=float))
+    points.append(np.array([-X/2, -Y/2 - delta, -Z/2,], dtype=float))
+    points.append(np.array([-X/2, Y/2 - delta, -Z/2,], dtype=float))
+
+
+  points_vtk = vtk.vtkPoints()
+  pointID = 0
+
+  for i in range(len(points)):
+    points_vtk.InsertNextPoint(points[i])
+    pointID += 1
 
   adaptedBoxModel = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
   slicer.mrmlScene.AddNode(adaptedBoxModel)
   adaptedBoxModel.SetName(slicer.mrmlScene.GetUniqueNameByString(name))
   adaptedBoxModel.CreateDefaultDisplayNodes()
 
-  if highResolution:
-    adaptedBoxModel.SetPolyDataConnection(adaptiveSubdivisionFilter.GetOutputPort())
-  else:
-    adaptedBoxModel.SetPolyDataConnection(normalsFilter.GetOutput())
-  
+  adaptedBoxModel.SetAndObservePolyData(getTemplateMeshInstance(
+    ("adaptedBox",) + getTemplateDimensionsKey(*np.ravel(points)) + (bool(highResolution),),
+    lambda: createAdaptedBoxMesh(points_vtk, highResolution)
+  ))
 
   boxLowerFacePointIds = [6,5,3,2]
   rect_points_vtk = vtk.vtkPoints()
@@ -1528,38 +2383,89 @@ def has_collision(rect_polydata_original, rect_matrix, surface_polydata, obb_tre
 
   return False
 
-def countComponentsInPolyData(polydata):
-  connectivityFilter = vtk.vtkConnectivityFilter()
-  connectivityFilter.SetInputDataObject(0, polydata)
-  connectivityFilter.Update()
-  return connectivityFilter.GetNumberOfExtractedRegions()
+def getLabeledRegionsNumberOfCells(labeledPolyData, numberOfRegions):
+  from vtk.util.numpy_support import vtk_to_numpy
+  if labeledPolyData.GetNumberOfCells() == 0:
+    return np.zeros(numberOfRegions, dtype=int)
+  cellsRegionIds = vtk_to_numpy(labeledPolyData.GetCellData().GetArray("RegionId")).astype(int)
+  return np.bincount(cellsRegionIds, minlength=numberOfRegions)
 
-def extractEachRegionAsAModel(polydata, baseName):
-  connectivityFilter = vtk.vtkConnectivityFilter()
-  connectivityFilter.SetInputDataObject(0, polydata)
-  connectivityFilter.SetExtractionModeToAllRegions()
-  connectivityFilter.ColorRegionsOn()
-  connectivityFilter.Update()
-  numberOfRegions = connectivityFilter.GetNumberOfExtractedRegions()
+def splitLabeledRegions(labeledPolyData, numberOfRegions, minimumNumberOfCells=0):
+  """
+  Split the regions labeled by labelConnectedRegions into separate polydata.
+  Regions with less than minimumNumberOfCells cells are dropped before building any mesh.
+  Returns a list of (regionId, regionPolyData).
+  Polygonal meshes are partitioned in a single sweep over their cells: the cells are sorted by region
+  and the points each region uses are gathered with numpy. Other kinds of cells (vertices, lines,
+  strips) are extracted region by region.
+  """
+  from vtk.util import numpy_support
+  regionsNumberOfCells = getLabeledRegionsNumberOfCells(labeledPolyData, numberOfRegions)
+  keptRegionIds = np.nonzero(regionsNumberOfCells >= max(1, minimumNumberOfCells))[0]
+
+  numberOfPolys = labeledPolyData.GetNumberOfPolys()
+  if numberOfPolys != labeledPolyData.GetNumberOfCells():
+    return [(regionId, extractLabeledRegion(labeledPolyData, regionId)) for regionId in keptRegionIds]
+
+  points = numpy_support.vtk_to_numpy(labeledPolyData.GetPoints().GetData())
+  pointData = labeledPolyData.GetPointData()
+  pointArrays = [
+    pointData.GetArray(i) for i in range(pointData.GetNumberOfArrays())
+    if pointData.GetArray(i) is not None and pointData.GetArray(i).GetName() != "RegionId"
+  ]
+  polys = labeledPolyData.GetPolys()
+  offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray()).astype(np.int64)
+  connectivity = numpy_support.vtk_to_numpy(polys.GetConnectivityArray()).astype(np.int64)
+  cellsRegionIds = numpy_support.vtk_to_numpy(labeledPolyData.GetCellData().GetArray("RegionId")).astype(int)
+
+  cellsOrder = np.argsort(cellsRegionIds, kind="stable")
+  regionsCellsStart = np.concatenate([[0], np.cumsum(regionsNumberOfCells)])
+
+  regionsPolyData = []
+  for regionId in keptRegionIds:
+    regionCells = cellsOrder[regionsCellsStart[regionId]:regionsCellsStart[regionId + 1]]
+    cellsSizes = offsets[regionCells + 1] - offsets[regionCells]
+    regionOffsets = np.concatenate([[0], np.cumsum(cellsSizes)])
+    connectivityIndices = np.repeat(offsets[regionCells] - regionOffsets[:-1], cellsSizes) + np.arange(regionOffsets[-1])
+    regionPointIds, regionConnectivity = np.unique(connectivity[connectivityIndices], return_inverse=True)
+
+    regionPoints = vtk.vtkPoints()
+    regionPoints.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(points[regionPointIds]), deep=1))
+    regionPolys = vtk.vtkCellArray()
+    regionPolys.SetData(numpyToVtkIdTypeArray(regionOffsets), numpyToVtkIdTypeArray(regionConnectivity))
+    regionPolyData = vtk.vtkPolyData()
+    regionPolyData.SetPoints(regionPoints)
+    regionPolyData.SetPolys(regionPolys)
+    for pointArray in pointArrays:
+      regionArray = numpy_support.numpy_to_vtk(
+        np.ascontiguousarray(numpy_support.vtk_to_numpy(pointArray)[regionPointIds]), deep=1
+      )
+      regionArray.SetName(pointArray.GetName())
+      regionPolyData.GetPointData().AddArray(regionArray)
+    if pointData.GetNormals() is not None:
+      regionPolyData.GetPointData().SetActiveNormals(pointData.GetNormals().GetName())
+    regionsPolyData.append((regionId, regionPolyData))
 
-  regionModels = []
-  for i in range(numberOfRegions):
-    threshold = vtk.vtkThreshold()
-    threshold.SetInputConnection(connectivityFilter.GetOutputPort())
-    threshold.SetLowerThreshold(i-0.1)
-    threshold.SetUpperThreshold(i+0.1)
-    
-    threshold.Update()
+  return regionsPolyData
 
-    geometryFilter = vtk.vtkGeometryFilter()
-    geometryFilter.SetInputConnection(threshold.GetOutputPort())
-    geometryFilter.Update()
+def countComponentsInPolyData(polydata, minimumNumberOfCells=0):
+  """
+  Number of connected regions of polydata, not counting the ones with less than minimumNumberOfCells cells
+  """
+  labeledPolyData, _, numberOfRegions = labelConnectedRegions(polydata)
+  if minimumNumberOfCells <= 0:
+    return numberOfRegions
+  regionsNumberOfCells = getLabeledRegionsNumberOfCells(labeledPolyData, numberOfRegions)
+  return int(np.count_nonzero(regionsNumberOfCells >= minimumNumberOfCells))
 
-    regionPolyData = geometryFilter.GetOutput()
+def extractEachRegionAsAModel(polydata, baseName, minimumNumberOfCells=0):
+  labeledPolyData, _, numberOfRegions = labelConnectedRegions(polydata)
 
+  regionModels = []
+  for regionId, regionPolyData in splitLabeledRegions(labeledPolyData, numberOfRegions, minimumNumberOfCells):
     regionModel = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
     slicer.mrmlScene.AddNode(regionModel)
-    regionModel.SetName(slicer.mrmlScene.GetUniqueNameByString(f"{baseName}_region_{i}"))
+    regionModel.SetName(slicer.mrmlScene.GetUniqueNameByString(f"{baseName}_region_{regionId}"))
     regionModel.CreateDefaultDisplayNodes()
     regionModel.SetAndObservePolyData(regionPolyData)
 
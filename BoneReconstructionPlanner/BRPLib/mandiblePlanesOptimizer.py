@@ -0,0 +1,239 @@
+import numpy as np
+
+# All functions of this file work on numpy arrays only (no MRML nodes) so
+# hundreds of candidate plane placements can be evaluated in a single batch.
+
+MAX_NUMBER_OF_BONE_POINTS = 2000
+MAX_ELEMENTS_PER_BATCH = 4_000_000
+INFEASIBLE_PLACEMENT_PENALTY = 1000.
+
+def getCumulativeArcLengths(curvePoints):
+  segmentsLengths = np.linalg.norm(np.diff(curvePoints, axis=0), axis=1)
+  return np.concatenate([[0.], np.cumsum(segmentsLengths)])
+
+def getCurvePointsAtArcLengths(curvePoints, cumulativeArcLengths, arcLengths):
+  """
+  Interpolate curve positions at arcLengths, arcLengths can have any shape (..., ) and
+  the result has shape (..., 3)
+  """
+  arcLengths = np.clip(arcLengths, cumulativeArcLengths[0], cumulativeArcLengths[-1])
+  return np.stack(
+    [np.interp(arcLengths, cumulativeArcLengths, curvePoints[:, k]) for k in range(3)],
+    axis=-1
+  )
+
+def getArcLengthOfClosestCurvePoint(curvePoints, cumulativeArcLengths, position):
+  closestIndex = np.argmin(np.linalg.norm(curvePoints - position, axis=1))
+  return cumulativeArcLengths[closestIndex]
+
+def getDistancesToPolylines(points, segmentsStarts, segmentsEnds):
+  """
+  Distance of every point to the closest segment of every candidate polyline.
+  points (M,3), segmentsStarts and segmentsEnds (C,S,3). Returns (C,M)
+  """
+  numberOfCandidates, numberOfSegments = segmentsStarts.shape[:2]
+  numberOfPoints = len(points)
+  batchSize = max(1, MAX_ELEMENTS_PER_BATCH // max(1, numberOfSegments*numberOfPoints))
+
+  distances = np.empty((numberOfCandidates, numberOfPoints))
+  for batchStart in range(0, numberOfCandidates, batchSize):
+    A = segmentsStarts[batchStart:batchStart+batchSize, :, None, :]
+    AB = segmentsEnds[batchStart:batchStart+batchSize, :, None, :] - A
+    AP = points[None, None, :, :] - A
+    squaredLengths = np.maximum(np.sum(AB*AB, axis=-1), 1e-12)
+    t = np.clip(np.sum(AP*AB, axis=-1)/squaredLengths, 0., 1.)
+    closestPoints = A + t[..., None]*AB
+    segmentDistances = np.linalg.norm(points[None, None, :, :] - closestPoints, axis=-1)
+    distances[batchStart:batchStart+batchSize] = segmentDistances.min(axis=1)
+  return distances
+
+def getPlacementsGeometry(curvePoints, cumulativeArcLengths, knotsArcLengths):
+  """
+  knotsArcLengths (C,K) are sorted arc lengths of the planes over the curve.
+  Returns origins (C,K,3), segments directions (C,K-1,3), segments lengths (C,K-1)
+  and angles between consecutive segments (C,K-2)
+  """
+  origins = getCurvePointsAtArcLengths(curvePoints, cumulativeArcLengths, knotsArcLengths)
+  segmentsVectors = np.diff(origins, axis=1)
+  segmentsLengths = np.linalg.norm(segmentsVectors, axis=-1)
+  segmentsDirections = segmentsVectors/np.maximum(segmentsLengths, 1e-9)[..., None]
+  cosines = np.clip(np.sum(segmentsDirections[:, :-1]*segmentsDirections[:, 1:], axis=-1), -1., 1.)
+  jointsAngles = np.arccos(cosines)
+  return origins, segmentsDirections, segmentsLengths, jointsAngles
+
+def evaluatePlanesPlacements(
+  curvePoints, cumulativeArcLengths, knotsArcLengths, bonePoints,
+  fibulaRadius, minimumSegmentLength, availableFibulaLength, initialSpace, betweenSpace,
+  deviationWeight=0.5
+):
+  """
+  Score candidate placements of the mandible planes, higher is better.
+  The bone contact term is the fraction of the resected mandible points that lie inside
+  the fibula cylinders placed over the segments, the deviation term penalizes segments
+  that depart from the mandibular curve. Placements with a segment shorter than
+  minimumSegmentLength or that need more fibula than availableFibulaLength are penalized
+  by INFEASIBLE_PLACEMENT_PENALTY times the violation (in mm).
+  """
+  origins, segmentsDirections, segmentsLengths, jointsAngles = getPlacementsGeometry(
+    curvePoints, cumulativeArcLengths, knotsArcLengths
+  )
+  segmentsStarts = origins[:, :-1]
+  segmentsEnds = origins[:, 1:]
+
+  if len(bonePoints) > 0:
+    boneDistances = getDistancesToPolylines(bonePoints, segmentsStarts, segmentsEnds)
+    boneContact = np.mean(boneDistances <= fibulaRadius, axis=1)
+  else:
+    boneContact = np.zeros(len(knotsArcLengths))
+
+  # only the curve samples between the first and the last plane are relevant
+  insideResection = (
+    (cumulativeArcLengths >= knotsArcLengths[0, 0]) &
+    (cumulativeArcLengths <= knotsArcLengths[0, -1])
+  )
+  curveDistances = getDistancesToPolylines(curvePoints[insideResection], segmentsStarts, segmentsEnds)
+  if curveDistances.shape[1] > 0:
+    curveDeviation = curveDistances.mean(axis=1)/max(fibulaRadius, 1e-3)
+  else:
+    curveDeviation = np.zeros(len(knotsArcLengths))
+
+  # the pieces are laid one after the other over the fibula line, each wedge-shaped osteotomy
+  # needs approximately 2*r*tan(angle/2) of extra fibula length
+  wedgesLengths = 2*fibulaRadius*np.tan(np.minimum(jointsAngles, np.radians(80))/2)
+  neededFibulaLength = (
+    initialSpace + segmentsLengths.sum(axis=1) +
+    wedgesLengths.sum(axis=1) + betweenSpace*jointsAngles.shape[1]
+  )
+  shortSegmentsViolation = np.maximum(minimumSegmentLength - segmentsLengths, 0.).sum(axis=1)
+  fibulaLengthViolation = np.maximum(neededFibulaLength - availableFibulaLength, 0.)
+  violation = shortSegmentsViolation + fibulaLengthViolation
+
+  scores = boneContact - deviationWeight*curveDeviation - INFEASIBLE_PLACEMENT_PENALTY*violation
+
+  metrics = {
+    "boneContact": boneContact,
+    "curveDeviation": curveDeviation,
+    "segmentsLengths": segmentsLengths,
+    "neededFibulaLength": neededFibulaLength,
+    "feasible": violation == 0.,
+  }
+  return scores, metrics
+
+def sampleKnotsArcLengths(randomGenerator, startArcLength, endArcLength, numberOfSegments, numberOfCandidates):
+  """
+  Random sorted plane positions between the fixed first and last planes
+  """
+  fractions = randomGenerator.dirichlet(np.full(numberOfSegments, 4.), size=numberOfCandidates)
+  innerKnots = startArcLength + (endArcLength - startArcLength)*np.cumsum(fractions, axis=1)[:, :-1]
+  return np.concatenate([
+    np.full((numberOfCandidates, 1), startArcLength),
+    innerKnots,
+    np.full((numberOfCandidates, 1), endArcLength)
+  ], axis=1)
+
+def optimizeMandiblePlanesArcLengths(
+  curvePoints, startArcLength, endArcLength, numberOfSegments, bonePoints,
+  fibulaRadius, minimumSegmentLength, availableFibulaLength, initialSpace, betweenSpace,
+  initialKnotsArcLengths=None, numberOfCandidates=256, numberOfIterations=8, eliteSize=16, seed=0
+):
+  """
+  Search the positions of the planes over the mandibular curve (as arc lengths) that maximize
+  the placement score while the first and last planes stay at startArcLength and endArcLength.
+  Returns the best knots arc lengths (K,) and its metrics.
+  """
+  randomGenerator = np.random.default_rng(seed)
+  cumulativeArcLengths = getCumulativeArcLengths(curvePoints)
+
+  if len(bonePoints) > MAX_NUMBER_OF_BONE_POINTS:
+    bonePoints = bonePoints[randomGenerator.choice(len(bonePoints), MAX_NUMBER_OF_BONE_POINTS, replace=False)]
+
+  def evaluate(knotsArcLengths):
+    return evaluatePlanesPlacements(
+      curvePoints, cumulativeArcLengths, knotsArcLengths, bonePoints,
+      fibulaRadius, minimumSegmentLength, availableFibulaLength, initialSpace, betweenSpace
+    )
+
+  candidates = sampleKnotsArcLengths(randomGenerator, startArcLength, endArcLength, numberOfSegments, 2*numberOfCandidates)
+  evenlySpaced = np.linspace(startArcLength, endArcLength, numberOfSegments+1)[None, :]
+  candidates = np.concatenate([evenlySpaced, candidates])
+  if initialKnotsArcLengths is not None and len(initialKnotsArcLengths) == numberOfSegments+1:
+    candidates = np.concatenate([np.sort(np.asarray(initialKnotsArcLengths))[None, :], candidates])
+
+  scores, metrics = evaluate(candidates)
+  numberOfEvaluatedCandidates = len(candidates)
+  sigma = 0.1*(endArcLength - startArcLength)
+  for iteration in range(numberOfIterations):
+    eliteIndices = np.argsort(scores)[::-1][:eliteSize]
+    elite = candidates[eliteIndices]
+    parents = elite[randomGenerator.integers(0, len(elite), numberOfCandidates)]
+    children = parents.copy()
+    children[:, 1:-1] += randomGenerator.normal(0., sigma, size=(numberOfCandidates, numberOfSegments-1))
+    children[:, 1:-1] = np.sort(np.clip(children[:, 1:-1], startArcLength, endArcLength), axis=1)
+
+    childrenScores, childrenMetrics = evaluate(children)
+    numberOfEvaluatedCandidates += len(children)
+    candidates = np.concatenate([elite, children])
+    scores = np.concatenate([scores[eliteIndices], childrenScores])
+    metrics = {
+      key: np.concatenate([metrics[key][eliteIndices], childrenMetrics[key]])
+      for key in metrics
+    }
+    sigma *= 0.6
+
+  bestIndex = int(np.argmax(scores))
+  bestMetrics = {key: metrics[key][bestIndex] for key in metrics}
+  bestMetrics["score"] = scores[bestIndex]
+  bestMetrics["numberOfEvaluatedCandidates"] = numberOfEvaluatedCandidates
+  return candidates[bestIndex], bestMetrics
+
+def getBisectorNormals(origins):
+  """
+  Normals of the inner planes that bisect the directions of the adjacent segments,
+  the same criteria used by mandiblePlanesPositioningForMaximumBoneContact
+  """
+  directions = np.diff(origins, axis=0)
+  directions = directions/np.linalg.norm(directions, axis=1)[:, None]
+  normals = directions[:-1] + directions[1:]
+  return normals/np.linalg.norm(normals, axis=1)[:, None]
+
+def getPointsAlongCurveSection(points, curvePoints, cumulativeArcLengths, startArcLength, endArcLength, maximumDistance):
+  """
+  Return the points whose closest curve point lies between startArcLength and endArcLength
+  and that are nearer than maximumDistance to the curve (e.g. the mandible bone to be resected)
+  """
+  batchSize = max(1, MAX_ELEMENTS_PER_BATCH // max(1, len(curvePoints)))
+  selectedPoints = []
+  for batchStart in range(0, len(points), batchSize):
+    batchPoints = points[batchStart:batchStart+batchSize]
+    distances = np.linalg.norm(batchPoints[:, None, :] - curvePoints[None, :, :], axis=-1)
+    closestIndices = np.argmin(distances, axis=1)
+    closestDistances = distances[np.arange(len(batchPoints)), closestIndices]
+    closestArcLengths = cumulativeArcLengths[closestIndices]
+    selected = (
+      (closestArcLengths >= startArcLength) &
+      (closestArcLengths <= endArcLength) &
+      (closestDistances <= maximumDistance)
+    )
+    selectedPoints.append(batchPoints[selected])
+  if len(selectedPoints) == 0:
+    return np.zeros((0, 3))
+  return np.concatenate(selectedPoints)
+
+def getFibulaRadiusAndAvailableLength(fibulaPoints, lineStartPosition, lineEndPosition, safeDistanceToFibulaTip):
+  """
+  Estimate the fibula radius as the median distance of the fibula points to the fibula line and
+  the length available for the pieces from the start of the line up to safeDistanceToFibulaTip
+  before the end of the bone in the direction of the line
+  """
+  lineDirection = lineEndPosition - lineStartPosition
+  lineLength = np.linalg.norm(lineDirection)
+  lineDirection = lineDirection/lineLength
+  relativePoints = fibulaPoints - lineStartPosition
+  projections = relativePoints @ lineDirection
+  radialDistances = np.linalg.norm(relativePoints - projections[:, None]*lineDirection, axis=1)
+  overTheLine = (projections >= 0) & (projections <= lineLength)
+  if not np.any(overTheLine):
+    return None, lineLength
+  fibulaRadius = np.median(radialDistances[overTheLine])
+  availableFibulaLength = projections.max() - safeDistanceToFibulaTip
+  return fibulaRadius, availableFibulaLength
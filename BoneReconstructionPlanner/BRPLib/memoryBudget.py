@@ -0,0 +1,179 @@
+import logging
+import os
+import sys
+import threading
+
+# Upper limit for the memory of this Slicer session, set it on shared planning servers
+MEMORY_BUDGET_ENVIRONMENT_VARIABLE = "BRP_MEMORY_BUDGET_MB"
+# Only this fraction of the memory available on the system (or container) is given to one operation
+MEMORY_BUDGET_FRACTION_OF_AVAILABLE_MEMORY = 0.6
+MEMORY_SAMPLING_INTERVAL_S = 0.02
+
+def readFirstInteger(filePath):
+  try:
+    with open(filePath) as file:
+      return int(file.read().split()[0])
+  except (OSError, ValueError, IndexError):
+    return None
+
+def getCurrentMemoryUsage():
+  """
+  Resident set size of this process in bytes, None if it cannot be read
+  """
+  try:
+    import psutil
+    return psutil.Process().memory_info().rss
+  except ImportError:
+    pass
+  try:
+    with open("/proc/self/statm") as statmFile:
+      return int(statmFile.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, AttributeError):
+    return None
+
+def getPeakMemoryUsage():
+  """
+  Highest resident set size reached by this process so far in bytes, None if it cannot be read
+  """
+  try:
+    with open("/proc/self/status") as statusFile:
+      for line in statusFile:
+        if line.startswith("VmHWM:"):
+          return int(line.split()[1])*1024
+  except (OSError, ValueError):
+    pass
+  try:
+    import resource
+    maximumResidentSetSize = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maximumResidentSetSize if sys.platform == "darwin" else maximumResidentSetSize*1024
+  except (ImportError, ValueError):
+    return None
+
+def getCgroupAvailableMemory():
+  """
+  Memory left before the container (cgroup v2 or v1) limit is hit, None if there is no limit
+  """
+  limit = readFirstInteger("/sys/fs/cgroup/memory.max")
+  usage = readFirstInteger("/sys/fs/cgroup/memory.current")
+  if limit is None:
+    limit = readFirstInteger("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+    usage = readFirstInteger("/sys/fs/cgroup/memory/memory.usage_in_bytes")
+  # cgroup v1 reports a huge number when there is no limit
+  if limit is None or usage is None or limit >= 2**60:
+    return None
+  return max(0, limit - usage)
+
+def getAvailableMemory():
+  """
+  Memory in bytes that can be allocated without swapping, None if it cannot be read
+  """
+  availableMemory = None
+  try:
+    import psutil
+    availableMemory = psutil.virtual_memory().available
+  except ImportError:
+    try:
+      with open("/proc/meminfo") as meminfoFile:
+        for line in meminfoFile:
+          if line.startswith("MemAvailable:"):
+            availableMemory = int(line.split()[1])*1024
+            break
+    except (OSError, ValueError):
+      pass
+
+  cgroupAvailableMemory = getCgroupAvailableMemory()
+  if cgroupAvailableMemory is not None:
+    availableMemory = cgroupAvailableMemory if availableMemory is None else min(availableMemory, cgroupAvailableMemory)
+  return availableMemory
+
+def getMemoryBudget():
+  """
+  Bytes a new operation may allocate, None if no limit is known.
+  It is the smallest of a fraction of the available memory and what is left of the
+  BRP_MEMORY_BUDGET_MB session limit.
+  """
+  budgets = []
+  availableMemory = getAvailableMemory()
+  if availableMemory is not None:
+    budgets.append(availableMemory*MEMORY_BUDGET_FRACTION_OF_AVAILABLE_MEMORY)
+
+  sessionLimitMb = os.environ.get(MEMORY_BUDGET_ENVIRONMENT_VARIABLE)
+  if sessionLimitMb:
+    try:
+      sessionLimit = float(sessionLimitMb)*1024*1024
+      budgets.append(max(0., sessionLimit - (getCurrentMemoryUsage() or 0)))
+    except ValueError:
+      logging.warning(f"Invalid {MEMORY_BUDGET_ENVIRONMENT_VARIABLE} value: {sessionLimitMb}")
+
+  return min(budgets) if budgets else None
+
+def fitsInMemoryBudget(estimatedBytes, operationName=None):
+  memoryBudget = getMemoryBudget()
+  if memoryBudget is None or estimatedBytes <= memoryBudget:
+    return True
+  if operationName is not None:
+    logging.warning(
+      f"{operationName} needs about {estimatedBytes/2**20:.0f} MB but the memory budget is {memoryBudget/2**20:.0f} MB"
+    )
+  return False
+
+def getAffordableNumberOfItems(bytesPerItem, maximumNumberOfItems, minimumNumberOfItems=1):
+  """
+  How many items of bytesPerItem fit in the memory budget, between minimumNumberOfItems and maximumNumberOfItems
+  """
+  memoryBudget = getMemoryBudget()
+  if memoryBudget is None:
+    return maximumNumberOfItems
+  return int(max(minimumNumberOfItems, min(maximumNumberOfItems, memoryBudget//max(1, bytesPerItem))))
+
+def getPolyDataMemorySize(polyData):
+  if polyData is None:
+    return 0
+  # vtkDataObject reports kibibytes
+  return polyData.GetActualMemorySize()*1024
+
+class PeakMemoryMonitor:
+  """
+  Peak resident memory of this process between start() and stop().
+  Memory usage is sampled from a thread. A long VTK call can hold the interpreter lock and hide
+  a short peak from the sampler, so the process high water mark is also read and used when it
+  grew in between.
+  """
+  def __init__(self, samplingInterval=MEMORY_SAMPLING_INTERVAL_S):
+    self.samplingInterval = samplingInterval
+    self.stopEvent = threading.Event()
+    self.samplingThread = None
+    self.startMemoryUsage = None
+    self.startPeakMemoryUsage = None
+    self.peakMemoryUsage = None
+
+  def start(self):
+    self.startMemoryUsage = getCurrentMemoryUsage()
+    self.startPeakMemoryUsage = getPeakMemoryUsage()
+    self.peakMemoryUsage = self.startMemoryUsage
+    self.stopEvent.clear()
+    self.samplingThread = threading.Thread(target=self.sampleMemoryUsage, name="BRPMemoryMonitor", daemon=True)
+    self.samplingThread.start()
+
+  def updatePeakMemoryUsage(self, memoryUsage):
+    if memoryUsage is not None and (self.peakMemoryUsage is None or memoryUsage > self.peakMemoryUsage):
+      self.peakMemoryUsage = memoryUsage
+
+  def sampleMemoryUsage(self):
+    while not self.stopEvent.wait(self.samplingInterval):
+      self.updatePeakMemoryUsage(getCurrentMemoryUsage())
+
+  def stop(self):
+    """
+    Returns the peak memory usage in bytes, None if memory usage cannot be read
+    """
+    self.stopEvent.set()
+    if self.samplingThread is not None:
+      self.samplingThread.join()
+      self.samplingThread = None
+    self.updatePeakMemoryUsage(getCurrentMemoryUsage())
+    peakMemoryUsage = getPeakMemoryUsage()
+    if peakMemoryUsage is not None and self.startPeakMemoryUsage is not None and peakMemoryUsage > self.startPeakMemoryUsage:
+      self.updatePeakMemoryUsage(peakMemoryUsage)
+    return self.peakMemoryUsage
@@ -0,0 +1,193 @@
+from __main__ import vtk, slicer, qt
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+
+EXPORT_FILE_FORMATS = ["stl", "ply", "obj"]
+EXPORT_MANIFEST_FILENAME = "manifest.json"
+EXPORT_COPY_CHUNK_SIZE_BYTES = 4*1024*1024
+
+def snapshotModelPolyData(modelNode):
+  """
+  Deep copy the polydata of a model node with its parent transforms hardened.
+  The copy is owned by the caller, so later edits of the scene do not affect it.
+  """
+  polyData = vtk.vtkPolyData()
+  if modelNode.GetPolyData() is None:
+    return polyData
+
+  transformToWorld = vtk.vtkGeneralTransform()
+  slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(modelNode.GetParentTransformNode(), None, transformToWorld)
+
+  transformFilter = vtk.vtkTransformPolyDataFilter()
+  transformFilter.SetTransform(transformToWorld)
+  transformFilter.SetInputData(modelNode.GetPolyData())
+  transformFilter.Update()
+
+  polyData.DeepCopy(transformFilter.GetOutput())
+  return polyData
+
+def createMeshWriter(fileFormat):
+  """
+  Return a VTK writer for the given file format. STL and PLY are written in
+  binary mode, OBJ has no binary variant.
+  """
+  if fileFormat == "stl":
+    writer = vtk.vtkSTLWriter()
+    writer.SetFileTypeToBinary()
+  elif fileFormat == "ply":
+    writer = vtk.vtkPLYWriter()
+    writer.SetFileTypeToBinary()
+  elif fileFormat == "obj":
+    writer = vtk.vtkOBJWriter()
+  else:
+    raise ValueError(f"Unsupported export file format: {fileFormat}")
+  return writer
+
+def getExportFileName(name, fileFormat):
+  safeName = re.sub(r'[^\w\-. ]', '_', name).strip() or "model"
+  return f"{safeName}.{fileFormat}"
+
+def writePolyDataToFile(polyData, filePath, fileFormat):
+  """
+  Write polyData to filePath and return (sha256, sizeInBytes) of the written file.
+  The mesh is written to a local temporary file first and then streamed to the
+  destination while hashing, so a slow destination (e.g. a network share) is
+  only traversed once and never left with a half written file.
+  """
+  localFileDescriptor, localFilePath = tempfile.mkstemp(suffix="." + fileFormat)
+  os.close(localFileDescriptor)
+  partialFilePath = filePath + ".part"
+  try:
+    writer = createMeshWriter(fileFormat)
+    writer.SetInputData(polyData)
+    writer.SetFileName(localFilePath)
+    if not writer.Write():
+      raise IOError(f"Could not write {localFilePath}")
+
+    sha256 = hashlib.sha256()
+    sizeInBytes = 0
+    with open(localFilePath, "rb") as sourceFile, open(partialFilePath, "wb") as destinationFile:
+      while True:
+        chunk = sourceFile.read(EXPORT_COPY_CHUNK_SIZE_BYTES)
+        if not chunk:
+          break
+        sha256.update(chunk)
+        destinationFile.write(chunk)
+        sizeInBytes += len(chunk)
+    os.replace(partialFilePath, filePath)
+  finally:
+    if os.path.exists(localFilePath):
+      os.remove(localFilePath)
+    if os.path.exists(partialFilePath):
+      os.remove(partialFilePath)
+
+  return sha256.hexdigest(), sizeInBytes
+
+class BackgroundMeshExporter:
+  """
+  Writes snapshots of model nodes to a folder from a worker thread.
+  Snapshots are taken on the main thread when the export is started, files are
+  written in the background one after another and, when all of them are done,
+  a manifest with checksums is saved next to them and onFinished(manifest) is
+  called on the main thread.
+  """
+  def __init__(self, pollIntervalMs=100):
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="BRPMeshExport")
+    self.pendingExports = []
+    self.pollTimer = qt.QTimer()
+    self.pollTimer.setInterval(pollIntervalMs)
+    self.pollTimer.connect('timeout()', self.onPollTimerTimeout)
+
+  def isBusy(self):
+    return len(self.pendingExports) > 0
+
+  def exportModels(self, modelNodes, folderPath, fileFormat="stl", onFinished=None):
+    fileFormat = fileFormat.lower()
+    if fileFormat not in EXPORT_FILE_FORMATS:
+      raise ValueError(f"Unsupported export file format: {fileFormat}")
+    os.makedirs(folderPath, exist_ok=True)
+
+    usedFileNames = set()
+    entries = []
+    for modelNode in modelNodes:
+      if modelNode is None:
+        continue
+      fileName = getExportFileName(modelNode.GetName(), fileFormat)
+      baseName = fileName[:-len(fileFormat)-1]
+      suffix = 1
+      while fileName in usedFileNames:
+        fileName = f"{baseName}_{suffix}.{fileFormat}"
+        suffix += 1
+      usedFileNames.add(fileName)
+
+      polyData = snapshotModelPolyData(modelNode)
+      entry = {
+        "name": modelNode.GetName(),
+        "file": fileName,
+        "format": fileFormat,
+        "numberOfPoints": polyData.GetNumberOfPoints(),
+        "numberOfCells": polyData.GetNumberOfCells(),
+      }
+      future = self.executor.submit(writePolyDataToFile, polyData, os.path.join(folderPath, fileName), fileFormat)
+      entries.append((entry, future))
+
+    self.pendingExports.append({
+      "folderPath": folderPath,
+      "entries": entries,
+      "onFinished": onFinished,
+    })
+    if not self.pollTimer.isActive():
+      self.pollTimer.start()
+
+  def onPollTimerTimeout(self):
+    finishedExports = [pendingExport for pendingExport in self.pendingExports
+      if all(future.done() for entry, future in pendingExport["entries"])]
+    for finishedExport in finishedExports:
+      self.pendingExports.remove(finishedExport)
+      manifest = self.finishExport(finishedExport)
+      if finishedExport["onFinished"] is not None:
+        try:
+          finishedExport["onFinished"](manifest)
+        except Exception:
+          logging.exception("Mesh export completion callback failed")
+    if not self.pendingExports:
+      self.pollTimer.stop()
+
+  def finishExport(self, finishedExport):
+    manifest = {
+      "createdBy": "BoneReconstructionPlanner",
+      "date": datetime.datetime.now().isoformat(timespec="seconds"),
+      "files": [],
+      "errors": [],
+    }
+    for entry, future in finishedExport["entries"]:
+      try:
+        sha256, sizeInBytes = future.result()
+        entry["sha256"] = sha256
+        entry["sizeInBytes"] = sizeInBytes
+        manifest["files"].append(entry)
+      except Exception as e:
+        logging.warning(f"Could not export {entry['name']}: {e}")
+        manifest["errors"].append({"name": entry["name"], "file": entry["file"], "error": str(e)})
+
+    manifestPath = os.path.join(finishedExport["folderPath"], EXPORT_MANIFEST_FILENAME)
+    try:
+      with open(manifestPath, "w") as manifestFile:
+        json.dump(manifest, manifestFile, indent=2)
+    except Exception as e:
+      logging.warning(f"Could not write export manifest {manifestPath}: {e}")
+    manifest["folderPath"] = finishedExport["folderPath"]
+    return manifest
+
+  def shutdown(self):
+    self.pollTimer.stop()
+    self.executor.shutdown(wait=True)
+    for pendingExport in self.pendingExports:
+      self.finishExport(pendingExport)
+    self.pendingExports = []
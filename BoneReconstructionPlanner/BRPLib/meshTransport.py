@@ -0,0 +1,179 @@
+from __main__ import vtk
+import os
+import shutil
+import subprocess
+import tempfile
+import xml.etree.ElementTree as ElementTree
+
+# tmpfs mount of Linux, files written there stay in memory and never reach the disk
+RAM_BACKED_TEMPORARY_DIRECTORY = "/dev/shm"
+# room needed in the RAM backed directory relative to the operands size (operands, output and some slack)
+MESH_TRANSPORT_FREE_SPACE_FACTOR = 4
+MESH_TRANSPORT_FILE_EXTENSIONS = [".vtp", ".vtk"]
+
+def getMeshTransportDirectory(requiredBytes):
+  """
+  RAM backed directory for the temporary mesh files if there is one with enough free space,
+  otherwise the default temporary directory
+  """
+  if os.path.isdir(RAM_BACKED_TEMPORARY_DIRECTORY) and os.access(RAM_BACKED_TEMPORARY_DIRECTORY, os.W_OK):
+    try:
+      if shutil.disk_usage(RAM_BACKED_TEMPORARY_DIRECTORY).free >= MESH_TRANSPORT_FREE_SPACE_FACTOR*requiredBytes:
+        return RAM_BACKED_TEMPORARY_DIRECTORY
+    except OSError:
+      pass
+  return tempfile.gettempdir()
+
+def writePolyDataForTransport(polyData, filePath):
+  """
+  Write polyData as raw binary (no base64 encoding, no compression) so writing and
+  reading it back is little more than a memory copy
+  """
+  if filePath.endswith(".vtp"):
+    writer = vtk.vtkXMLPolyDataWriter()
+    writer.SetDataModeToAppended()
+    writer.EncodeAppendedDataOff()
+    writer.SetCompressorTypeToNone()
+  else:
+    writer = vtk.vtkPolyDataWriter()
+    writer.SetFileTypeToBinary()
+  writer.SetInputData(polyData)
+  writer.SetFileName(filePath)
+  if not writer.Write():
+    raise IOError(f"Could not write {filePath}")
+
+def readPolyDataFromTransport(filePath):
+  if filePath.endswith(".vtp"):
+    reader = vtk.vtkXMLPolyDataReader()
+  else:
+    reader = vtk.vtkPolyDataReader()
+  reader.SetFileName(filePath)
+  reader.Update()
+  polyData = vtk.vtkPolyData()
+  polyData.ShallowCopy(reader.GetOutput())
+  return polyData
+
+_cliParametersDescriptionsCache = {}
+
+def getCLIParametersDescription(executablePath):
+  """
+  How each parameter of a command line module is passed to its executable, read once from the
+  XML description the executable prints with --xml. Returns a dict from the parameter name to a
+  dict with its "tag" (e.g. geometry, boolean), "flag" (e.g. --operation, None if positional),
+  "index" (None if flagged) and the "fileExtensions" it accepts.
+  """
+  parametersDescription = _cliParametersDescriptionsCache.get(executablePath)
+  if parametersDescription is not None:
+    return parametersDescription
+
+  completedProcess = subprocess.run(
+    [executablePath, "--xml"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=60, check=True
+  )
+  xmlDescription = completedProcess.stdout.decode(errors="replace")
+  # some executables print a few lines before the description
+  executableRoot = ElementTree.fromstring(xmlDescription[xmlDescription.index("<executable"):])
+
+  parametersDescription = {}
+  for parametersGroup in executableRoot.iter("parameters"):
+    for parameter in parametersGroup:
+      name = parameter.findtext("name")
+      if name is None:
+        continue
+      longFlag = parameter.findtext("longflag")
+      flag = parameter.findtext("flag")
+      index = parameter.findtext("index")
+      if longFlag:
+        commandLineFlag = longFlag if longFlag.startswith("-") else "--" + longFlag
+      elif flag:
+        commandLineFlag = flag if flag.startswith("-") else "-" + flag
+      else:
+        commandLineFlag = None
+      parametersDescription[name.strip()] = {
+        "tag": parameter.tag,
+        "flag": commandLineFlag.strip() if commandLineFlag else None,
+        "index": int(index) if index is not None else None,
+        "fileExtensions": [
+          extension.strip() for extension in parameter.get("fileExtensions", "").split(",") if extension.strip()
+        ],
+      }
+
+  _cliParametersDescriptionsCache[executablePath] = parametersDescription
+  return parametersDescription
+
+def getTransportFileExtension(parameterDescription):
+  acceptedFileExtensions = parameterDescription["fileExtensions"]
+  for fileExtension in MESH_TRANSPORT_FILE_EXTENSIONS:
+    if not acceptedFileExtensions or fileExtension in acceptedFileExtensions:
+      return fileExtension
+  raise ValueError(f"None of the mesh file formats {acceptedFileExtensions} is supported")
+
+def startCLIWithPolyData(executablePath, parameters, outputParameterName):
+  """
+  Start the command line module executable in its own process, without CLI or model nodes.
+  vtkPolyData values of parameters are written to temporary files, in a RAM backed directory
+  if possible, and the mesh written to outputParameterName is read back by finishCLIWithPolyData.
+  Returns the job to pass to isCLIRunning and finishCLIWithPolyData.
+  """
+  parametersDescription = getCLIParametersDescription(executablePath)
+  operandsBytes = sum(
+    value.GetActualMemorySize()*1024 for value in parameters.values() if isinstance(value, vtk.vtkPolyData)
+  )
+  workingDirectory = tempfile.mkdtemp(prefix="BRPMeshTransport", dir=getMeshTransportDirectory(operandsBytes))
+  try:
+    outputPath = os.path.join(
+      workingDirectory, outputParameterName + getTransportFileExtension(parametersDescription[outputParameterName])
+    )
+    flaggedArguments = []
+    positionalArguments = []
+    for name, value in list(parameters.items()) + [(outputParameterName, outputPath)]:
+      parameterDescription = parametersDescription[name]
+      if isinstance(value, vtk.vtkPolyData):
+        filePath = os.path.join(workingDirectory, name + getTransportFileExtension(parameterDescription))
+        writePolyDataForTransport(value, filePath)
+        value = filePath
+      if parameterDescription["tag"] == "boolean":
+        if value and parameterDescription["flag"] is not None:
+          flaggedArguments.append(parameterDescription["flag"])
+        continue
+      if parameterDescription["flag"] is not None:
+        flaggedArguments += [parameterDescription["flag"], str(value)]
+      else:
+        positionalArguments.append((parameterDescription["index"], str(value)))
+
+    # errors go to a file, a pipe that nobody reads while the job runs could fill up and block it
+    errorOutputPath = os.path.join(workingDirectory, "errorOutput.txt")
+    with open(errorOutputPath, "wb") as errorOutputFile:
+      process = subprocess.Popen(
+        [executablePath] + flaggedArguments + [argument for _, argument in sorted(positionalArguments)],
+        stdout=subprocess.DEVNULL, stderr=errorOutputFile
+      )
+  except Exception:
+    shutil.rmtree(workingDirectory, ignore_errors=True)
+    raise
+  return {"process": process, "workingDirectory": workingDirectory, "outputPath": outputPath, "errorOutputPath": errorOutputPath}
+
+def isCLIRunning(cliJob):
+  return cliJob["process"].poll() is None
+
+def finishCLIWithPolyData(cliJob, timeout=None):
+  """
+  Wait for the job started by startCLIWithPolyData and return its output vtkPolyData.
+  Raises RuntimeError if the executable failed or did not write the output.
+  """
+  process = cliJob["process"]
+  try:
+    try:
+      process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+      process.kill()
+      process.wait()
+    if process.returncode != 0 or not os.path.isfile(cliJob["outputPath"]):
+      with open(cliJob["errorOutputPath"], "rb") as errorOutputFile:
+        errorOutput = errorOutputFile.read().decode(errors="replace").strip()
+      raise RuntimeError(f"Command line module exited with code {process.returncode}: " + errorOutput)
+    return readPolyDataFromTransport(cliJob["outputPath"])
+  finally:
+    shutil.rmtree(cliJob["workingDirectory"], ignore_errors=True)
+
+def runCLIWithPolyData(executablePath, parameters, outputParameterName, timeout=None):
+  return finishCLIWithPolyData(startCLIWithPolyData(executablePath, parameters, outputParameterName), timeout)
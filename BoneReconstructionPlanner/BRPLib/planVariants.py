@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+# This file is also executed as a script by the worker processes (see evaluatePlanVariants),
+# so it must not import slicer, vtk or qt
+if __package__:
+  from .mandiblePlanesOptimizer import *
+else:
+  from mandiblePlanesOptimizer import *
+
+PLAN_INPUTS_FILENAME = "planInputs.npz"
+
+def savePlanInputs(planInputs, filePath):
+  np.savez(filePath, **{key: np.asarray(value) for key, value in planInputs.items()})
+
+def loadPlanInputs(filePath):
+  with np.load(filePath) as planInputsFile:
+    return {
+      key: (planInputsFile[key] if planInputsFile[key].ndim > 0 else planInputsFile[key].item())
+      for key in planInputsFile.files
+    }
+
+def evaluatePlanVariant(planInputs, variant):
+  """
+  Evaluate a plan variant over the plan inputs (see BoneReconstructionPlannerLogic.getPlanInputs).
+  variant is a dict with a "name" and either the "knotsArcLengths" of all the planes over the
+  mandibular curve or a "numberOfSegments" for which the planes placement is optimized first.
+  Returns a json serializable dict with the metrics of the variant.
+  """
+  curvePoints = planInputs["curvePoints"]
+  cumulativeArcLengths = getCumulativeArcLengths(curvePoints)
+  fibulaRadius = planInputs["fibulaRadius"]
+  betweenSpace = planInputs["betweenSpace"]
+
+  if "knotsArcLengths" in variant:
+    knotsArcLengths = np.sort(np.asarray(variant["knotsArcLengths"], dtype=float))
+  else:
+    knotsArcLengths, optimizationMetrics = optimizeMandiblePlanesArcLengths(
+      curvePoints, planInputs["startArcLength"], planInputs["endArcLength"], int(variant["numberOfSegments"]),
+      planInputs["resectedBonePoints"], fibulaRadius, planInputs["minimumSegmentLength"],
+      planInputs["availableFibulaLength"], planInputs["initialSpace"], betweenSpace,
+      seed=variant.get("seed", 0)
+    )
+
+  scores, metrics = evaluatePlanesPlacements(
+    curvePoints, cumulativeArcLengths, knotsArcLengths[None, :], planInputs["resectedBonePoints"],
+    fibulaRadius, planInputs["minimumSegmentLength"], planInputs["availableFibulaLength"],
+    planInputs["initialSpace"], betweenSpace
+  )
+  origins, segmentsDirections, segmentsLengths, jointsAngles = getPlacementsGeometry(
+    curvePoints, cumulativeArcLengths, knotsArcLengths[None, :]
+  )
+  # gap between consecutive pieces over the fibula, measured along the fibula axis
+  piecesGaps = betweenSpace + 2*fibulaRadius*np.tan(np.minimum(jointsAngles[0], np.radians(80))/2)
+
+  return {
+    "name": variant.get("name", ""),
+    "numberOfSegments": len(knotsArcLengths) - 1,
+    "knotsArcLengths": knotsArcLengths.tolist(),
+    "planesOrigins": origins[0].tolist(),
+    "segmentsLengths": segmentsLengths[0].tolist(),
+    "jointsAngles_deg": np.degrees(jointsAngles[0]).tolist(),
+    "piecesGaps": piecesGaps.tolist(),
+    "boneContact": float(metrics["boneContact"][0]),
+    "curveDeviation": float(metrics["curveDeviation"][0]),
+    "neededFibulaLength": float(metrics["neededFibulaLength"][0]),
+    "availableFibulaLength": float(planInputs["availableFibulaLength"]),
+    "feasible": bool(metrics["feasible"][0]),
+    "score": float(scores[0]),
+  }
+
+def getWorkerPythonExecutable():
+  """
+  Python interpreter for the worker processes. Inside Slicer sys.executable is the Slicer application
+  itself, the PythonSlicer launcher (next to it on the PATH of Slicer) runs plain Python with numpy.
+  Returns None if it is not found.
+  """
+  return shutil.which("PythonSlicer")
+
+class PlanVariantsEvaluation:
+  """
+  Evaluation of several plan variants, each one in its own worker process that receives a copy of
+  the plan inputs. update() starts the pending workers and collects the finished ones without waiting
+  for them, call it periodically (e.g. from a timer) until it returns True.
+  results holds the metrics of each variant in the same order as variants, a variant whose worker
+  failed has an "error" entry instead of metrics.
+  If worker processes are not available the variants are evaluated in this process, one per update().
+  """
+  def __init__(self, planInputs, variants, maximumNumberOfWorkers=None, timeout=600):
+    self.planInputs = planInputs
+    self.variants = list(variants)
+    self.timeout = timeout
+    if maximumNumberOfWorkers is None:
+      maximumNumberOfWorkers = max(1, (os.cpu_count() or 2) - 1)
+    self.maximumNumberOfWorkers = maximumNumberOfWorkers
+    self.results = [None]*len(self.variants)
+    self.pendingVariantsIndices = list(range(len(self.variants)))
+    self.runningWorkers = []
+
+    self.pythonExecutable = getWorkerPythonExecutable()
+    self.workingDirectory = None
+    if self.pythonExecutable is not None:
+      self.workingDirectory = tempfile.mkdtemp(prefix="BRPPlanVariants")
+      self.planInputsPath = os.path.join(self.workingDirectory, PLAN_INPUTS_FILENAME)
+      savePlanInputs(planInputs, self.planInputsPath)
+
+  def isFinished(self):
+    return not self.pendingVariantsIndices and not self.runningWorkers
+
+  def getVariantName(self, variantIndex):
+    return self.variants[variantIndex].get("name", "")
+
+  def setVariantError(self, variantIndex, errorMessage):
+    logging.warning(f"Plan variant {self.getVariantName(variantIndex) or variantIndex} failed: {errorMessage}")
+    self.results[variantIndex] = {"name": self.getVariantName(variantIndex), "error": errorMessage}
+
+  def startWorker(self, variantIndex):
+    variantPath = os.path.join(self.workingDirectory, f"variant{variantIndex}.json")
+    resultPath = os.path.join(self.workingDirectory, f"result{variantIndex}.json")
+    errorOutputPath = os.path.join(self.workingDirectory, f"errorOutput{variantIndex}.txt")
+    with open(variantPath, "w") as variantFile:
+      json.dump(self.variants[variantIndex], variantFile)
+    # errors go to a file, a pipe that nobody reads while the worker runs could fill up and block it
+    with open(errorOutputPath, "wb") as errorOutputFile:
+      process = subprocess.Popen(
+        [self.pythonExecutable, os.path.abspath(__file__), self.planInputsPath, variantPath, resultPath],
+        stdout=subprocess.DEVNULL, stderr=errorOutputFile
+      )
+    self.runningWorkers.append({
+      "variantIndex": variantIndex, "process": process, "resultPath": resultPath,
+      "errorOutputPath": errorOutputPath, "startTime": time.monotonic()
+    })
+
+  def finishWorker(self, worker):
+    process = worker["process"]
+    if process.returncode == 0 and os.path.isfile(worker["resultPath"]):
+      with open(worker["resultPath"]) as resultFile:
+        self.results[worker["variantIndex"]] = json.load(resultFile)
+      return
+    with open(worker["errorOutputPath"], "rb") as errorOutputFile:
+      errorMessage = errorOutputFile.read().decode(errors="replace").strip()
+    if not errorMessage:
+      errorMessage = f"Worker exited with code {process.returncode}"
+    self.setVariantError(worker["variantIndex"], errorMessage)
+
+  def update(self):
+    """
+    Returns True when all the variants are evaluated
+    """
+    if self.pythonExecutable is None:
+      if self.pendingVariantsIndices:
+        variantIndex = self.pendingVariantsIndices.pop(0)
+        try:
+          self.results[variantIndex] = evaluatePlanVariant(self.planInputs, self.variants[variantIndex])
+        except Exception as e:
+          self.setVariantError(variantIndex, str(e))
+      return self.isFinished()
+
+    runningWorkers = []
+    for worker in self.runningWorkers:
+      if worker["process"].poll() is None:
+        if time.monotonic() - worker["startTime"] < self.timeout:
+          runningWorkers.append(worker)
+          continue
+        worker["process"].kill()
+        worker["process"].wait()
+      self.finishWorker(worker)
+    self.runningWorkers = runningWorkers
+
+    while self.pendingVariantsIndices and len(self.runningWorkers) < self.maximumNumberOfWorkers:
+      self.startWorker(self.pendingVariantsIndices.pop(0))
+
+    if self.isFinished():
+      self.removeWorkingDirectory()
+    return self.isFinished()
+
+  def cancel(self):
+    """
+    Stop the running workers, the variants not evaluated yet are left without result
+    """
+    for worker in self.runningWorkers:
+      worker["process"].kill()
+      worker["process"].wait()
+    self.runningWorkers = []
+    self.pendingVariantsIndices = []
+    self.removeWorkingDirectory()
+
+  def removeWorkingDirectory(self):
+    if self.workingDirectory is not None:
+      shutil.rmtree(self.workingDirectory, ignore_errors=True)
+      self.workingDirectory = None
+
+def evaluatePlanVariants(planInputs, variants, maximumNumberOfWorkers=None, timeout=600, pollInterval=0.05):
+  """
+  Evaluate several plan variants concurrently and wait for all of them (see PlanVariantsEvaluation).
+  Results are returned in the same order as variants.
+  """
+  evaluation = PlanVariantsEvaluation(planInputs, variants, maximumNumberOfWorkers, timeout)
+  try:
+    while not evaluation.update():
+      if evaluation.runningWorkers:
+        time.sleep(pollInterval)
+  finally:
+    evaluation.cancel()
+  return evaluation.results
+
+if __name__ == "__main__":
+  planInputsPath, variantPath, resultPath = sys.argv[1:4]
+  with open(variantPath) as variantFile:
+    variant = json.load(variantFile)
+  result = evaluatePlanVariant(loadPlanInputs(planInputsPath), variant)
+  with open(resultPath, "w") as resultFile:
+    json.dump(result, resultFile)
@@ -0,0 +1,180 @@
+import collections
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from .memoryBudget import *
+
+# Older events are dropped once the trace is full, the summary keeps counting
+STAGE_TIMINGS_MAXIMUM_NUMBER_OF_EVENTS = 100000
+
+class StageTimings:
+  """
+  Records the wall time of nested processing stages and keeps it in memory.
+  For each stage path (e.g. VSP > updateFibulaPieces) it accumulates the call count, total, self,
+  minimum and maximum time, and the peak memory of the stages that monitor it. Every call is also kept as an event so the whole session can be
+  exported as a json trace in the Chrome trace event format (chrome://tracing, ui.perfetto.dev).
+  """
+  def __init__(self, maximumNumberOfEvents=STAGE_TIMINGS_MAXIMUM_NUMBER_OF_EVENTS):
+    self.maximumNumberOfEvents = maximumNumberOfEvents
+    self.lock = threading.Lock()
+    self.threadState = threading.local()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.originTime = time.perf_counter()
+      self.stagesStatistics = {}
+      self.events = collections.deque(maxlen=self.maximumNumberOfEvents)
+      self.numberOfDroppedEvents = 0
+
+  def getOpenStages(self):
+    if not hasattr(self.threadState, "openStages"):
+      self.threadState.openStages = []
+    return self.threadState.openStages
+
+  @contextmanager
+  def stage(self, name, monitorMemory=False):
+    openStages = self.getOpenStages()
+    parentPath = openStages[-1]["path"] if openStages else ()
+    memoryMonitor = None
+    if monitorMemory:
+      memoryMonitor = PeakMemoryMonitor()
+      memoryMonitor.start()
+    openStage = {"path": parentPath + (name,), "startTime": time.perf_counter(), "childrenTime": 0., "peakMemory": None}
+    openStages.append(openStage)
+    try:
+      yield
+    finally:
+      stopTime = time.perf_counter()
+      openStages.pop()
+      if memoryMonitor is not None:
+        openStage["peakMemory"] = memoryMonitor.stop()
+      elapsedTime = stopTime - openStage["startTime"]
+      if openStages:
+        openStages[-1]["childrenTime"] += elapsedTime
+      self.addStageRecord(openStage, elapsedTime)
+
+  def addStageRecord(self, openStage, elapsedTime):
+    path = openStage["path"]
+    with self.lock:
+      statistics = self.stagesStatistics.get(path)
+      if statistics is None:
+        statistics = self.stagesStatistics[path] = {
+          "count": 0, "totalTime": 0., "selfTime": 0., "minimumTime": elapsedTime, "maximumTime": elapsedTime,
+          "peakMemory": None
+        }
+      statistics["count"] += 1
+      statistics["totalTime"] += elapsedTime
+      statistics["selfTime"] += elapsedTime - openStage["childrenTime"]
+      statistics["minimumTime"] = min(statistics["minimumTime"], elapsedTime)
+      statistics["maximumTime"] = max(statistics["maximumTime"], elapsedTime)
+      peakMemory = openStage["peakMemory"]
+      if peakMemory is not None:
+        statistics["peakMemory"] = max(statistics["peakMemory"] or 0, peakMemory)
+
+      if len(self.events) == self.maximumNumberOfEvents:
+        self.numberOfDroppedEvents += 1
+      self.events.append((path, openStage["startTime"], elapsedTime, threading.get_ident(), peakMemory))
+
+  def getCurrentStageElapsedTime(self):
+    """
+    Seconds since the innermost running stage of this thread started, 0 if there is none
+    """
+    openStages = self.getOpenStages()
+    if not openStages:
+      return 0.
+    return time.perf_counter() - openStages[-1]["startTime"]
+
+  def getSummary(self):
+    """
+    Returns the stages as a tree of dicts with name, count, totalTime, selfTime,
+    minimumTime, maximumTime (seconds), peakMemory (bytes, None if not monitored) and children
+    """
+    with self.lock:
+      stagesStatistics = {path: dict(statistics) for path, statistics in self.stagesStatistics.items()}
+
+    rootStages = []
+    nodesByPath = {}
+    for path in sorted(stagesStatistics, key=len):
+      node = {"name": path[-1], **stagesStatistics[path], "children": []}
+      nodesByPath[path] = node
+      parentNode = nodesByPath.get(path[:-1])
+      if parentNode is None:
+        rootStages.append(node)
+      else:
+        parentNode["children"].append(node)
+
+    def sortByTotalTime(nodes):
+      nodes.sort(key=lambda node: node["totalTime"], reverse=True)
+      for node in nodes:
+        sortByTotalTime(node["children"])
+    sortByTotalTime(rootStages)
+    return rootStages
+
+  def formatSummary(self, maximumDepth=None):
+    lines = []
+    def addLines(nodes, depth):
+      if maximumDepth is not None and depth >= maximumDepth:
+        return
+      for node in nodes:
+        line = "{0}{1}: {2} calls, total {3:.3f} s, self {4:.3f} s, max {5:.3f} s".format(
+          "  "*depth, node["name"], node["count"], node["totalTime"], node["selfTime"], node["maximumTime"]
+        )
+        if node["peakMemory"] is not None:
+          line += ", peak memory {0:.0f} MB".format(node["peakMemory"]/2**20)
+        lines.append(line)
+        addLines(node["children"], depth + 1)
+    addLines(self.getSummary(), 0)
+    return "\n".join(lines)
+
+  def getTrace(self):
+    with self.lock:
+      events = list(self.events)
+      numberOfDroppedEvents = self.numberOfDroppedEvents
+      originTime = self.originTime
+
+    processID = os.getpid()
+    traceEvents = []
+    for path, startTime, elapsedTime, threadID, peakMemory in events:
+      traceEvent = {
+        "name": path[-1],
+        "cat": "BoneReconstructionPlanner",
+        "ph": "X",
+        "ts": round((startTime - originTime)*1e6, 1),
+        "dur": round(elapsedTime*1e6, 1),
+        "pid": processID,
+        "tid": threadID,
+        "args": {"path": " > ".join(path)},
+      }
+      if peakMemory is not None:
+        traceEvent["args"]["peakMemory_MB"] = round(peakMemory/2**20, 1)
+      traceEvents.append(traceEvent)
+    return {
+      "traceEvents": traceEvents,
+      "displayTimeUnit": "ms",
+      "otherData": {"numberOfDroppedEvents": numberOfDroppedEvents},
+      "stagesSummary": self.getSummary(),
+    }
+
+  def exportTrace(self, filePath):
+    with open(filePath, "w") as traceFile:
+      json.dump(self.getTrace(), traceFile)
+
+stageTimings = StageTimings()
+
+def timedStage(name=None, monitorMemory=False):
+  """
+  Decorator that records each call of the decorated function as a stage of stageTimings,
+  named after the function if no name is given
+  """
+  def decorator(function):
+    stageName = name or function.__name__
+    @functools.wraps(function)
+    def decorated_function(*args, **kwargs):
+      with stageTimings.stage(stageName, monitorMemory):
+        return function(*args, **kwargs)
+    return decorated_function
+  return decorator
@@ -5,8 +5,14 @@ import vtk, qt, ctk, slicer, math
 import numpy as np
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
+from BRPLib.memoryBudget import *
+from BRPLib.stageTimings import *
+from BRPLib.meshTransport import *
 from BRPLib.helperFunctions import *
 from BRPLib.guiWidgets import *
+from BRPLib.meshExport import *
+from BRPLib.mandiblePlanesOptimizer import *
+from BRPLib.planVariants import *
 from BRPLib.MOOSEHelper import *
 from BRPLib.DentalSegmentatorHelper import *
 import json
@@ -66,12 +72,14 @@ def registerSampleData():
     # Thumbnail should have size of approximately 260x280 pixels and stored in Resources/Icons folder.
     # It can be created by Screen Capture module, "Capture all views" option enabled, "Number of images" set to "Single".
     thumbnailFileName=os.path.join(iconsPath, 'iconCTFibulaCropped.png'),
-    # Download URL and target file name
-    uris="https://github.com/SlicerIGT/SlicerBoneReconstructionPlanner/releases/download/TestingData/CTFibulaCropped.nrrd",
-    fileNames='CTFibulaCropped.nrrd',
-    # Checksum to ensure file integrity. Can be computed by this command:
-    #  import hashlib; print(hashlib.sha256(open(filename, "rb").read()).hexdigest())
-    checksums = 'SHA256:5febc47a8fba6b43440be2b475f9defadffe9b47b1316d04217208b4497a4f72',
+    # Download URL (or local mirror file) and target file name
+    **resolveSampleDataSource(
+      uris="https://github.com/SlicerIGT/SlicerBoneReconstructionPlanner/releases/download/TestingData/CTFibulaCropped.nrrd",
+      fileNames='CTFibulaCropped.nrrd',
+      # Checksum to ensure file integrity. Can be computed by this command:
+      #  import hashlib; print(hashlib.sha256(open(filename, "rb").read()).hexdigest())
+      checksums='SHA256:5febc47a8fba6b43440be2b475f9defadffe9b47b1316d04217208b4497a4f72'
+    ),
     # This node name will be used when the data set is loaded
     nodeNames='CTFibulaCropped'
   )
@@ -82,10 +90,12 @@ def registerSampleData():
     category='BoneReconstructionPlanner',
     sampleName='CTFibula',
     thumbnailFileName=os.path.join(iconsPath, 'iconCTFibula.png'),
-    # Download URL and target file name
-    uris="https://github.com/SlicerIGT/SlicerBoneReconstructionPlanner/releases/download/TestingData/CTFibula.nrrd",
-    fileNames='CTFibula.nrrd',
-    checksums = 'SHA256:715ae01091b642677e6065b8d7bb4d15ed9adaf31c057f4b53ea70a425bba7a4',
+    # Download URL (or local mirror file) and target file name
+    **resolveSampleDataSource(
+      uris="https://github.com/SlicerIGT/SlicerBoneReconstructionPlanner/releases/download/TestingData/CTFibula.nrrd",
+      fileNames='CTFibula.nrrd',
+      checksums='SHA256:715ae01091b642677e6065b8d7bb4d15ed9adaf31c057f4b53ea70a425bba7a4'
+    ),
     # This node name will be used when the data set is loaded
     nodeNames='CTFibula'
   )
@@ -96,10 +106,12 @@ def registerSampleData():
     category='BoneReconstructionPlanner',
     sampleName='CTMandible',
     thumbnailFileName=os.path.join(iconsPath, 'iconCTMandible.png'),
-    # Download URL and target file name
-    uris="https://github.com/SlicerIGT/SlicerBoneReconstructionPlanner/releases/download/TestingData/CTMandible.nrrd",
-    fileNames='CTMandible.nrrd',
-    checksums = 'SHA256:352aefed1905bd2ad7373972a6bb115bd494e26e4fc438d2c8679384dcfd2654',
+    # Download URL (or local mirror file) and target file name
+    **resolveSampleDataSource(
+      uris="https://github.com/SlicerIGT/SlicerBoneReconstructionPlanner/releases/download/TestingData/CTMandible.nrrd",
+      fileNames='CTMandible.nrrd',
+      checksums='SHA256:352aefed1905bd2ad7373972a6bb115bd494e26e4fc438d2c8679384dcfd2654'
+    ),
     # This node name will be used when the data set is loaded
     nodeNames='CTMandible'
   )
@@ -111,10 +123,12 @@ def registerSampleData():
     sampleName='FibulaSegmentation',
     thumbnailFileName=os.path.join(iconsPath, 'iconFibulaSegmentation.png'),
     loadFileType='SegmentationFile',
-    # Download URL and target file name
-    uris="https://github.com/SlicerIGT/SlicerBoneReconstructionPlanner/releases/download/TestingData/FibulaSegmentation.seg.nrrd",
-    fileNames='FibulaSegmentation.seg.nrrd',
-    checksums = 'SHA256:517bfe11a87b709cb8aa6d4187f41d8c86a8d9a033667a4fc8c8b95bf3eeb99d',
+    # Download URL (or local mirror file) and target file name
+    **resolveSampleDataSource(
+      uris="https://github.com/SlicerIGT/SlicerBoneReconstructionPlanner/releases/download/TestingData/FibulaSegmentation.seg.nrrd",
+      fileNames='FibulaSegmentation.seg.nrrd',
+      checksums='SHA256:517bfe11a87b709cb8aa6d4187f41d8c86a8d9a033667a4fc8c8b95bf3eeb99d'
+    ),
     # This node name will be used when the data set is loaded
     nodeNames='FibulaSegmentation'
   )
@@ -126,10 +140,12 @@ def registerSampleData():
     sampleName='MandibleSegmentation',
     thumbnailFileName=os.path.join(iconsPath, 'iconMandibleSegmentation.png'),
     loadFileType='SegmentationFile',
-    # Download URL and target file name
-    uris="https://github.com/SlicerIGT/SlicerBoneReconstructionPlanner/releases/download/TestingData/MandibleSegmentation.seg.nrrd",
-    fileNames='MandibleSegmentation.seg.nrrd',
-    checksums = 'SHA256:d815406843f7945997c8eee6d7cd906e707ed5a1a6aabb2787c5203297e3ef01',
+    # Download URL (or local mirror file) and target file name
+    **resolveSampleDataSource(
+      uris="https://github.com/SlicerIGT/SlicerBoneReconstructionPlanner/releases/download/TestingData/MandibleSegmentation.seg.nrrd",
+      fileNames='MandibleSegmentation.seg.nrrd',
+      checksums='SHA256:d815406843f7945997c8eee6d7cd906e707ed5a1a6aabb2787c5203297e3ef01'
+    ),
     # This node name will be used when the data set is loaded
     nodeNames='MandibleSegmentation'
   )
@@ -142,23 +158,173 @@ def registerSampleData():
     thumbnailFileName=os.path.join(iconsPath, 'iconTestPlanBRP.png'),
     loadFileType='SceneFile',
     loadFiles="True",
-    # Download URL and target file name
-    uris="https://github.com/SlicerIGT/SlicerBoneReconstructionPlanner/releases/download/TestingData/TestPlanBRP.mrb",
-    fileNames='TestPlanBRP.mrb',
-    checksums = 'SHA256:92ace5d23218e74a7deb04f78afa22e49ed98be6951ef4202ac9f26a8f79190b',
+    # Download URL (or local mirror file) and target file name
+    **resolveSampleDataSource(
+      uris="https://github.com/SlicerIGT/SlicerBoneReconstructionPlanner/releases/download/TestingData/TestPlanBRP.mrb",
+      fileNames='TestPlanBRP.mrb',
+      checksums='SHA256:92ace5d23218e74a7deb04f78afa22e49ed98be6951ef4202ac9f26a8f79190b'
+    ),
     # This node name will be used when the data set is loaded
     nodeNames='TestPlanBRP'
   )
 
+SAMPLE_DATA_MIRROR_DIRECTORY_ENVIRONMENT_VARIABLE = "BRP_SAMPLE_DATA_MIRROR_DIRECTORY"
+
+def getSampleDataMirrorDirectory():
+  """
+  Return the local directory that mirrors the sample data release files or None.
+  It is read from the BRP_SAMPLE_DATA_MIRROR_DIRECTORY environment variable or
+  from the BoneReconstructionPlanner/sampleDataMirrorDirectory setting.
+  """
+  mirrorDirectory = os.environ.get(SAMPLE_DATA_MIRROR_DIRECTORY_ENVIRONMENT_VARIABLE)
+  if not mirrorDirectory:
+    mirrorDirectory = rs("sampleDataMirrorDirectory")
+  if not mirrorDirectory or not os.path.isdir(mirrorDirectory):
+    return None
+  return mirrorDirectory
+
+def getSampleDataMirrorFileSignature(filePath, checksum):
+  fileStat = os.stat(filePath)
+  return f"{fileStat.st_size}:{fileStat.st_mtime_ns}:{checksum}"
+
+def getSampleDataMirrorVerifiedSettingName(filePath):
+  return "sampleDataMirrorVerified/" + os.path.basename(filePath)
+
+def isSampleDataMirrorFileRecordedAsVerified(filePath, checksum):
+  """
+  Return True if the mirror file was verified before and did not change since then.
+  Only the file size and modification time are read, the file is not hashed.
+  """
+  settingName = getSampleDataMirrorVerifiedSettingName(filePath)
+  return rs(settingName) == getSampleDataMirrorFileSignature(filePath, checksum)
+
+def isSampleDataMirrorFileVerified(filePath, checksum):
+  """
+  Return True if the mirror file matches the expected checksum ('SHA256:...').
+  The hash is computed only the first time, the result is recorded in the settings
+  together with the file size and modification time so it is not computed again
+  while the file stays unchanged.
+  """
+  if isSampleDataMirrorFileRecordedAsVerified(filePath, checksum):
+    return True
+
+  import hashlib
+  algorithm, expectedDigest = checksum.split(":", 1)
+  fileHash = hashlib.new(algorithm.lower())
+  with open(filePath, "rb") as file:
+    for chunk in iter(lambda: file.read(4*1024*1024), b""):
+      fileHash.update(chunk)
+  if fileHash.hexdigest() != expectedDigest.lower():
+    logging.warning(f"Sample data mirror file {filePath} does not match its checksum, it will be ignored")
+    return False
+
+  ws(getSampleDataMirrorVerifiedSettingName(filePath), getSampleDataMirrorFileSignature(filePath, checksum))
+  return True
+
+def resolveSampleDataSource(uris, fileNames, checksums):
+  """
+  Return the uris, fileNames and checksums arguments for registering a sample.
+  If the sample is in the local mirror directory and was verified in a previous session
+  the mirror file is used and the checksum is dropped, so Sample Data neither
+  needs network access nor hashes the file again on each load.
+  Mirror files are not hashed here (this runs at application startup), files not verified
+  yet are switched to the mirror by useVerifiedSampleDataMirror when they are needed.
+  """
+  mirrorDirectory = getSampleDataMirrorDirectory()
+  if mirrorDirectory is not None:
+    mirrorFilePath = os.path.join(mirrorDirectory, fileNames)
+    if os.path.isfile(mirrorFilePath) and isSampleDataMirrorFileRecordedAsVerified(mirrorFilePath, checksums):
+      return {
+        "uris": qt.QUrl.fromLocalFile(mirrorFilePath).toString(),
+        "fileNames": fileNames,
+        "checksums": None,
+      }
+  return {
+    "uris": uris,
+    "fileNames": fileNames,
+    "checksums": checksums,
+  }
+
+def useVerifiedSampleDataMirror(sampleName):
+  """
+  Point the registered sample to its local mirror file if the file matches its checksum.
+  Return True if the sample is loaded from the mirror.
+  """
+  mirrorDirectory = getSampleDataMirrorDirectory()
+  if mirrorDirectory is None:
+    return False
+  import SampleData
+  source = SampleData.SampleDataLogic().sourceForSampleName(sampleName)
+  if source is None:
+    return False
+  mirrorFilePath = os.path.join(mirrorDirectory, source.fileNames[0])
+  mirrorUri = qt.QUrl.fromLocalFile(mirrorFilePath).toString()
+  if source.uris[0] == mirrorUri:
+    # resolved when the sample was registered
+    return True
+  checksum = source.checksums[0]
+  if checksum is None or not os.path.isfile(mirrorFilePath):
+    return False
+  if not isSampleDataMirrorFileVerified(mirrorFilePath, checksum):
+    return False
+  source.uris[0] = mirrorUri
+  source.checksums[0] = None
+  return True
+
+TEST_DATA_SAMPLE_NAMES = ['CTMandible', 'CTFibula', 'MandibleSegmentation', 'FibulaSegmentation']
+
+def isTestDataAvailableInSampleDataMirror():
+  """
+  Return True if all the test data files are in the local mirror and match their checksums.
+  Verified files are loaded from the mirror from now on.
+  """
+  # verify every file, not only up to the first one that is missing
+  return all([useVerifiedSampleDataMirror(sampleName) for sampleName in TEST_DATA_SAMPLE_NAMES])
+
+_defaultParametersDict = None
+
+def loadDefaultParameters():
+  """
+  Return the cached default parameters dict, the json file is parsed only once per process.
+  The returned dict is shared so it must not be modified.
+  """
+  global _defaultParametersDict
+  if _defaultParametersDict is None:
+    defaultParametersPath = os.path.join(os.path.dirname(__file__), 'Resources/defaultParameters.json')
+    # read as json and convert to dictionary
+    with open(defaultParametersPath, 'r') as file:
+      _defaultParametersDict = json.load(file)
+  return _defaultParametersDict
+
 def readDefaultParameters():
   """
   Return default parameters as a dict
   """
-  defaultParametersPath = os.path.join(os.path.dirname(__file__), 'Resources/defaultParameters.json')
-  # read as json and convert to dictionary
-  with open(defaultParametersPath, 'r') as file:
-    defaultParametersDict = json.load(file)
-  return defaultParametersDict
+  return dict(loadDefaultParameters())
+
+def getParameterType(parameterName):
+  """
+  Return the type (bool, int, float or str) of a parameter according to its default value
+  """
+  defaultValue = loadDefaultParameters().get(parameterName)
+  if defaultValue is None:
+    return str
+  return type(defaultValue)
+
+def parseParameterValue(parameterName, stringValue):
+  """
+  Convert a string stored on the parameter node or the settings to the type of the parameter.
+  Empty or malformed numbers fall back to the default value.
+  """
+  parameterType = getParameterType(parameterName)
+  if parameterType is bool:
+    return stringValue == "True"
+  if parameterType is float or parameterType is int:
+    try:
+      return parameterType(float(stringValue))
+    except (TypeError, ValueError):
+      return loadDefaultParameters()[parameterName]
+  return stringValue if stringValue is not None else ""
 
 def setRemoteCacheLimit(cacheLimit_MB):
   """
@@ -182,6 +348,9 @@ def confirm_cache_size_is_enough_for_test_data():
   cacheManager = slicer.mrmlScene.GetCacheManager()
   if cacheManager is None:
     return
+  if isTestDataAvailableInSampleDataMirror():
+    # files are copied from the local mirror, so pruning the cache costs no download
+    return
   cacheLimit_MB = cacheManager.GetRemoteCacheLimit()
   if cacheLimit_MB >= TEST_DATA_SIZE_MB:
     return
@@ -245,23 +414,25 @@ def setLightingMode(renderingMode = "Lamp"):
       dontShowAgainSettingsKey = "BRP/MissingSandboxExtension"
     )
     return
-  viewNodesList = slicer.util.getNodesByClass("vtkMRMLViewNode")
-  for viewNode in viewNodesList:
-    lightsLogic.addManagedView(viewNode)
-  if renderingMode == "Lamp":
-    lightsLogic.setUseLightKit(False)
-    lightsLogic.setSingleLightIntensity(1.0)
-    lightsLogic.setUseSSAO(False)
-  elif renderingMode == "Lamp and Shadows":
-    lightsLogic.setUseLightKit(False)
-    lightsLogic.setSingleLightIntensity(1.0)
-    lightsLogic.setUseSSAO(True)
-  elif renderingMode == "MultiLamp":
-    lightsLogic.setUseLightKit(True)
-    lightsLogic.setUseSSAO(False)
-  elif renderingMode == "MultiLamp and Shadows":
-    lightsLogic.setUseLightKit(True)
-    lightsLogic.setUseSSAO(True)
+  # each lights logic setter re-renders the managed views, render them only once at the end
+  with slicer.util.RenderBlocker():
+    viewNodesList = slicer.util.getNodesByClass("vtkMRMLViewNode")
+    for viewNode in viewNodesList:
+      lightsLogic.addManagedView(viewNode)
+    if renderingMode == "Lamp":
+      lightsLogic.setUseLightKit(False)
+      lightsLogic.setSingleLightIntensity(1.0)
+      lightsLogic.setUseSSAO(False)
+    elif renderingMode == "Lamp and Shadows":
+      lightsLogic.setUseLightKit(False)
+      lightsLogic.setSingleLightIntensity(1.0)
+      lightsLogic.setUseSSAO(True)
+    elif renderingMode == "MultiLamp":
+      lightsLogic.setUseLightKit(True)
+      lightsLogic.setUseSSAO(False)
+    elif renderingMode == "MultiLamp and Shadows":
+      lightsLogic.setUseLightKit(True)
+      lightsLogic.setUseSSAO(True)
 
 def displayOrientation3DCube(display):
   """
@@ -295,33 +466,27 @@ def setModelsLightingInterpolationMethod(interpolationMethod = "Gouraud"):
     "Roughness": 0.3
   }
 
-  shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-  folderSubjectHierarchyID = shNode.GetItemByName("BoneReconstructionPlanner")
-  childIDs = vtk.vtkIdList()
-  shNode.GetItemChildren(folderSubjectHierarchyID, childIDs, True)
-
-  for id in range(childIDs.GetNumberOfIds()):
-    itemID = childIDs.GetId(id)
-    dataNode = shNode.GetItemDataNode(itemID)
-    if (dataNode is None) or not(dataNode.IsA("vtkMRMLModelNode")):
-      continue
-    displayNode = dataNode.GetDisplayNode()
-    if displayNode:
-      if interpolationMethod == "PBR":
-        # Set interpolation to PBR
-        displayNode.SetInterpolation(slicer.vtkMRMLDisplayNode.PBRInterpolation)
-        displayNode.SetDiffuse(PREFERRED_LIGHTING_EMPIRICAL_VALUES_PBR["Diffuse"])
-        displayNode.SetMetallic(PREFERRED_LIGHTING_EMPIRICAL_VALUES_PBR["Metallic"])
-        displayNode.SetRoughness(PREFERRED_LIGHTING_EMPIRICAL_VALUES_PBR["Roughness"])
-      elif interpolationMethod == "Gouraud":
-        # Set interpolation to Gouraud
-        displayNode.SetInterpolation(slicer.vtkMRMLDisplayNode.GouraudInterpolation)
-        displayNode.SetAmbient(DEFAULT_LIGHTING_VALUES_GOURAUD["Ambient"])
-        displayNode.SetDiffuse(DEFAULT_LIGHTING_VALUES_GOURAUD["Diffuse"])
-        displayNode.SetSpecular(DEFAULT_LIGHTING_VALUES_GOURAUD["Specular"])
-        displayNode.SetPower(DEFAULT_LIGHTING_VALUES_GOURAUD["Power"])
-        displayNode.SetMetallic(DEFAULT_LIGHTING_VALUES_GOURAUD["Metallic"])
-        displayNode.SetRoughness(DEFAULT_LIGHTING_VALUES_GOURAUD["Roughness"])
+  if interpolationMethod == "PBR":
+    displayProperties = {
+      "Interpolation": slicer.vtkMRMLDisplayNode.PBRInterpolation,
+      "Diffuse": PREFERRED_LIGHTING_EMPIRICAL_VALUES_PBR["Diffuse"],
+      "Metallic": PREFERRED_LIGHTING_EMPIRICAL_VALUES_PBR["Metallic"],
+      "Roughness": PREFERRED_LIGHTING_EMPIRICAL_VALUES_PBR["Roughness"],
+    }
+  elif interpolationMethod == "Gouraud":
+    displayProperties = {
+      "Interpolation": slicer.vtkMRMLDisplayNode.GouraudInterpolation,
+      "Ambient": DEFAULT_LIGHTING_VALUES_GOURAUD["Ambient"],
+      "Diffuse": DEFAULT_LIGHTING_VALUES_GOURAUD["Diffuse"],
+      "Specular": DEFAULT_LIGHTING_VALUES_GOURAUD["Specular"],
+      "Power": DEFAULT_LIGHTING_VALUES_GOURAUD["Power"],
+      "Metallic": DEFAULT_LIGHTING_VALUES_GOURAUD["Metallic"],
+      "Roughness": DEFAULT_LIGHTING_VALUES_GOURAUD["Roughness"],
+    }
+  else:
+    return
+
+  setDisplayNodesProperties(getModelDisplayNodesUnderFolder("BoneReconstructionPlanner"), **displayProperties)
 
 slicer.MANDIBLE_VIEW_SINGLETON_TAG = "1"
 slicer.FIBULA_VIEW_SINGLETON_TAG = "2"
@@ -336,9 +501,13 @@ slicer.THREE_D_PRINTABLE_OBJECT_COLOR = [243/255, 149/255, 42/255] # orange
 slicer.FIBULA_SEGMENTS_MEASUREMENT_MODES = ["center2center", "proximal2proximal", "distal2distal"]
 
 TEXT_LABEL_OVERLAP_EPSILON = 0.3 # mm, overlap of text labels into the guide boxes so boolean operations are robust
+TEXT_LABELS_SPATIAL_HASH_CELL_SIZE = 10 # mm, about the size of a text label
+# the positioning algorithm stops earlier once the line ends move less than positioningAlgorithmTolerance_mm
+MAXIMUM_NUMBER_OF_ITERATIONS_OF_POSITIONING_ALGORITHM = 10
 
 TEST_DATA_SIZE_MB = 500 # approximate size of CTMandible, CTFibula and their segmentations
 RECOMMENDED_CACHE_SIZE_MB = 1024
+NON_DECIMATED_PREVIEW_MEMORY_FACTOR = 3 # cut pieces, their transformed copies and the intermediate outputs of the filters
 
 USING_GUI = not(slicer.app.commandOptions().noMainWindow)
 
@@ -710,6 +879,7 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     self.ui.runHeadAndLegsSegmentationButton.connect('clicked(bool)', self.onRunHeadAndLegsSegmentationButton)
     self.ui.addCutPlaneButton.connect('clicked(bool)',self.onAddCutPlaneButton)
     self.ui.removeCutPlaneButton.connect('clicked(bool)',self.onRemoveCutPlaneButton)
+    self.ui.optimizeMandiblePlanesButton.connect('clicked(bool)',self.onOptimizeMandiblePlanesButton)
     self.ui.makeModelsButton.connect('clicked(bool)',self.onMakeModelsButton)
     self.ui.generateFibulaGuidebaseButton.connect('clicked(bool)',self.onGenerateFibulaGuidebaseButton)
     self.ui.makeBooleanOperationsToFibulaSurgicalGuideBaseButton.connect('clicked(bool)', self.onMakeBooleanOperationsToFibulaSurgicalGuideBaseButton)
@@ -755,6 +925,8 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     self.ui.lightingInterpolationMethodComboBox.textActivated.connect(self.updateParameterNodeFromGUI)
     self.ui.restoreDefaultSettingsButton.connect('clicked(bool)', self.onRestoreDefaultSettingsButton)
     self.ui.overwriteDefaultSettingsButton.connect('clicked(bool)', self.onOverwriteDefaultSettingsButton)
+    self.ui.exportGuidesAndPiecesButton.connect('clicked(bool)', self.onExportGuidesAndPiecesButton)
+    self.ui.exportStageTimingsButton.connect('clicked(bool)', self.onExportStageTimingsButton)
 
     # Make sure parameter node is initialized (needed for module reload)
     self.initializeParameterNode()
@@ -818,6 +990,12 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     Called when the application closes and the module widget is destroyed.
     """
     self.removeObservers()
+    if self.logic is not None:
+      # do not leave worker processes behind
+      self.logic.cancelPlanVariantsComparison()
+    if self.logic is not None and self.logic.meshExporter is not None:
+      # let pending exports finish writing their files and manifests
+      self.logic.meshExporter.shutdown()
 
   @vtk.calldata_type(vtk.VTK_OBJECT)
   def onNodeAboutToBeRemovedEvent(self, caller, event, callData):
@@ -1407,6 +1585,22 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
 
     # Make sure GUI changes do not call updateParameterNodeFromGUI (it could cause infinite loop)
     self._updatingGUIFromParameterNode = True
+    try:
+      # the visibility and lighting setters modify many display nodes, render the views only once
+      # (the blocker resumes rendering even if the update fails)
+      with slicer.util.RenderBlocker():
+        self.updateWidgetsFromParameterNode()
+    finally:
+      # All the GUI updates are done
+      self._updatingGUIFromParameterNode = False
+
+  def updateWidgetsFromParameterNode(self):
+    """
+    Update the widgets and the views to the parameter node, called by updateGUIFromParameterNode
+    while the rendering is paused.
+    """
+    # typed values of the parameters, parsed once for the whole update
+    parameterValues = self.logic.getParameterValues()
 
     # The line below is for selector updates
     currentScalarVolume = self._parameterNode.GetNodeReference("currentScalarVolume")
@@ -1416,11 +1610,11 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
       if USING_GUI:
         if scalarVolumeID:
           self.logic.setBackgroundVolumeFromID(scalarVolumeID)
-          self.logic.setRedSliceForModelsDisplayNodes()
+          self.logic.setRedSliceForModelsDisplayNodes(updateInverseMandiblePieces=False)
           self.logic.setRedSliceForMarkupsDisplayNodes()
 
-    self.ui.installAISegmentationsButton.enabled = self._parameterNode.GetParameter("AISegmentationsInstalled") == "False"
-    self.ui.runAISegmentationsFrame.enabled = self._parameterNode.GetParameter("AISegmentationsInstalled") == "True"
+    self.ui.installAISegmentationsButton.enabled = not parameterValues["AISegmentationsInstalled"]
+    self.ui.runAISegmentationsFrame.enabled = parameterValues["AISegmentationsInstalled"]
     self.ui.runHeadSegmentationButton.enabled = self._parameterNode.GetNodeReference("headCT") is not None
     self.ui.runLegsSegmentationButton.enabled = self._parameterNode.GetNodeReference("legsCT") is not None
     self.ui.runHeadAndLegsSegmentationButton.enabled = (
@@ -1432,18 +1626,18 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     #self.ui.headCTCorticalBoneThresholdSlider.maximum = scalarRange[1]
     self.ui.headCTCorticalBoneThresholdSlider.enabled = self._parameterNode.GetNodeReference("headCT") is not None
     self.ui.legsCTCorticalBoneThresholdSlider.enabled = self._parameterNode.GetNodeReference("legsCT") is not None
-    self.ui.headCTCorticalBoneThresholdSlider.value = float(self._parameterNode.GetParameter("headCTCorticalBoneThreshold"))
-    self.ui.legsCTCorticalBoneThresholdSlider.value = float(self._parameterNode.GetParameter("legsCTCorticalBoneThreshold"))
+    self.ui.headCTCorticalBoneThresholdSlider.value = parameterValues["headCTCorticalBoneThreshold"]
+    self.ui.legsCTCorticalBoneThresholdSlider.value = parameterValues["legsCTCorticalBoneThreshold"]
 
     # Update node selectors
     self.ui.headCTSelector.setCurrentNode(self._parameterNode.GetNodeReference("headCT"))
     self.ui.legsCTSelector.setCurrentNode(self._parameterNode.GetNodeReference("legsCT"))
     self.ui.mandibularSegmentSelector.setCurrentNode(self._parameterNode.GetNodeReference("mandibularSegmentation"))
-    self.ui.mandibularSegmentSelector.setCurrentSegmentID(self._parameterNode.GetParameter("mandibularSegment"))
+    self.ui.mandibularSegmentSelector.setCurrentSegmentID(parameterValues["mandibularSegment"])
     self.ui.fibulaSegmentSelector.setCurrentNode(self._parameterNode.GetNodeReference("fibulaSegmentation"))
-    self.ui.fibulaSegmentSelector.setCurrentSegmentID(self._parameterNode.GetParameter("fibulaSegment"))
+    self.ui.fibulaSegmentSelector.setCurrentSegmentID(parameterValues["fibulaSegment"])
     self.ui.vesselsSegmentSelector.setCurrentNode(self._parameterNode.GetNodeReference("vesselsSegmentation"))
-    self.ui.vesselsSegmentSelector.setCurrentSegmentID(self._parameterNode.GetParameter("vesselsSegment"))
+    self.ui.vesselsSegmentSelector.setCurrentSegmentID(parameterValues["vesselsSegment"])
     self.ui.fibulaSurgicalGuideBaseSelector.setCurrentNode(self._parameterNode.GetNodeReference("fibulaSurgicalGuideBaseModel"))
     self.ui.mandibleSurgicalGuideBaseSelector.setCurrentNode(self._parameterNode.GetNodeReference("mandibleSurgicalGuideBaseModel"))
     self.ui.dentalImplantFiducialListSelector.setCurrentNode(self._parameterNode.GetNodeReference("dentalImplantsFiducialList"))
@@ -1465,62 +1659,62 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
 
     self.ui.donorLegComboBox.currentText = self._parameterNode.GetParameter("donorLeg")
     
-    self.ui.initialSpinBox.setValue(float(self._parameterNode.GetParameter("initialSpace_mm")))
-    self.ui.betweenSpinBox.setValue(float(self._parameterNode.GetParameter("additionalBetweenSpaceOfFibulaPlanes_mm")))
-    self.ui.securityMarginOfFibulaPiecesSpinBox.setValue(float(self._parameterNode.GetParameter("securityMarginOfFibulaPieces_mm")))
-    self.ui.miterBoxSlotWidthSpinBox.setValue(float(self._parameterNode.GetParameter("miterBoxSlotWidth_mm")))
-    self.ui.miterBoxSlotLengthSpinBox.setValue(float(self._parameterNode.GetParameter("miterBoxSlotLength_mm")))
-    self.ui.miterBoxSlotHeightSpinBox.setValue(float(self._parameterNode.GetParameter("miterBoxSlotHeight_mm")))
-    self.ui.miterBoxSlotWallSpinBox.setValue(float(self._parameterNode.GetParameter("miterBoxSlotWall_mm")))
-    self.ui.fibulaScrewHoleCylinderRadiusSpinBox.setValue(float(self._parameterNode.GetParameter("fibulaScrewHoleCylinderRadius_mm")))
-    self.ui.clearanceFitPrintingToleranceSpinBox.setValue(float(self._parameterNode.GetParameter("clearanceFitPrintingTolerance_mm")))
-    self.ui.fibulaGuidebaseThicknessSpinBox.setValue(float(self._parameterNode.GetParameter("fibulaGuidebaseThickness_mm")))
-    self.ui.fibulaGuidebaseMarginSpinBox.setValue(float(self._parameterNode.GetParameter("fibulaGuidebaseMargin_mm")))
-    self.ui.fibulaGuidebaseAngleSpinBox.setValue(float(self._parameterNode.GetParameter("fibulaGuidebaseAngle_mm")))
-    self.ui.biggerMiterBoxDistanceToFibulaSpinBox.setValue(float(self._parameterNode.GetParameter("biggerMiterBoxDistanceToFibula_mm")))
-    self.ui.fibulaTextLabelsDepthSpinBox.setValue(float(self._parameterNode.GetParameter("fibulaTextLabelsDepth_mm")))
-    self.ui.sawBoxSlotWidthSpinBox.setValue(float(self._parameterNode.GetParameter("sawBoxSlotWidth_mm")))
-    self.ui.sawBoxSlotLengthSpinBox.setValue(float(self._parameterNode.GetParameter("sawBoxSlotLength_mm")))
-    self.ui.sawBoxSlotHeightSpinBox.setValue(float(self._parameterNode.GetParameter("sawBoxSlotHeight_mm")))
-    self.ui.sawBoxSlotWallSpinBox.setValue(float(self._parameterNode.GetParameter("sawBoxSlotWall_mm")))
-    self.ui.biggerSawBoxDistanceToMandibleSpinBox.setValue(float(self._parameterNode.GetParameter("biggerSawBoxDistanceToMandible_mm")))
-    self.ui.mandibleTextLabelsDepthSpinBox.setValue(float(self._parameterNode.GetParameter("mandibleTextLabelsDepth_mm")))
-    self.ui.mandibleScrewHoleCylinderRadiusSpinBox.setValue(float(self._parameterNode.GetParameter("mandibleScrewHoleCylinderRadius_mm")))
-    self.ui.mandibleBridgeRadiusSpinBox.setValue(float(self._parameterNode.GetParameter("mandibleBridgeRadius_mm")))
-    self.ui.mandibleGuidebaseThicknessSpinBox.setValue(float(self._parameterNode.GetParameter("mandibleGuidebaseThickness_mm")))
-    self.ui.dentalImplantCylinderRadiusSpinBox.setValue(float(self._parameterNode.GetParameter("dentalImplantCylinderRadius_mm")))
-    self.ui.dentalImplantCylinderHeightSpinBox.setValue(float(self._parameterNode.GetParameter("dentalImplantCylinderHeight_mm")))
-    self.ui.dentalImplantDrillGuideWallSpinBox.setValue(float(self._parameterNode.GetParameter("dentalImplantDrillGuideWall_mm")))
-    self.ui.plateCrossSectionalWidthSpinBox.setValue(float(self._parameterNode.GetParameter("plateCrossSectionalWidth_mm")))
-    self.ui.plateCrossSectionalLengthSpinBox.setValue(float(self._parameterNode.GetParameter("plateCrossSectionalLength_mm")))
-    self.ui.plateCrossSectionalBevelRadiusPorcentageSpinBox.setValue(float(self._parameterNode.GetParameter("plateCrossSectionalBevelRadiusPorcentage")))
-    self.ui.plateTipsBevelRadiusSpinBox.setValue(float(self._parameterNode.GetParameter("plateTipsBevelRadius")))
-
-    self.ui.fibulaNormalizationTransformButton.checked = self._parameterNode.GetParameter("fibulaNormalizationTransform") == "True"
-    self.ui.makeAllMandiblePlanesRotateTogetherCheckBox.checked = self._parameterNode.GetParameter("makeAllMandiblePlanesRotateTogether") == "True"
-    self.ui.useMoreExactVersionOfPositioningAlgorithmCheckBox.checked = self._parameterNode.GetParameter("useMoreExactVersionOfPositioningAlgorithm") == "True"
-    self.ui.mandiblePlanesPositioningForMaximumBoneContactCheckBox.checked = self._parameterNode.GetParameter("mandiblePlanesPositioningForMaximumBoneContact") == "True"
-    
-    includeVesselsOnPlanChecked = self._parameterNode.GetParameter("includeVesselsOnPlan") == "True"
+    self.ui.initialSpinBox.setValue(parameterValues["initialSpace_mm"])
+    self.ui.betweenSpinBox.setValue(parameterValues["additionalBetweenSpaceOfFibulaPlanes_mm"])
+    self.ui.securityMarginOfFibulaPiecesSpinBox.setValue(parameterValues["securityMarginOfFibulaPieces_mm"])
+    self.ui.miterBoxSlotWidthSpinBox.setValue(parameterValues["miterBoxSlotWidth_mm"])
+    self.ui.miterBoxSlotLengthSpinBox.setValue(parameterValues["miterBoxSlotLength_mm"])
+    self.ui.miterBoxSlotHeightSpinBox.setValue(parameterValues["miterBoxSlotHeight_mm"])
+    self.ui.miterBoxSlotWallSpinBox.setValue(parameterValues["miterBoxSlotWall_mm"])
+    self.ui.fibulaScrewHoleCylinderRadiusSpinBox.setValue(parameterValues["fibulaScrewHoleCylinderRadius_mm"])
+    self.ui.clearanceFitPrintingToleranceSpinBox.setValue(parameterValues["clearanceFitPrintingTolerance_mm"])
+    self.ui.fibulaGuidebaseThicknessSpinBox.setValue(parameterValues["fibulaGuidebaseThickness_mm"])
+    self.ui.fibulaGuidebaseMarginSpinBox.setValue(parameterValues["fibulaGuidebaseMargin_mm"])
+    self.ui.fibulaGuidebaseAngleSpinBox.setValue(parameterValues["fibulaGuidebaseAngle_mm"])
+    self.ui.biggerMiterBoxDistanceToFibulaSpinBox.setValue(parameterValues["biggerMiterBoxDistanceToFibula_mm"])
+    self.ui.fibulaTextLabelsDepthSpinBox.setValue(parameterValues["fibulaTextLabelsDepth_mm"])
+    self.ui.sawBoxSlotWidthSpinBox.setValue(parameterValues["sawBoxSlotWidth_mm"])
+    self.ui.sawBoxSlotLengthSpinBox.setValue(parameterValues["sawBoxSlotLength_mm"])
+    self.ui.sawBoxSlotHeightSpinBox.setValue(parameterValues["sawBoxSlotHeight_mm"])
+    self.ui.sawBoxSlotWallSpinBox.setValue(parameterValues["sawBoxSlotWall_mm"])
+    self.ui.biggerSawBoxDistanceToMandibleSpinBox.setValue(parameterValues["biggerSawBoxDistanceToMandible_mm"])
+    self.ui.mandibleTextLabelsDepthSpinBox.setValue(parameterValues["mandibleTextLabelsDepth_mm"])
+    self.ui.mandibleScrewHoleCylinderRadiusSpinBox.setValue(parameterValues["mandibleScrewHoleCylinderRadius_mm"])
+    self.ui.mandibleBridgeRadiusSpinBox.setValue(parameterValues["mandibleBridgeRadius_mm"])
+    self.ui.mandibleGuidebaseThicknessSpinBox.setValue(parameterValues["mandibleGuidebaseThickness_mm"])
+    self.ui.dentalImplantCylinderRadiusSpinBox.setValue(parameterValues["dentalImplantCylinderRadius_mm"])
+    self.ui.dentalImplantCylinderHeightSpinBox.setValue(parameterValues["dentalImplantCylinderHeight_mm"])
+    self.ui.dentalImplantDrillGuideWallSpinBox.setValue(parameterValues["dentalImplantDrillGuideWall_mm"])
+    self.ui.plateCrossSectionalWidthSpinBox.setValue(parameterValues["plateCrossSectionalWidth_mm"])
+    self.ui.plateCrossSectionalLengthSpinBox.setValue(parameterValues["plateCrossSectionalLength_mm"])
+    self.ui.plateCrossSectionalBevelRadiusPorcentageSpinBox.setValue(parameterValues["plateCrossSectionalBevelRadiusPorcentage"])
+    self.ui.plateTipsBevelRadiusSpinBox.setValue(parameterValues["plateTipsBevelRadius"])
+
+    self.ui.fibulaNormalizationTransformButton.checked = parameterValues["fibulaNormalizationTransform"]
+    self.ui.makeAllMandiblePlanesRotateTogetherCheckBox.checked = parameterValues["makeAllMandiblePlanesRotateTogether"]
+    self.ui.useMoreExactVersionOfPositioningAlgorithmCheckBox.checked = parameterValues["useMoreExactVersionOfPositioningAlgorithm"]
+    self.ui.mandiblePlanesPositioningForMaximumBoneContactCheckBox.checked = parameterValues["mandiblePlanesPositioningForMaximumBoneContact"]
+    
+    includeVesselsOnPlanChecked = parameterValues["includeVesselsOnPlan"]
     self.ui.includeVesselsOnPlanCheckBox.checked = includeVesselsOnPlanChecked
     self.setOriginalAndTranslatedVesselsVisibility(includeVesselsOnPlanChecked)
 
-    useNonDecimatedModelsForPreviewChecked = self._parameterNode.GetParameter("useNonDecimatedModelsForPreview") == "True"
+    useNonDecimatedModelsForPreviewChecked = parameterValues["useNonDecimatedModelsForPreview"]
     self.ui.useNonDecimatedModelsForPreviewCheckBox.checked = useNonDecimatedModelsForPreviewChecked
     self.showInputModelsAsNonDecimated(useNonDecimatedModelsForPreviewChecked)
 
-    fibulaSurgicalGuideElementsVisible = self._parameterNode.GetParameter("fibulaSurgicalGuideElementsVisible") == "True"
+    fibulaSurgicalGuideElementsVisible = parameterValues["fibulaSurgicalGuideElementsVisible"]
     self.ui.fibulaSurgicalGuideElementsVisibleCheckBox.checked = fibulaSurgicalGuideElementsVisible
     self.setFibulaGuideBaseElementsVisibility(fibulaSurgicalGuideElementsVisible)
 
-    fibulaSurgicalGuideVisible = self._parameterNode.GetParameter("fibulaSurgicalGuideVisible") == "True"
+    fibulaSurgicalGuideVisible = parameterValues["fibulaSurgicalGuideVisible"]
     self.ui.fibulaSurgicalGuideVisibleCheckBox.checked = fibulaSurgicalGuideVisible
     self.setFibulaSurgicalGuideVisibility(fibulaSurgicalGuideVisible)
     self.ui.fibulaSurgicalGuideVisibleCheckBox.enabled = (
       self._parameterNode.GetNodeReference("fibulaSurgicalGuidePrototypeModel") is not None
     )
 
-    mandibleSurgicalGuideElementsVisible = self._parameterNode.GetParameter("mandibleSurgicalGuideElementsVisible") == "True"
+    mandibleSurgicalGuideElementsVisible = parameterValues["mandibleSurgicalGuideElementsVisible"]
     self.ui.mandibleSurgicalGuideElementsVisibleCheckBox.checked = mandibleSurgicalGuideElementsVisible
     self.setMandibleGuideBaseElementsVisibility(mandibleSurgicalGuideElementsVisible)
 
@@ -1531,48 +1725,48 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
       self._parameterNode.GetNodeReference("mandibleSurgicalGuidePrototypeModel") is not None
     )
 
-    if self._parameterNode.GetParameter("miterBoxesNeedUpdate") == "True":
+    if parameterValues["miterBoxesNeedUpdate"]:
       # always hide till the GUI feedback feature is complete
       self.ui.miterBoxesNeedUpdateLabel.hide()
       # self.ui.miterBoxesNeedUpdateLabel.show()
     else:
       self.ui.miterBoxesNeedUpdateLabel.hide()
 
-    if self._parameterNode.GetParameter("sawBoxesNeedUpdate") == "True":
+    if parameterValues["sawBoxesNeedUpdate"]:
       # always hide till the GUI feedback feature is complete
       # self.ui.sawBoxesNeedUpdateLabel.show()
       self.ui.sawBoxesNeedUpdateLabel.hide()
     else:
       self.ui.sawBoxesNeedUpdateLabel.hide()
 
-    useMandibleGuideBasesFromCurvesChecked = self._parameterNode.GetParameter("useMandibleGuideBasesFromCurves") == "True"
+    useMandibleGuideBasesFromCurvesChecked = parameterValues["useMandibleGuideBasesFromCurves"]
     self.ui.mandibleSurgicalGuideBaseSelector.enabled = not useMandibleGuideBasesFromCurvesChecked
     self.ui.useMandibleGuideBasesFromCurvesCheckBox.checked = useMandibleGuideBasesFromCurvesChecked
 
-    doDisplayOrientation3DCube = self._parameterNode.GetParameter("displayOrientation3DCube") == "True"
+    doDisplayOrientation3DCube = parameterValues["displayOrientation3DCube"]
     self.ui.orientation3DCubeCheckBox.checked = doDisplayOrientation3DCube
     displayOrientation3DCube(doDisplayOrientation3DCube)
     
-    self.ui.lightingModeComboBox.currentText = self._parameterNode.GetParameter("lightingMode")
-    setLightingMode(self._parameterNode.GetParameter("lightingMode"))
-    self.ui.lightingInterpolationMethodComboBox.currentText = self._parameterNode.GetParameter("lightingInterpolationMethod")
-    setModelsLightingInterpolationMethod(self._parameterNode.GetParameter("lightingInterpolationMethod"))
+    self.ui.lightingModeComboBox.currentText = parameterValues["lightingMode"]
+    setLightingMode(parameterValues["lightingMode"])
+    self.ui.lightingInterpolationMethodComboBox.currentText = parameterValues["lightingInterpolationMethod"]
+    setModelsLightingInterpolationMethod(parameterValues["lightingInterpolationMethod"])
 
     self.ui.makeModelsButton.enabled = (
       (self._parameterNode.GetNodeReference("mandibularSegmentation") is not None) and
       (self._parameterNode.GetNodeReference("fibulaSegmentation") is not None) and
-      (self._parameterNode.GetParameter("mandibularSegment") != "") and
-      (self._parameterNode.GetParameter("fibulaSegment") != "")
+      (parameterValues["mandibularSegment"] != "") and
+      (parameterValues["fibulaSegment"] != "")
     )
     
     checkSecurityMarginOnMiterBoxCreationChecked = self._parameterNode.GetParameter("checkSecurityMarginOnMiterBoxCreation") != "False"
     self.ui.checkSecurityMarginOnMiterBoxCreationCheckBox.checked = checkSecurityMarginOnMiterBoxCreationChecked
     self.ui.securityMarginOfFibulaPiecesFrame.enabled = checkSecurityMarginOnMiterBoxCreationChecked
 
-    self.ui.fibulaSegmentsMeasurementModeComboBox.currentText = self._parameterNode.GetParameter("fibulaSegmentsMeasurementMode")
+    self.ui.fibulaSegmentsMeasurementModeComboBox.currentText = parameterValues["fibulaSegmentsMeasurementMode"]
     
     self.ui.mandibleSideToRemoveComboBox.removeItem(2)
-    kindOfMandibleResection = self._parameterNode.GetParameter("kindOfMandibleResection")
+    kindOfMandibleResection = parameterValues["kindOfMandibleResection"]
     self.ui.kindOfMandibleResectionComboBox.currentText = kindOfMandibleResection
     if kindOfMandibleResection == "Segmental Mandibulectomy":
       self.ui.mandibleBridgeCurvePlaceWidget.enabled = True
@@ -1587,19 +1781,19 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
 
       self.ui.mandibleSideToRemoveComboBox.enabled = True
       self.ui.mandibleSideToRemoveComboBox.removeItem(2)
-      self.ui.mandibleSideToRemoveComboBox.currentText = self._parameterNode.GetParameter("mandibleSideToRemove")
+      self.ui.mandibleSideToRemoveComboBox.currentText = parameterValues["mandibleSideToRemove"]
 
 
     # TODO: finish implementation, probably needs turning around the fibula centerline support of miterBoxes
     self.ui.miterBoxesGuideTypeLabel.hide()
     self.ui.miterBoxesGuideTypeComboBox.hide()
-    self.ui.miterBoxesGuideTypeComboBox.currentText = self._parameterNode.GetParameter("miterBoxesGuideType")
+    self.ui.miterBoxesGuideTypeComboBox.currentText = parameterValues["miterBoxesGuideType"]
     self.ui.sawBoxesGuideTypeLabel.hide()
     self.ui.sawBoxesGuideTypeComboBox.hide()
-    self.ui.sawBoxesGuideTypeComboBox.currentText = self._parameterNode.GetParameter("sawBoxesGuideType")
+    self.ui.sawBoxesGuideTypeComboBox.currentText = parameterValues["sawBoxesGuideType"]
 
-    self.ui.fibulaTextLabelsModeComboBox.currentText = self._parameterNode.GetParameter("fibulaTextLabelsMode")
-    self.ui.mandibleTextLabelsModeComboBox.currentText = self._parameterNode.GetParameter("mandibleTextLabelsMode")
+    self.ui.fibulaTextLabelsModeComboBox.currentText = parameterValues["fibulaTextLabelsMode"]
+    self.ui.mandibleTextLabelsModeComboBox.currentText = parameterValues["mandibleTextLabelsMode"]
 
 
     #if self._parameterNode.GetParameter("miterBoxesGuideType") == "Slot":
@@ -1608,7 +1802,7 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     #else:
     #  self.ui.miterBoxesBoxTypeLabel.hide()
     #  self.ui.miterBoxesBoxTypeComboBox.hide()
-    self.ui.miterBoxesBoxTypeComboBox.currentText = self._parameterNode.GetParameter("miterBoxesBoxType")
+    self.ui.miterBoxesBoxTypeComboBox.currentText = parameterValues["miterBoxesBoxType"]
 
 
     #if self._parameterNode.GetParameter("sawBoxesGuideType") == "Slot":
@@ -1620,10 +1814,10 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     #self.ui.sawBoxesBoxTypeComboBox.currentText = self._parameterNode.GetParameter("sawBoxesBoxType")
 
     
-    AISegmentationsChecked = self._parameterNode.GetParameter("AISegmentations") == "True"
-    dentalImplantsPlanningAndFibulaDrillGuidesChecked = self._parameterNode.GetParameter("dentalImplantsPlanningAndFibulaDrillGuides") == "True"
-    customTitaniumPlateDesingChecked = self._parameterNode.GetParameter("customTitaniumPlateDesing") == "True"
-    makeAllDentalImplanCylindersParallelChecked = self._parameterNode.GetParameter("makeAllDentalImplanCylindersParallel") == "True"
+    AISegmentationsChecked = parameterValues["AISegmentations"]
+    dentalImplantsPlanningAndFibulaDrillGuidesChecked = parameterValues["dentalImplantsPlanningAndFibulaDrillGuides"]
+    customTitaniumPlateDesingChecked = parameterValues["customTitaniumPlateDesing"]
+    makeAllDentalImplanCylindersParallelChecked = parameterValues["makeAllDentalImplanCylindersParallel"]
     self.ui.AISegmentationsCheckBox.checked = AISegmentationsChecked
     self.ui.dentalImplantsPlanningAndFibulaDrillGuidesCheckBox.checked = dentalImplantsPlanningAndFibulaDrillGuidesChecked
     self.ui.customTitaniumPlateDesingCheckBox.checked = customTitaniumPlateDesingChecked
@@ -1650,17 +1844,17 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     else:
       self.ui.customTitaniumPlateGenerationCollapsibleButton.hide()
 
-    showInterCondylarBeamBoxChecked = self._parameterNode.GetParameter("showInterCondylarBeamBox") == "True"
+    showInterCondylarBeamBoxChecked = parameterValues["showInterCondylarBeamBox"]
     self.ui.interCondylarBeamVisibilityToolButton.checked = showInterCondylarBeamBoxChecked
     self.setInterCondylarBeamVisibility(showInterCondylarBeamBoxChecked)
 
-    lockVSPChecked = self._parameterNode.GetParameter("lockVSP") == "True"
+    lockVSPChecked = parameterValues["lockVSP"]
 
-    showMandiblePlanesChecked = self._parameterNode.GetParameter("showMandiblePlanes") == "True"
+    showMandiblePlanesChecked = parameterValues["showMandiblePlanes"]
     self.ui.showMandiblePlanesToolButton.checked = showMandiblePlanesChecked
     self.setMandiblePlanesVisibility(showMandiblePlanesChecked)
     
-    showMandiblePlanesInteractionHandlesChecked = self._parameterNode.GetParameter("showMandiblePlanesInteractionHandles") == "True"
+    showMandiblePlanesInteractionHandlesChecked = parameterValues["showMandiblePlanesInteractionHandles"]
     showMandiblePlanesInteractionHandles = (
       showMandiblePlanesChecked and showMandiblePlanesInteractionHandlesChecked and
       (not lockVSPChecked)
@@ -1674,7 +1868,7 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
       (not lockVSPChecked)
     )
     
-    inCameraPlaneInteractionHandlesChecked = self._parameterNode.GetParameter("inCameraPlaneInteractionHandles") == "True"
+    inCameraPlaneInteractionHandlesChecked = parameterValues["inCameraPlaneInteractionHandles"]
     inCameraPlaneInteractionHandles = (
       showMandiblePlanesChecked and 
       showMandiblePlanesInteractionHandlesChecked and 
@@ -1717,24 +1911,24 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
       self.ui.create3DModelOfTheReconstructionFrame.enabled = True
     
 
-    self.ui.neomandibleVisibilityButton.checked = self._parameterNode.GetParameter("neomandibleVisible") == "True"
+    self.ui.neomandibleVisibilityButton.checked = parameterValues["neomandibleVisible"]
 
 
-    if self._parameterNode.GetParameter("updateOnMandiblePlanesMovement") == "True":
+    if parameterValues["updateOnMandiblePlanesMovement"]:
       self.ui.generateFibulaPlanesFibulaBonePiecesAndTransformThemToMandibleButton.checkState = 2
     else:
       self.ui.generateFibulaPlanesFibulaBonePiecesAndTransformThemToMandibleButton.checkState = 0
 
-    if self._parameterNode.GetParameter("updateOnDentalImplantPlanesMovement") == "True":
+    if parameterValues["updateOnDentalImplantPlanesMovement"]:
       self.ui.updateFibulaDentalImplantCylindersButton.checkState = 2
     else:
       self.ui.updateFibulaDentalImplantCylindersButton.checkState = 0
 
-    showFibulaSegmentsLengthsChecked = self._parameterNode.GetParameter("showFibulaSegmentsLengths") == "True"
+    showFibulaSegmentsLengthsChecked = parameterValues["showFibulaSegmentsLengths"]
     self.ui.showFibulaSegmentsLengthsCheckBox.checked = showFibulaSegmentsLengthsChecked
     self.setFibulaSegmentsLengthsVisibility(showFibulaSegmentsLengthsChecked)
     
-    showOriginalMandibleChecked = self._parameterNode.GetParameter("showOriginalMandible") == "True"
+    showOriginalMandibleChecked = parameterValues["showOriginalMandible"]
     self.ui.showOriginalMandibleCheckBox.checked = showOriginalMandibleChecked
     self.setOriginalMandibleVisibility(showOriginalMandibleChecked)
 
@@ -1743,9 +1937,6 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     self.ui.planningInformativeLabel.text = self._parameterNode.GetParameter("planningInformativeText")
     self.ui.planningInformativeLabel.hide() # hide until new BRP version supports it fully
 
-    # All the GUI updates are done
-    self._updatingGUIFromParameterNode = False
-
   def updateParameterNodeFromGUI(self, caller=None, event=None):
     """
     This method is called when the user makes any change in the GUI.
@@ -1950,6 +2141,19 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     """
     self.logic.overwriteDefaultParameters()
 
+  def onExportGuidesAndPiecesButton(self):
+    folderPath = qt.QFileDialog.getExistingDirectory(None, "Select export folder")
+    if not folderPath:
+      return
+    fileFormat = self.ui.exportFileFormatComboBox.currentText.lower()
+    self.logic.exportSurgicalGuidesAndReconstructionPiecesToFolder(folderPath, fileFormat)
+
+  def onExportStageTimingsButton(self):
+    filePath = qt.QFileDialog.getSaveFileName(None, "Save processing timings trace", "BRPTimings.json", "JSON files (*.json)")
+    if not filePath:
+      return
+    self.logic.exportStageTimingsTrace(filePath)
+
   def onEmailBugReportButton(self):
     """
     Execute function to start an email client with an email draft about a bug
@@ -2005,6 +2209,12 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     Function to delete last mandible plane according to mandible curve index decreasing order
     """
     self.logic.removeCutPlane()
+
+  def onOptimizeMandiblePlanesButton(self):
+    """
+    Function to automatically place the mandible planes between the first and the last one
+    """
+    self.logic.optimizeMandiblePlanesPlacement(self.ui.numberOfFibulaSegmentsSpinBox.value)
   
   def processingLabelShow(self, show):
     """
@@ -2126,9 +2336,10 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     
     mandibularPlanesList = createListFromFolderName("Mandibular planes")
 
-    for i in range(len(mandibularPlanesList)):
-      displayNode = mandibularPlanesList[i].GetDisplayNode()
-      displayNode.SetVisibility(visibility)
+    setDisplayNodesProperties(
+      [mandibularPlane.GetDisplayNode() for mandibularPlane in mandibularPlanesList],
+      Visibility=visibility
+    )
 
   def setMarkupControlPointsVisibility(self, markupsNode, visibility):
     """
@@ -2179,39 +2390,18 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
     ):
       return
     
-    if nonDecimated:
-      nonDecimatedFibulaModelDisplayNode = nonDecimatedFibulaModelNode.GetDisplayNode()
-      decimatedFibulaModelDisplayNode = decimatedFibulaModelNode.GetDisplayNode()
-      nonDecimatedFibulaModelDisplayNode.SetVisibility(True)
-      decimatedFibulaModelDisplayNode.SetVisibility(False)
-
-      nonDecimatedMandibleModelDisplayNode =  nonDecimatedMandibleModelNode.GetDisplayNode()
-      decimatedMandibleModelDisplayNode = decimatedMandibleModelNode.GetDisplayNode()
-      nonDecimatedMandibleModelDisplayNode.SetVisibility(True and showOriginalMandibleChecked)
-      decimatedMandibleModelDisplayNode.SetVisibility(False)
-
-      if nonDecimatedVesselsModelNode and decimatedVesselsModelNode:
-        nonDecimatedVesselsModelDisplayNode = nonDecimatedVesselsModelNode.GetDisplayNode()
-        decimatedVesselsModelDisplayNode = decimatedVesselsModelNode.GetDisplayNode()
-        nonDecimatedVesselsModelDisplayNode.SetVisibility(True and includeVesselsOnPlanChecked)
-        decimatedVesselsModelDisplayNode.SetVisibility(False)
-      
-    else:
-      nonDecimatedFibulaModelDisplayNode = nonDecimatedFibulaModelNode.GetDisplayNode()
-      decimatedFibulaModelDisplayNode = decimatedFibulaModelNode.GetDisplayNode()
-      nonDecimatedFibulaModelDisplayNode.SetVisibility(False)
-      decimatedFibulaModelDisplayNode.SetVisibility(True)
-
-      nonDecimatedMandibleModelDisplayNode =  nonDecimatedMandibleModelNode.GetDisplayNode()
-      decimatedMandibleModelDisplayNode = decimatedMandibleModelNode.GetDisplayNode()
-      nonDecimatedMandibleModelDisplayNode.SetVisibility(False)
-      decimatedMandibleModelDisplayNode.SetVisibility(True and showOriginalMandibleChecked)
-
-      if nonDecimatedVesselsModelNode and decimatedVesselsModelNode:
-        nonDecimatedVesselsModelDisplayNode = nonDecimatedVesselsModelNode.GetDisplayNode()
-        decimatedVesselsModelDisplayNode = decimatedVesselsModelNode.GetDisplayNode()
-        nonDecimatedVesselsModelDisplayNode.SetVisibility(False)
-        decimatedVesselsModelDisplayNode.SetVisibility(True and includeVesselsOnPlanChecked)
+    displayStates = [
+      (nonDecimatedFibulaModelNode.GetDisplayNode(), {"Visibility": nonDecimated}),
+      (decimatedFibulaModelNode.GetDisplayNode(), {"Visibility": not nonDecimated}),
+      (nonDecimatedMandibleModelNode.GetDisplayNode(), {"Visibility": nonDecimated and showOriginalMandibleChecked}),
+      (decimatedMandibleModelNode.GetDisplayNode(), {"Visibility": (not nonDecimated) and showOriginalMandibleChecked}),
+    ]
+    if nonDecimatedVesselsModelNode and decimatedVesselsModelNode:
+      displayStates += [
+        (nonDecimatedVesselsModelNode.GetDisplayNode(), {"Visibility": nonDecimated and includeVesselsOnPlanChecked}),
+        (decimatedVesselsModelNode.GetDisplayNode(), {"Visibility": (not nonDecimated) and includeVesselsOnPlanChecked}),
+      ]
+    applyDisplayStates(displayStates)
     
     # and since the other models are created from them (e.g. dynamic modeler ones), they share the current visibility mode
     # after planning update
@@ -2286,7 +2476,7 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
       mandibleSurgicalGuideBase.GetDisplayNode().AddViewNodeID(mandibleViewNode.GetID())
       mandibleSurgicalGuideBase.GetDisplayNode().SetVisibility2D(True)
       moveNodeToFolder(mandibleSurgicalGuideBase, getFolder("BoneReconstructionPlanner"))
-      self.logic.setRedSliceForModelsDisplayNodes()
+      self.logic.setRedSliceForModelsDisplayNodes(updateInverseMandiblePieces=False)
       self.logic.setRedSliceForMarkupsDisplayNodes()
 
     bothSidesMandibleGuideBaseModel = self._parameterNode.GetNodeReference("bothSidesMandibleGuideBaseModel")
@@ -2296,7 +2486,7 @@ class BoneReconstructionPlannerWidget(ScriptedLoadableModuleWidget, VTKObservati
       bothSidesMandibleGuideBaseModel.GetDisplayNode().AddViewNodeID(mandibleViewNode.GetID())
       bothSidesMandibleGuideBaseModel.GetDisplayNode().SetVisibility2D(True)
       moveNodeToFolder(bothSidesMandibleGuideBaseModel, getFolder("BoneReconstructionPlanner"))
-      self.logic.setRedSliceForModelsDisplayNodes()
+      self.logic.setRedSliceForModelsDisplayNodes(updateInverseMandiblePieces=False)
       self.logic.setRedSliceForMarkupsDisplayNodes()
 
     mandibleBridgeTube = self._parameterNode.GetNodeReference("mandibleBridgeTube")
@@ -2455,6 +2645,9 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     self.fibulaLineInstructionsEventsObserversList = []
     self.mandibularCurveInstructionsEventsObserversList = []
     self.resectedMandibleAndObserver = []
+    self.inverseMandiblePiecesAreOutdated = True
+    self.transformedMandiblePiecesAreOutdated = True
+    self.decimatedModelsAreForcedForPreview = False
     self.planeNodeAndObserver = []
     # self.mandibleCurveModifiedObserver = 0 # TODO: could be implemented on the future
     self.interCondylarBeamLineControlPointDefinedObserver = 0
@@ -2489,37 +2682,97 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     self.updateFibuladentalImplantsTimer.setInterval(150)
     self.updateFibuladentalImplantsTimer.setSingleShot(True)
     self.updateFibuladentalImplantsTimer.connect('timeout()', self.onUpdateFibulaDentalImplantsTimerTimeout)
+    self.meshExporter = None
+    self.lastExportManifest = None
+    self.planVariantsEvaluation = None
+    self.planVariantsEvaluationFinishedCallback = None
+    self.lastPlanVariantsResults = None
+    self.planVariantsEvaluationTimer = qt.QTimer()
+    self.planVariantsEvaluationTimer.setInterval(100)
+    self.planVariantsEvaluationTimer.connect('timeout()', self.onPlanVariantsEvaluationTimerTimeout)
+    self.parameterValues = None
+    self.parameterValuesKey = None
 
   def setDefaultParameters(self, parameterNode):
     """
     Initialize parameter node with default settings.
     """
-    defaultParametersDict = readDefaultParameters()
-    for parameterName, parameterValue in defaultParametersDict.items():
+    parametersDict = {}
+    for parameterName, parameterValue in loadDefaultParameters().items():
       valueFromSettings = rs(parameterName)
       if valueFromSettings is None:
         ws(parameterName, parameterValue)
-        wp(parameterNode, parameterName, parameterValue)
+        parametersDict[parameterName] = parameterValue
       elif not parameterNode.GetParameter(parameterName):
-        wp(parameterNode, parameterName, valueFromSettings)
+        parametersDict[parameterName] = valueFromSettings
+    self.setParameterValues(parametersDict, parameterNode)
 
   def restoreDefaultParameters(self):
     """
     Restore parameterNode and settings to default parameters from the defaultParameters.json
     """
-    defaultParametersDict = readDefaultParameters()
-    parameterNode = self.getParameterNode()
+    defaultParametersDict = loadDefaultParameters()
     for parameterName, parameterValue in defaultParametersDict.items():
       ws(parameterName, parameterValue)
-      wp(parameterNode, parameterName, parameterValue)
+    self.setParameterValues(defaultParametersDict)
+
+  def setParameterValues(self, parametersDict, parameterNode=None):
+    """
+    Write several parameters to the parameterNode in a single batch so observers
+    (e.g. updateGUIFromParameterNode) are notified only once.
+    """
+    if parameterNode is None:
+      parameterNode = self.getParameterNode()
+    wasModified = parameterNode.StartModify()
+    try:
+      for parameterName, parameterValue in parametersDict.items():
+        wp(parameterNode, parameterName, parameterValue)
+    finally:
+      parameterNode.EndModify(wasModified)
+
+  def getParameterValues(self):
+    """
+    Return the values of all the parameters of defaultParameters.json converted to their types.
+    The strings of the parameterNode are parsed once per modification of the node, so the
+    returned dict is shared and must not be modified.
+    """
+    parameterNode = self.getParameterNode()
+    # inside StartModify/EndModify the modified time is not updated but the pending events are counted
+    parameterValuesKey = (
+      parameterNode.GetID(), parameterNode.GetMTime(), parameterNode.GetModifiedEventPending()
+    )
+    if self.parameterValuesKey != parameterValuesKey:
+      self.parameterValues = {
+        parameterName: parseParameterValue(parameterName, rp(parameterNode, parameterName))
+        for parameterName in loadDefaultParameters()
+      }
+      self.parameterValuesKey = parameterValuesKey
+    return self.parameterValues
+
+  def getParameterValue(self, parameterName):
+    """
+    Return the value of a parameter of the parameterNode converted to its type (see defaultParameters.json)
+    """
+    if parameterName in loadDefaultParameters():
+      return self.getParameterValues()[parameterName]
+    parameterNode = self.getParameterNode()
+    return parseParameterValue(parameterName, rp(parameterNode, parameterName))
+
+  def getBoolParameter(self, parameterName):
+    if parameterName in loadDefaultParameters():
+      return bool(self.getParameterValues()[parameterName])
+    parameterNode = self.getParameterNode()
+    return rp(parameterNode, parameterName) == "True"
+
+  def getFloatParameter(self, parameterName):
+    return float(self.getParameterValue(parameterName))
 
   def overwriteDefaultParameters(self):
     """
     Overwrite default settings to current values on the parameterNode
     """
-    defaultParametersDict = readDefaultParameters()
     parameterNode = self.getParameterNode()
-    for parameterName in defaultParametersDict.keys():
+    for parameterName in loadDefaultParameters().keys():
       valueFromParameterNode = rp(parameterNode, parameterName)
       ws(parameterName, valueFromParameterNode)
   
@@ -3152,6 +3405,10 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
     if mandibleBridgeCurve.GetNumberOfControlPoints() <= 1:
       return
+
+    inputsSignature = getInputsSignature(mandibleBridgeCurve, mandibleBridgeRadius)
+    if isDerivedModelUpToDate(mandibleBridgeTube, inputsSignature):
+      return
     
     if mandibleBridgeTube is None:
       # create the placeholder model
@@ -3178,6 +3435,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       False, mandibleBridgeRadius, 8, 5, True, 3, slicer.vtkMRMLMarkupsToModelNode.RawIndices, 
       None, slicer.vtkMRMLMarkupsToModelNode.MovingLeastSquares 
     )
+    setDerivedModelInputsSignature(mandibleBridgeTube, inputsSignature)
   
   def onFibulaFiducialsPointModified(self,sourceNode,event):
     fibulaCylindersModelsList = createListFromFolderName("Fibula Cylinders Models")
@@ -3292,6 +3550,20 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     parameterNode.SetNodeReferenceID("fibulaSegmentation", legsAISegmentation.GetID())
 
   def addCutPlane(self):
+    planeNode = self.createMandiblePlaneNode()
+
+    #conections
+    self.planeNodeAndObserver = [
+      planeNode,
+      planeNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointPositionDefinedEvent,self.onPlanePointAdded)
+    ]
+
+    #setup placement
+    slicer.modules.markups.logic().SetActiveListID(planeNode)
+    interactionNode = slicer.mrmlScene.GetNodeByID("vtkMRMLInteractionNodeSingleton")
+    interactionNode.SwitchToSinglePlaceMode()
+
+  def createMandiblePlaneNode(self):
     parameterNode = self.getParameterNode()
 
     colorIndexStr = parameterNode.GetParameter("colorIndex")
@@ -3333,16 +3605,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
     self.setRedSliceForMarkupsDisplayNodes()
 
-    #conections
-    self.planeNodeAndObserver = [
-      planeNode,
-      planeNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointPositionDefinedEvent,self.onPlanePointAdded)
-    ]
-
-    #setup placement
-    slicer.modules.markups.logic().SetActiveListID(planeNode)
-    interactionNode = slicer.mrmlScene.GetNodeByID("vtkMRMLInteractionNodeSingleton")
-    interactionNode.SwitchToSinglePlaceMode()
+    return planeNode
   
   def removeCutPlane(self):
     mandibularPlanesList = createListFromFolderName("Mandibular planes")
@@ -3431,97 +3694,46 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       self.updateRightSideMandibleGuideBaseModel()
 
   def updateLeftSideMandibleGuideBaseModel(self):
-    parameterNode = self.getParameterNode()
-    leftSideMandibleGuideBaseCurve = self.getLeftSideMandibleGuideBaseCurve()
-    mandibleModelNode = parameterNode.GetNodeReference("mandibleModelNode")
-    mandibleGuidebaseThickness = float(parameterNode.GetParameter("mandibleGuidebaseThickness_mm"))
-
-    leftSideMandibleGuideBaseModel = parameterNode.GetNodeReference("leftSideMandibleGuideBaseModel")
-    if leftSideMandibleGuideBaseModel is None:
-      leftSideMandibleGuideBaseModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode")
-      leftSideMandibleGuideBaseModel.SetName(slicer.mrmlScene.GetUniqueNameByString("leftSideMandibleGuideBaseModel"))
-      leftSideMandibleGuideBaseModel.CreateDefaultDisplayNodes()
-      parameterNode.SetNodeReferenceID("leftSideMandibleGuideBaseModel", leftSideMandibleGuideBaseModel.GetID())
-      mandibleViewNode = slicer.mrmlScene.GetSingletonNode(slicer.MANDIBLE_VIEW_SINGLETON_TAG, "vtkMRMLViewNode")
-      leftSideMandibleGuideBaseModel.GetDisplayNode().AddViewNodeID(mandibleViewNode.GetID())
-      leftSideMandibleGuideBaseModel.GetDisplayNode().SetVisibility2D(True)
-      moveNodeToFolder(leftSideMandibleGuideBaseModel, getFolder("BoneReconstructionPlanner"))
-      parameterNode.SetNodeReferenceID("leftSideMandibleGuideBaseModel", leftSideMandibleGuideBaseModel.GetID())
-
-    # Extract the patch of the mandible surface enclosed by the closed curve using a dynamic modeler Curve cut
-    curveCutModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", "temporalLeftSideMandibleGuideBaseCurveCutModel")
-    curveCutModel.CreateDefaultDisplayNodes()
-    curveCutModel.GetDisplayNode().SetVisibility(False)
-
-    dynamicModelerNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLDynamicModelerNode")
-    dynamicModelerNode.SetToolName("Curve cut")
-    dynamicModelerNode.SetNodeReferenceID("CurveCut.InputModel", mandibleModelNode.GetID())
-    dynamicModelerNode.SetNodeReferenceID("CurveCut.InputCurve", leftSideMandibleGuideBaseCurve.GetID())
-    dynamicModelerNode.SetNodeReferenceID("CurveCut.OutputInside", curveCutModel.GetID())
-    dynamicModelerNode.SetAttribute("CurveCut.StraightCut", "1")
-    slicer.modules.dynamicmodeler.logic().RunDynamicModelerTool(dynamicModelerNode)
-
-    curveCutPolyData = curveCutModel.GetPolyData()
-    if curveCutPolyData is None or curveCutPolyData.GetNumberOfPoints() == 0:
-      slicer.mrmlScene.RemoveNode(dynamicModelerNode)
-      slicer.mrmlScene.RemoveNode(curveCutModel)
-      return
-
-    # Compute the average normal of the curve-cut patch
-    curveCutModel.SetAndObservePolyData(calculateNormals(curveCutModel.GetPolyData()))
-    normalsArray = slicer.util.arrayFromModelPointData(curveCutModel, 'Normals')
-    averageNormal = np.mean(normalsArray, axis=0)
-    averageNormal = averageNormal/np.linalg.norm(averageNormal)
-
-    # Force the extrusion to point outward (away from the mandible), not into the bone.
-    # AutoOrientNormals is unreliable on open patches, so the sign of the averaged normal
-    # cannot be trusted; determine the outward direction geometrically instead.
-    outwardDirection = getCentroid(curveCutModel) - getCentroid(mandibleModelNode)
-    if np.dot(averageNormal, outwardDirection) < 0:
-      averageNormal = -averageNormal
-
-    # Extrude the patch along the average normal to give it the requested thickness
-    extrudeFilter = vtk.vtkLinearExtrusionFilter()
-    extrudeFilter.SetInputData(curveCutModel.GetPolyData())
-    extrudeFilter.SetExtrusionTypeToVectorExtrusion()
-    extrudeFilter.SetVector(averageNormal * mandibleGuidebaseThickness)
-    extrudeFilter.CappingOn()
-    extrudeFilter.Update()
-
-    leftSideMandibleGuideBaseModel.SetAndObservePolyData(calculateNormals(extrudeFilter.GetOutput()))
-
-    slicer.mrmlScene.RemoveNode(dynamicModelerNode)
-    slicer.mrmlScene.RemoveNode(curveCutModel)
-
-    self.updateBothMandibleGuideBaseModels()
+    self.updateMandibleGuideBaseModel(self.getLeftSideMandibleGuideBaseCurve(), "leftSideMandibleGuideBaseModel")
 
   def updateRightSideMandibleGuideBaseModel(self):
+    self.updateMandibleGuideBaseModel(self.getRightSideMandibleGuideBaseCurve(), "rightSideMandibleGuideBaseModel")
+
+  @timedStage()
+  def updateMandibleGuideBaseModel(self, mandibleGuideBaseCurve, mandibleGuideBaseModelReferenceRole):
+    """
+    Create the guide base of one side by extruding the patch of the mandible enclosed by mandibleGuideBaseCurve.
+    It is only regenerated if the curve, the mandible model or the thickness changed since the last time.
+    """
     parameterNode = self.getParameterNode()
-    rightSideMandibleGuideBaseCurve = self.getRightSideMandibleGuideBaseCurve()
     mandibleModelNode = parameterNode.GetNodeReference("mandibleModelNode")
     mandibleGuidebaseThickness = float(parameterNode.GetParameter("mandibleGuidebaseThickness_mm"))
 
-    rightSideMandibleGuideBaseModel = parameterNode.GetNodeReference("rightSideMandibleGuideBaseModel")
-    if rightSideMandibleGuideBaseModel is None:
-      rightSideMandibleGuideBaseModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode")
-      rightSideMandibleGuideBaseModel.SetName(slicer.mrmlScene.GetUniqueNameByString("rightSideMandibleGuideBaseModel"))
-      rightSideMandibleGuideBaseModel.CreateDefaultDisplayNodes()
-      parameterNode.SetNodeReferenceID("rightSideMandibleGuideBaseModel", rightSideMandibleGuideBaseModel.GetID())
+    mandibleGuideBaseModel = parameterNode.GetNodeReference(mandibleGuideBaseModelReferenceRole)
+    inputsSignature = getInputsSignature(mandibleGuideBaseCurve, mandibleModelNode, mandibleGuidebaseThickness)
+    if isDerivedModelUpToDate(mandibleGuideBaseModel, inputsSignature):
+      self.updateBothMandibleGuideBaseModels()
+      return
+
+    if mandibleGuideBaseModel is None:
+      mandibleGuideBaseModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode")
+      mandibleGuideBaseModel.SetName(slicer.mrmlScene.GetUniqueNameByString(mandibleGuideBaseModelReferenceRole))
+      mandibleGuideBaseModel.CreateDefaultDisplayNodes()
       mandibleViewNode = slicer.mrmlScene.GetSingletonNode(slicer.MANDIBLE_VIEW_SINGLETON_TAG, "vtkMRMLViewNode")
-      rightSideMandibleGuideBaseModel.GetDisplayNode().AddViewNodeID(mandibleViewNode.GetID())
-      rightSideMandibleGuideBaseModel.GetDisplayNode().SetVisibility2D(True)
-      moveNodeToFolder(rightSideMandibleGuideBaseModel, getFolder("BoneReconstructionPlanner"))
-      parameterNode.SetNodeReferenceID("rightSideMandibleGuideBaseModel", rightSideMandibleGuideBaseModel.GetID())
+      mandibleGuideBaseModel.GetDisplayNode().AddViewNodeID(mandibleViewNode.GetID())
+      mandibleGuideBaseModel.GetDisplayNode().SetVisibility2D(True)
+      moveNodeToFolder(mandibleGuideBaseModel, getFolder("BoneReconstructionPlanner"))
+      parameterNode.SetNodeReferenceID(mandibleGuideBaseModelReferenceRole, mandibleGuideBaseModel.GetID())
 
     # Extract the patch of the mandible surface enclosed by the closed curve using a dynamic modeler Curve cut
-    curveCutModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", "temporalRightSideMandibleGuideBaseCurveCutModel")
+    curveCutModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", "temporalMandibleGuideBaseCurveCutModel")
     curveCutModel.CreateDefaultDisplayNodes()
     curveCutModel.GetDisplayNode().SetVisibility(False)
 
     dynamicModelerNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLDynamicModelerNode")
     dynamicModelerNode.SetToolName("Curve cut")
     dynamicModelerNode.SetNodeReferenceID("CurveCut.InputModel", mandibleModelNode.GetID())
-    dynamicModelerNode.SetNodeReferenceID("CurveCut.InputCurve", rightSideMandibleGuideBaseCurve.GetID())
+    dynamicModelerNode.SetNodeReferenceID("CurveCut.InputCurve", mandibleGuideBaseCurve.GetID())
     dynamicModelerNode.SetNodeReferenceID("CurveCut.OutputInside", curveCutModel.GetID())
     dynamicModelerNode.SetAttribute("CurveCut.StraightCut", "1")
     slicer.modules.dynamicmodeler.logic().RunDynamicModelerTool(dynamicModelerNode)
@@ -3553,7 +3765,8 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     extrudeFilter.CappingOn()
     extrudeFilter.Update()
 
-    rightSideMandibleGuideBaseModel.SetAndObservePolyData(calculateNormals(extrudeFilter.GetOutput()))
+    mandibleGuideBaseModel.SetAndObservePolyData(calculateNormals(extrudeFilter.GetOutput()))
+    setDerivedModelInputsSignature(mandibleGuideBaseModel, inputsSignature)
 
     slicer.mrmlScene.RemoveNode(dynamicModelerNode)
     slicer.mrmlScene.RemoveNode(curveCutModel)
@@ -3575,6 +3788,11 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
         slicer.mrmlScene.RemoveNode(bothSidesMandibleGuideBaseModel)
       return
 
+    bothSidesMandibleGuideBaseModel = parameterNode.GetNodeReference("bothSidesMandibleGuideBaseModel")
+    inputsSignature = getInputsSignature(leftSideMandibleGuideBaseModel, rightSideMandibleGuideBaseModel)
+    if isDerivedModelUpToDate(bothSidesMandibleGuideBaseModel, inputsSignature):
+      return
+
     appendFilter = vtk.vtkAppendPolyData()
     
     if leftSideMandibleGuideBaseModel is not None:
@@ -3598,7 +3816,6 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
     finalPolyData = calculateNormals(combinedCleanedPolyData)
 
-    bothSidesMandibleGuideBaseModel = parameterNode.GetNodeReference("bothSidesMandibleGuideBaseModel")
     if bothSidesMandibleGuideBaseModel is None:
       # create the placeholder model
       bothSidesMandibleGuideBaseModel = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
@@ -3618,6 +3835,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       self.setRedSliceForMarkupsDisplayNodes()
     
     bothSidesMandibleGuideBaseModel.SetAndObservePolyData(finalPolyData)
+    setDerivedModelInputsSignature(bothSidesMandibleGuideBaseModel, inputsSignature)
   
   def onPlanePointAdded(self,sourceNode,event):
     parameterNode = self.getParameterNode()
@@ -3647,8 +3865,9 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
   
   def onPlaneModifiedSetTimer(self,sourceNode,event):
     parameterNode = self.getParameterNode()
-    updateOnMandiblePlanesMovementChecked = parameterNode.GetParameter("updateOnMandiblePlanesMovement") == "True"
-    makeAllMandiblePlanesRotateTogetherChecked = parameterNode.GetParameter("makeAllMandiblePlanesRotateTogether") == "True"
+    parameterValues = self.getParameterValues()
+    updateOnMandiblePlanesMovementChecked = parameterValues["updateOnMandiblePlanesMovement"]
+    makeAllMandiblePlanesRotateTogetherChecked = parameterValues["makeAllMandiblePlanesRotateTogether"]
     
     if makeAllMandiblePlanesRotateTogetherChecked and sourceNode != None:
       parameterNode.SetNodeReferenceID("mandiblePlaneOfRotation", sourceNode.GetID())
@@ -3656,32 +3875,30 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     if updateOnMandiblePlanesMovementChecked:
       self.generateFibulaPlanesTimer.start()
 
-  @saveExecutedMethodWithTelemetry
+  @saveExecutedMethodWithTelemetry(monitorMemory=True)
   def onGenerateFibulaPlanesTimerTimeout(self):
     parameterNode = self.getParameterNode()
+    parameterValues = self.getParameterValues()
     parameterNode.SetParameter("virtualPlanWasSuccessful", str(False))
     parameterNode.SetParameter("currentlyProcessing", str(True))
-    lockVSPChecked = parameterNode.GetParameter("lockVSP") == "True"
+    lockVSPChecked = parameterValues["lockVSP"]
     if lockVSPChecked:
       logging.info('VSP updates are locked. Please set "lockVSP" parameter to "False".')
       parameterNode.SetParameter("currentlyProcessing", str(False))
       return
     
-    import time
-    startTime = time.time()
     logging.info('Processing started')
 
     mandibularPlanesList = createListFromFolderName("Mandibular planes")
 
     parameterNode = self.getParameterNode()
-    mandiblePlanesPositioningForMaximumBoneContactChecked = parameterNode.GetParameter("mandiblePlanesPositioningForMaximumBoneContact") == "True"
-    makeAllMandiblePlanesRotateTogetherChecked = parameterNode.GetParameter("makeAllMandiblePlanesRotateTogether") == "True"
+    mandiblePlanesPositioningForMaximumBoneContactChecked = parameterValues["mandiblePlanesPositioningForMaximumBoneContact"]
+    makeAllMandiblePlanesRotateTogetherChecked = parameterValues["makeAllMandiblePlanesRotateTogether"]
     mandiblePlaneOfRotation = parameterNode.GetNodeReference("mandiblePlaneOfRotation")
     fibulaLine = parameterNode.GetNodeReference("fibulaLine")
 
     if len(mandibularPlanesList) == 0:
-      stopTime = time.time()
-      logging.info('Processing completed in {0:.2f} seconds\n'.format(stopTime-startTime))
+      logging.info('Processing completed in {0:.2f} seconds\n'.format(stageTimings.getCurrentStageElapsedTime()))
       parameterNode.SetParameter("currentlyProcessing", str(False))
       return    
   
@@ -3714,10 +3931,10 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     parameterNode.SetParameter("sawBoxesNeedUpdate", str(True))
     parameterNode.SetParameter("virtualPlanWasSuccessful", str(True))
 
-    stopTime = time.time()
-    logging.info('Processing completed in {0:.2f} seconds\n'.format(stopTime-startTime))
+    logging.info('Processing completed in {0:.2f} seconds\n'.format(stageTimings.getCurrentStageElapsedTime()))
     parameterNode.SetParameter("currentlyProcessing", str(False))
 
+  @timedStage()
   def transformMandiblePlanesZRotationToBeTheSameAsInputPlane(self,mandiblePlaneOfRotation):
     mandibularPlanesList = createListFromFolderName("Mandibular planes")
     mandiblePlanesTransformsFolder = getFolder("Mandible Planes Transforms")
@@ -3858,13 +4075,16 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       dentalImplantsPlane.RemoveObserver(self.dentalImplantPlaneObserversPlaneNodeIDAndTransformIDList[i][0])
     self.dentalImplantPlaneObserversPlaneNodeIDAndTransformIDList = []
 
+  @timedStage()
   def transformFibulaPlanes(self):
     parameterNode = self.getParameterNode()
+    parameterValues = self.getParameterValues()
     fibulaLine = parameterNode.GetNodeReference("fibulaLine")
-    initialSpace = float(parameterNode.GetParameter("initialSpace_mm"))
-    additionalBetweenSpaceOfFibulaPlanes = float(parameterNode.GetParameter("additionalBetweenSpaceOfFibulaPlanes_mm"))
+    initialSpace = parameterValues["initialSpace_mm"]
+    additionalBetweenSpaceOfFibulaPlanes = parameterValues["additionalBetweenSpaceOfFibulaPlanes_mm"]
     rightSideLegIsDonor = parameterNode.GetParameter("donorLeg") == "Right"
-    useMoreExactVersionOfPositioningAlgorithmChecked = parameterNode.GetParameter("useMoreExactVersionOfPositioningAlgorithm") == "True"
+    useMoreExactVersionOfPositioningAlgorithmChecked = parameterValues["useMoreExactVersionOfPositioningAlgorithm"]
+    positioningAlgorithmTolerance = parameterValues["positioningAlgorithmTolerance_mm"]
     fibulaModelNode = parameterNode.GetNodeReference("fibulaModelNode")
     planeList = createListFromFolderName("Mandibular planes")
     
@@ -3880,6 +4100,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     #NewPlanes position and distance
     self.fibulaPlanesPositionA = []
     self.fibulaPlanesPositionB = []
+    self.fibulaPlanesPositioningNumberOfIterations = []
     boneSegmentsDistance = []
 
     #Set up transform for intersections to measure betweenSpace
@@ -4018,46 +4239,28 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
           j += 1
 
       if useMoreExactVersionOfPositioningAlgorithmChecked:
-        intersectionsForCentroidCalculationFolder = getFolder("Intersections For Centroid Calculation")
-
         lineStartPos = self.fibulaPlanesPositionA.pop()
         lineEndPos = self.fibulaPlanesPositionB.pop()
 
-        numberOfRepetitionsOfPositioningAlgorithm = 5
-        for k in range(numberOfRepetitionsOfPositioningAlgorithm):
-          oldLineStartPos = lineStartPos
-          oldLineEndPos = lineEndPos
-
-          fibulaLineNorm = np.linalg.norm(lineEndPos-lineStartPos)
-          fibulaLineDirection = (lineEndPos-lineStartPos)/fibulaLineNorm
-
-          intersectionA = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Intersection A %d' % i)
-          intersectionB = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Intersection B %d' % i)
-          intersectionA.CreateDefaultDisplayNodes()
-          intersectionB.CreateDefaultDisplayNodes()
-          
-          moveNodeToFolder(intersectionA, intersectionsForCentroidCalculationFolder)
-          moveNodeToFolder(intersectionB, intersectionsForCentroidCalculationFolder)
-          
-          getIntersectionBetweenModelAnd1PlaneWithNormalAndOrigin(fibulaModelNode,fibulaLineDirection,lineStartPos,intersectionA)
-          getIntersectionBetweenModelAnd1PlaneWithNormalAndOrigin(fibulaModelNode,fibulaLineDirection,lineEndPos,intersectionB)
-          lineStartPos = getCentroid(intersectionA)
-          lineEndPos = getCentroid(intersectionB)
-
+        centeredLineStartPos, centeredLineEndPos, numberOfIterations, converged = centerLineInsideModel(
+          fibulaModelNode.GetPolyData(), lineStartPos, lineEndPos,
+          positioningAlgorithmTolerance, MAXIMUM_NUMBER_OF_ITERATIONS_OF_POSITIONING_ALGORITHM,
+          lineLength=boneSegmentsDistance[i]
+        )
+        if centeredLineStartPos is None:
+          logging.warning(f"Fibula segment {i} could not be centered on the fibula, its planes cut outside of it")
+        else:
+          lineStartPos, lineEndPos = centeredLineStartPos, centeredLineEndPos
           #Create fibula axis:
           fibulaX, fibulaY, fibulaZ, fibulaOrigin = self.createFibulaAxisFromFibulaLineAndRightSideLegChecked_2(lineStartPos,lineEndPos,rightSideLegIsDonor)
-          
-          lineEndPos = lineStartPos + boneSegmentsDistance[i]*fibulaZ
+        self.fibulaPlanesPositioningNumberOfIterations.append(numberOfIterations)
+        logging.info(f"Fibula segment {i} positioned in {numberOfIterations} iterations")
+        if not converged:
+          logging.warning(f"Fibula segment {i} positioning did not converge to {positioningAlgorithmTolerance}mm in {numberOfIterations} iterations")
 
-          error = np.linalg.norm(lineStartPos-oldLineStartPos) + np.linalg.norm(lineEndPos-oldLineEndPos)
-          if error < 0.01:# Unavoidable errors because of fibula bone shape are about 0.6-0.8mm
-            break
-        
         self.fibulaPlanesPositionA.append(lineStartPos)
         self.fibulaPlanesPositionB.append(lineEndPos)
 
-        removeFolder(intersectionsForCentroidCalculationFolder)
-
       mandibleToFibulaRegistrationTransformNode = slicer.vtkMRMLLinearTransformNode()
       mandibleToFibulaRegistrationTransformNode.SetName("Mandible2Fibula Registration Transform%d" % i)
       slicer.mrmlScene.AddNode(mandibleToFibulaRegistrationTransformNode)
@@ -4134,6 +4337,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
     removeFolder(intersectionsFolder)
   
+  @timedStage()
   def createFibulaPlanesFromMandiblePlanesAndFibulaAxis(self,mandiblePlanesList,fibulaPlanesList):
     fibulaPlanesFolder = getFolder("Fibula planes")
     for i in range(len(mandiblePlanesList)-1):
@@ -4242,6 +4446,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
     self.setRedSliceForMarkupsDisplayNodes()
 
+  @timedStage()
   def createAndUpdateDynamicModelerNodes(self):
     parameterNode = self.getParameterNode()
     #useNonDecimatedModelsForPreviewChecked = parameterNode.GetParameter("useNonDecimatedModelsForPreview") == "True"
@@ -4436,107 +4641,47 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
         for i in range(len(dynamicModelerNodesList)):
           dynamicModelerNodesList[i].SetNodeReferenceID("PlaneCut.InputModel", vesselsModelNode.GetID())
 
-    inversePlaneCutsList = createListFromFolderName("Inverse Plane Cuts")
-    inverseAppendList = createListFromFolderName("Inverse Append")
-    numberOfFibulaPieces = len(createListFromFolderName("Bone Plane Cuts")) -1
-    if (
-      (len(inversePlaneCutsList) != numberOfFibulaPieces) or
-      (len(inverseAppendList) != numberOfFibulaPieces)
-    ):
-      inverseMandibleReconstructionFolder = getFolder("Inverse mandible reconstruction", reset = True)
-      setFolderItemVisibility(inverseMandibleReconstructionFolder, False)
-      inversePlaneCutsFolder = getFolder("Inverse Plane Cuts", reset = True)
-      inverseAppendFolder = getFolder("Inverse Append", reset = True)
-      cutMandiblePiecesFolder = getFolder("Cut Mandible Pieces", reset = True)
-      fullMandiblesFolder = getFolder("Full Mandibles", reset = True)
+  def resetPlan(self):
+    removeFolder(getFolder("Fibula planes"))
+    removeFolder(getFolder("Bone Plane Cuts"))
+    removeFolder(getFolder("Cut Bones"))
+    removeFolder(getFolder("Transformed Fibula Pieces"))
+    removeFolder(getFolder("Vessels Plane Cuts"))
+    removeFolder(getFolder("Cut Vessels"))
+    removeFolder(getFolder("Transformed Vessels Pieces"))
+    #self.getParameterNode().SetParameter("fixCutGoesThroughTheMandibleTwiceCheckBoxChanged", str(True))
+  
+  @saveExecutedMethodWithTelemetry
+  def hardVSPUpdate(self):
+    self.resetPlan()
+    self.onGenerateFibulaPlanesTimerTimeout()
 
-      qt.QTimer.singleShot(0, lambda: setFolderItemVisibility(fullMandiblesFolder, 0))
+  @saveExecutedMethodWithTelemetry
+  def lockVSP(self, doLock):
+    parameterNode = self.getParameterNode()
+    parameterNode.SetParameter("lockVSP", str(doLock))
 
-      for i in range(len(planeList)-1):
-        modelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
-        modelNode.SetName("Mandible Segment {0}".format(i))
-        slicer.mrmlScene.AddNode(modelNode)
-        modelNode.CreateDefaultDisplayNodes()
-        modelDisplayNode = modelNode.GetDisplayNode()
-        modelDisplayNode.SetVisibility2D(True)
+  @timedStage()
+  def generateFibulaPlanesFibulaBonePiecesAndTransformThemToMandible(self):
+    parameterNode = self.getParameterNode()
+    parameterValues = self.getParameterValues()
+    useNonDecimatedModelsForPreviewChecked = parameterValues["useNonDecimatedModelsForPreview"]
+    nonDecimatedMandibleModelNode = parameterNode.GetNodeReference("mandibleModelNode")
+    decimatedMandibleModelNode = parameterNode.GetNodeReference("decimatedMandibleModelNode")
+    planeList = createListFromFolderName("Mandibular planes")
+    includeVesselsOnPlan = parameterValues["includeVesselsOnPlan"]
 
-        fullModelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
-        fullModelNode.SetName("Mandible {0}".format(i))
-        slicer.mrmlScene.AddNode(fullModelNode)
-        fullModelNode.CreateDefaultDisplayNodes()
-        fullModelDisplayNode = fullModelNode.GetDisplayNode()
-        fullModelDisplayNode.SetVisibility2D(True)
-
-        mandibleViewNode = slicer.mrmlScene.GetSingletonNode(slicer.MANDIBLE_VIEW_SINGLETON_TAG, "vtkMRMLViewNode")
-        modelDisplayNode.AddViewNodeID(mandibleViewNode.GetID())
-        fullModelDisplayNode.AddViewNodeID(mandibleViewNode.GetID())
-
-        #Set color of the model
-        aux = slicer.mrmlScene.GetNodeByID('vtkMRMLColorTableNodeFileMediumChartColors.txt')
-        colorTable = aux.GetLookupTable()
-        nColors = colorTable.GetNumberOfColors()
-        ind = int((nColors-1) - i)
-        colorwithalpha = colorTable.GetTableValue(ind)
-        color = [colorwithalpha[0],colorwithalpha[1],colorwithalpha[2]]
-        modelDisplayNode.SetColor(color)
-        fullModelDisplayNode.SetColor(color)
-
-        dynamicModelerNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLDynamicModelerNode")
-        dynamicModelerNode.SetToolName("Plane cut")
-        dynamicModelerNode.SetNodeReferenceID("PlaneCut.InputModel", mandibleModelNode.GetID())
-        dynamicModelerNode.AddNodeReferenceID("PlaneCut.InputPlane", planeList[i+1].GetID())
-        dynamicModelerNode.AddNodeReferenceID("PlaneCut.InputPlane", planeList[i].GetID()) 
-        dynamicModelerNode.SetNodeReferenceID("PlaneCut.OutputNegativeModel", modelNode.GetID())
-        dynamicModelerNode.SetAttribute("OperationType", "Difference")
-        #slicer.modules.dynamicmodeler.logic().RunDynamicModelerTool(dynamicModelerNode)
-        
-        dynamicModelerNode2 = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLDynamicModelerNode")
-        dynamicModelerNode2.SetToolName("Append")
-        dynamicModelerNode2.SetNodeReferenceID("Append.InputModel", mandibleModelNode.GetID())
-        dynamicModelerNode2.SetNodeReferenceID("Append.OutputModel", fullModelNode.GetID())
-
-        moveNodeToFolder(dynamicModelerNode, inversePlaneCutsFolder)
-        moveNodeToFolder(dynamicModelerNode2, inverseAppendFolder)
-        moveNodeToFolder(modelNode, cutMandiblePiecesFolder)
-        moveNodeToFolder(fullModelNode, fullMandiblesFolder)
-        
-    
-    else:
-      dynamicModelerNodesList = createListFromFolderName("Inverse Plane Cuts")
-      for i in range(len(dynamicModelerNodesList)):
-        dynamicModelerNodesList[i].SetNodeReferenceID("PlaneCut.InputModel", mandibleModelNode.GetID())
-
-      dynamicModelerNodesList = createListFromFolderName("Inverse Append")
-      for i in range(len(dynamicModelerNodesList)):
-        dynamicModelerNodesList[i].SetNodeReferenceID("Append.InputModel", mandibleModelNode.GetID())
-
-  def resetPlan(self):
-    removeFolder(getFolder("Fibula planes"))
-    removeFolder(getFolder("Bone Plane Cuts"))
-    removeFolder(getFolder("Cut Bones"))
-    removeFolder(getFolder("Transformed Fibula Pieces"))
-    removeFolder(getFolder("Vessels Plane Cuts"))
-    removeFolder(getFolder("Cut Vessels"))
-    removeFolder(getFolder("Transformed Vessels Pieces"))
-    #self.getParameterNode().SetParameter("fixCutGoesThroughTheMandibleTwiceCheckBoxChanged", str(True))
-  
-  @saveExecutedMethodWithTelemetry
-  def hardVSPUpdate(self):
-    self.resetPlan()
-    self.onGenerateFibulaPlanesTimerTimeout()
-
-  @saveExecutedMethodWithTelemetry
-  def lockVSP(self, doLock):
-    parameterNode = self.getParameterNode()
-    parameterNode.SetParameter("lockVSP", str(doLock))
-
-  def generateFibulaPlanesFibulaBonePiecesAndTransformThemToMandible(self):
-    parameterNode = self.getParameterNode()
-    useNonDecimatedModelsForPreviewChecked = parameterNode.GetParameter("useNonDecimatedModelsForPreview") == "True"
-    nonDecimatedMandibleModelNode = parameterNode.GetNodeReference("mandibleModelNode")
-    decimatedMandibleModelNode = parameterNode.GetNodeReference("decimatedMandibleModelNode")
-    planeList = createListFromFolderName("Mandibular planes")
-    includeVesselsOnPlan = parameterNode.GetParameter("includeVesselsOnPlan") == "True"
+    # only this update falls back to the decimated models, the user choice is kept on the parameter node
+    self.decimatedModelsAreForcedForPreview = (
+      useNonDecimatedModelsForPreviewChecked and
+      parameterValues["kindOfMandibleResection"] != "Hemimandibulectomy" and
+      not self.nonDecimatedPreviewFitsInMemoryBudget()
+    )
+    if self.decimatedModelsAreForcedForPreview:
+      message = "Decimated models are used for this preview update to stay within the memory budget"
+      logging.warning(message)
+      slicer.util.showStatusMessage(message, 5000)
+      useNonDecimatedModelsForPreviewChecked = False
 
     if useNonDecimatedModelsForPreviewChecked:
       mandibleModelNode = nonDecimatedMandibleModelNode
@@ -4567,7 +4712,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
     self.transformFibulaPlanes()
 
-    kindOfMandibleResection = parameterNode.GetParameter("kindOfMandibleResection")
+    kindOfMandibleResection = parameterValues["kindOfMandibleResection"]
     if kindOfMandibleResection == "Hemimandibulectomy":
       # this is needed because otherwise decimation will make rendering of one mandible piece fail
       parameterNode.SetParameter("useNonDecimatedModelsForPreview", "True")
@@ -4578,7 +4723,8 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     
     self.updateVesselsPieces()
 
-    self.updateInverseMandiblePieces()
+    # computed on demand by updateInverseMandiblePiecesIfOutdated
+    self.inverseMandiblePiecesAreOutdated = True
 
     self.tranformFibulaPiecesToMandible()
 
@@ -4587,11 +4733,13 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
     # self.tranformMandiblePiecesToFibula()
 
-    self.setRedSliceForModelsDisplayNodes()
+    # the inverse mandible pieces stay outdated until a consumer needs them
+    self.setRedSliceForModelsDisplayNodes(updateInverseMandiblePieces=False)
     self.setRedSliceForMarkupsDisplayNodes()
 
-    self.updateNormalizationFibulaLineTransform(None)
+    self.updateNormalizationFibulaLineTransform(None, updateInverseMandiblePieces=False)
 
+  @timedStage()
   def reorderMandiblePlanes(self):
     planeList = createListFromFolderName("Mandibular planes")
     parameterNode = self.getParameterNode()
@@ -4661,7 +4809,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     removeFolder(getFolder("Mandibular planes"))
     renameFolder(mandibularPlanesFolder2,"Mandibular planes")
 
-  def setRedSliceForModelsDisplayNodes(self):
+  def setRedSliceForModelsDisplayNodes(self, updateInverseMandiblePieces=True):
     parameterNode = self.getParameterNode()
     scalarVolume = parameterNode.GetNodeReference("currentScalarVolume")
     fibulaCentroidX = parameterNode.GetParameter("fibulaCentroidX")
@@ -4674,6 +4822,9 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     if fibulaCentroidX == "":
       return
 
+    if updateInverseMandiblePieces:
+      self.updateInverseMandiblePiecesIfOutdated()
+
     fibulaCentroid = np.array([float(fibulaCentroidX),float(fibulaCentroidY),float(fibulaCentroidZ)])
     mandibleCentroid = np.array([float(mandibleCentroidX),float(mandibleCentroidY),float(mandibleCentroidZ)])
 
@@ -4840,7 +4991,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     vtk.vtkMatrix4x4.Multiply4x4(axes2ToWorldChangeOfFrameMatrix, worldToAxes1ChangeOfFrameMatrix, axes1ToAxes2RegistrationTransformMatrix)
     return axes1ToAxes2RegistrationTransformMatrix
 
-  @saveExecutedMethodWithTelemetry
+  @saveExecutedMethodWithTelemetry(monitorMemory=True)
   def makeModels(self):
     setBRPLayout()
     slicer.util.resetSliceViews()
@@ -4907,7 +5058,8 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
               "method": "FastQuadric"
               }
 
-      slicer.cli.runSync(slicer.modules.decimation, parameters=param)
+      with stageTimings.stage("decimation"):
+        slicer.cli.runSync(slicer.modules.decimation, parameters=param)
 
       moveNodeToFolder(models[i], segmentationModelsFolder)
       moveNodeToFolder(decimatedModels[i], segmentationModelsFolder)
@@ -4964,7 +5116,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     if vesselsSegmentation is not None and vesselsSegment != "":
       decimatedVesselsModelNode.SetAndObserveMesh(calculateNormals(decimatedVesselsModelNode.GetMesh()))
 
-    self.autocreateFibulaLine(fibulaSegmentID, fibulaSegmentation)
+    self.autocreateFibulaLine(fibulaSegmentID, fibulaSegmentation, fibulaModelNode)
 
     parameterNode.EndModify(wasModified)
 
@@ -4973,36 +5125,47 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
     parameterNode.SetParameter("currentlyProcessing", str(False))
 
-  def autocreateFibulaLine(self, segmentID, segmentationNode):
-    obbOrigin, obbDiameters, principalZAxis = getSegmentStatistics(segmentID, segmentationNode)
-
-    safeDistanceToFibulaTip = float(self.getParameterNode().GetParameter("safeDistanceToFibulaTip_mm"))
+  def autocreateFibulaLine(self, segmentID, segmentationNode, fibulaModelNode=None):
+    """
+    Place the fibula line over the long axis of the fibula, keeping safeDistanceToFibulaTip_mm from both tips.
+    The axis is the principal axis of the points of fibulaModelNode; the oriented bounding box computed by
+    segment statistics over the labelmap is only used if no model is given.
+    """
+    safeDistanceToFibulaTip = self.getFloatParameter("safeDistanceToFibulaTip_mm")
 
     superiorDirection = np.array([0.,0.,1.])
-    # the next if expression body is not intuitive but its because of how segmentStatistics works
-    if vtk.vtkMath.Dot(principalZAxis, superiorDirection) > 0:
-      startPoint = obbOrigin
-      endPoint = obbOrigin + principalZAxis*obbDiameters[2]
-      fibulaFirstPoint = startPoint + principalZAxis*safeDistanceToFibulaTip
-      fibulaLastPoint = endPoint - principalZAxis*safeDistanceToFibulaTip
+    fibulaPolyData = fibulaModelNode.GetPolyData() if fibulaModelNode is not None else None
+    if fibulaPolyData is not None and fibulaPolyData.GetNumberOfPoints() >= 3:
+      centroid, principalAxis, minimumProjection, maximumProjection = getPrincipalAxisAndExtentFromPoints(
+        slicer.util.arrayFromModelPoints(fibulaModelNode)
+      )
+      if vtk.vtkMath.Dot(principalAxis, superiorDirection) < 0:
+        principalAxis = -principalAxis
+        minimumProjection, maximumProjection = -maximumProjection, -minimumProjection
+      startPoint = centroid + principalAxis*minimumProjection
+      endPoint = centroid + principalAxis*maximumProjection
+      fibulaFirstPoint = startPoint + principalAxis*safeDistanceToFibulaTip
+      fibulaLastPoint = endPoint - principalAxis*safeDistanceToFibulaTip
     else:
-      startPoint = obbOrigin + principalZAxis*obbDiameters[2]
-      endPoint = obbOrigin
-      fibulaFirstPoint = startPoint - principalZAxis*safeDistanceToFibulaTip
-      fibulaLastPoint = endPoint + principalZAxis*safeDistanceToFibulaTip
-
-    print("principalZAxis: " + str(principalZAxis))
-    print("obbDiameters[2]: " + str(obbDiameters[2]))
-    print("obbOrigin: " + str(obbOrigin))
-    print("startPoint: " + str(startPoint))
-    print("endPoint: " + str(endPoint))
-    print("fibulaFirstPoint: " + str(fibulaFirstPoint))
-    print("fibulaLastPoint: " + str(fibulaLastPoint))
+      obbOrigin, obbDiameters, principalZAxis = getSegmentStatistics(segmentID, segmentationNode)
+
+      # the next if expression body is not intuitive but its because of how segmentStatistics works
+      if vtk.vtkMath.Dot(principalZAxis, superiorDirection) > 0:
+        startPoint = obbOrigin
+        endPoint = obbOrigin + principalZAxis*obbDiameters[2]
+        fibulaFirstPoint = startPoint + principalZAxis*safeDistanceToFibulaTip
+        fibulaLastPoint = endPoint - principalZAxis*safeDistanceToFibulaTip
+      else:
+        startPoint = obbOrigin + principalZAxis*obbDiameters[2]
+        endPoint = obbOrigin
+        fibulaFirstPoint = startPoint - principalZAxis*safeDistanceToFibulaTip
+        fibulaLastPoint = endPoint + principalZAxis*safeDistanceToFibulaTip
 
     self.getFibulaLine().RemoveAllControlPoints()
     self.getFibulaLine().AddControlPoint(fibulaFirstPoint)
     self.getFibulaLine().AddControlPoint(fibulaLastPoint)
   
+  @timedStage()
   def updateFibulaPieces(self):
     planeCutsList = createListFromFolderName("Bone Plane Cuts")
     for i in range(len(planeCutsList)):
@@ -5021,13 +5184,13 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     self.filterOutUnconnectedModelPiecesAccordingToKindOfMandibleResection(resectedMandibleModel)
 
   def filterOutUnconnectedModelPiecesAccordingToKindOfMandibleResection(self, modelPieces):
-    parameterNode = self.getParameterNode()
-    kindOfMandibleResection = parameterNode.GetParameter("kindOfMandibleResection")
+    parameterValues = self.getParameterValues()
+    kindOfMandibleResection = parameterValues["kindOfMandibleResection"]
     if kindOfMandibleResection == "Segmental Mandibulectomy":
       return
     elif kindOfMandibleResection == "Hemimandibulectomy":
       rightMandiblePlane, leftMandiblePlane = self.getRightAndLeftMandibleResectionPlanes()
-      mandibleSideToRemove = parameterNode.GetParameter("mandibleSideToRemove")
+      mandibleSideToRemove = parameterValues["mandibleSideToRemove"]
       if mandibleSideToRemove == "Removing right side":
         nearestPlane = leftMandiblePlane
       elif mandibleSideToRemove == "Removing left side":
@@ -5049,10 +5212,11 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       #
       modelPieces.SetAndObservePolyData(calculateNormals(closestRegion))
 
+  @timedStage()
   def updateVesselsPieces(self):
-    parameterNode = self.getParameterNode()
+    parameterValues = self.getParameterValues()
     
-    includeVesselsOnPlan = parameterNode.GetParameter("includeVesselsOnPlan") == "True"
+    includeVesselsOnPlan = parameterValues["includeVesselsOnPlan"]
     if not includeVesselsOnPlan:
       return
     
@@ -5060,6 +5224,114 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     for i in range(len(vesselsPlaneCutsList)):
       slicer.modules.dynamicmodeler.logic().RunDynamicModelerTool(vesselsPlaneCutsList[i])
 
+  def createAndUpdateInverseMandiblePiecesDynamicModelerNodes(self):
+    planeList = createListFromFolderName("Mandibular planes")
+    mandibleModelNode = self.getCurrentMandibleModel()
+
+    inversePlaneCutsList = createListFromFolderName("Inverse Plane Cuts")
+    inverseAppendList = createListFromFolderName("Inverse Append")
+    numberOfFibulaPieces = len(createListFromFolderName("Bone Plane Cuts")) -1
+    if (
+      (len(inversePlaneCutsList) != numberOfFibulaPieces) or
+      (len(inverseAppendList) != numberOfFibulaPieces)
+    ):
+      inverseMandibleReconstructionFolder = getFolder("Inverse mandible reconstruction", reset = True)
+      setFolderItemVisibility(inverseMandibleReconstructionFolder, False)
+      inversePlaneCutsFolder = getFolder("Inverse Plane Cuts", reset = True)
+      inverseAppendFolder = getFolder("Inverse Append", reset = True)
+      cutMandiblePiecesFolder = getFolder("Cut Mandible Pieces", reset = True)
+      fullMandiblesFolder = getFolder("Full Mandibles", reset = True)
+
+      qt.QTimer.singleShot(0, lambda: setFolderItemVisibility(fullMandiblesFolder, 0))
+
+      for i in range(len(planeList)-1):
+        modelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
+        modelNode.SetName("Mandible Segment {0}".format(i))
+        slicer.mrmlScene.AddNode(modelNode)
+        modelNode.CreateDefaultDisplayNodes()
+        modelDisplayNode = modelNode.GetDisplayNode()
+        modelDisplayNode.SetVisibility2D(True)
+
+        fullModelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
+        fullModelNode.SetName("Mandible {0}".format(i))
+        slicer.mrmlScene.AddNode(fullModelNode)
+        fullModelNode.CreateDefaultDisplayNodes()
+        fullModelDisplayNode = fullModelNode.GetDisplayNode()
+        fullModelDisplayNode.SetVisibility2D(True)
+
+        mandibleViewNode = slicer.mrmlScene.GetSingletonNode(slicer.MANDIBLE_VIEW_SINGLETON_TAG, "vtkMRMLViewNode")
+        modelDisplayNode.AddViewNodeID(mandibleViewNode.GetID())
+        fullModelDisplayNode.AddViewNodeID(mandibleViewNode.GetID())
+
+        #Set color of the model
+        aux = slicer.mrmlScene.GetNodeByID('vtkMRMLColorTableNodeFileMediumChartColors.txt')
+        colorTable = aux.GetLookupTable()
+        nColors = colorTable.GetNumberOfColors()
+        ind = int((nColors-1) - i)
+        colorwithalpha = colorTable.GetTableValue(ind)
+        color = [colorwithalpha[0],colorwithalpha[1],colorwithalpha[2]]
+        modelDisplayNode.SetColor(color)
+        fullModelDisplayNode.SetColor(color)
+
+        dynamicModelerNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLDynamicModelerNode")
+        dynamicModelerNode.SetToolName("Plane cut")
+        dynamicModelerNode.SetNodeReferenceID("PlaneCut.InputModel", mandibleModelNode.GetID())
+        dynamicModelerNode.AddNodeReferenceID("PlaneCut.InputPlane", planeList[i+1].GetID())
+        dynamicModelerNode.AddNodeReferenceID("PlaneCut.InputPlane", planeList[i].GetID()) 
+        dynamicModelerNode.SetNodeReferenceID("PlaneCut.OutputNegativeModel", modelNode.GetID())
+        dynamicModelerNode.SetAttribute("OperationType", "Difference")
+        #slicer.modules.dynamicmodeler.logic().RunDynamicModelerTool(dynamicModelerNode)
+        
+        dynamicModelerNode2 = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLDynamicModelerNode")
+        dynamicModelerNode2.SetToolName("Append")
+        dynamicModelerNode2.SetNodeReferenceID("Append.InputModel", mandibleModelNode.GetID())
+        dynamicModelerNode2.SetNodeReferenceID("Append.OutputModel", fullModelNode.GetID())
+
+        moveNodeToFolder(dynamicModelerNode, inversePlaneCutsFolder)
+        moveNodeToFolder(dynamicModelerNode2, inverseAppendFolder)
+        moveNodeToFolder(modelNode, cutMandiblePiecesFolder)
+        moveNodeToFolder(fullModelNode, fullMandiblesFolder)
+        
+    
+    else:
+      dynamicModelerNodesList = createListFromFolderName("Inverse Plane Cuts")
+      for i in range(len(dynamicModelerNodesList)):
+        dynamicModelerNodesList[i].SetNodeReferenceID("PlaneCut.InputModel", mandibleModelNode.GetID())
+
+      dynamicModelerNodesList = createListFromFolderName("Inverse Append")
+      for i in range(len(dynamicModelerNodesList)):
+        dynamicModelerNodesList[i].SetNodeReferenceID("Append.InputModel", mandibleModelNode.GetID())
+
+  def updateInverseMandiblePiecesIfOutdated(self, transformToFibula=False):
+    """
+    The inverse mandible pieces (the mandible cut by each pair of planes) and their copies over the fibula
+    are not needed during interactive planning, so the VSP only marks them as outdated. Call this before
+    using them to compute the ones that are outdated. Copies over the fibula that already exist are kept
+    up to date even if transformToFibula is not set.
+    """
+    if len(createListFromFolderName("Bone Plane Cuts")) == 0:
+      return
+
+    piecesWereUpdated = False
+    if self.inverseMandiblePiecesAreOutdated:
+      self.createAndUpdateInverseMandiblePiecesDynamicModelerNodes()
+      self.updateInverseMandiblePieces()
+      self.inverseMandiblePiecesAreOutdated = False
+      self.transformedMandiblePiecesAreOutdated = True
+      piecesWereUpdated = True
+
+    transformedMandiblePiecesExist = len(createListFromFolderName("Transformed Mandible Pieces")) > 0
+    if (transformToFibula or transformedMandiblePiecesExist) and self.transformedMandiblePiecesAreOutdated:
+      self.tranformMandiblePiecesToFibula()
+      self.transformedMandiblePiecesAreOutdated = False
+      piecesWereUpdated = True
+
+    if piecesWereUpdated:
+      # new pieces need the same slice views and fibula normalization transform as the rest of the plan
+      self.setRedSliceForModelsDisplayNodes()
+      self.updateNormalizationFibulaLineTransform(None)
+
+  @timedStage()
   def updateInverseMandiblePieces(self):
     inversePlaneCutsList = createListFromFolderName("Inverse Plane Cuts")
     for i in range(len(inversePlaneCutsList)):
@@ -5069,6 +5341,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     for i in range(len(inverseAppendList)):
       slicer.modules.dynamicmodeler.logic().RunDynamicModelerTool(inverseAppendList[i])
 
+  @timedStage()
   def tranformMandiblePiecesToFibula(self):
     mandible2FibulaTransformsList = createListFromFolderName("Mandible2Fibula transforms")
     transformedMandiblePiecesFolder = getFolder("Transformed Mandible Pieces", reset = True)
@@ -5114,6 +5387,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
     qt.QTimer.singleShot(0, lambda: setFolderItemVisibility(transformedFullMandiblesFolder, 1))
 
+  @timedStage()
   def tranformFibulaPiecesToMandible(self):
     parameterNode = self.getParameterNode()
     fibulaLine = parameterNode.GetNodeReference("fibulaLine")
@@ -5160,6 +5434,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       moveNodeToFolder(transformedFibulaPiece, transformedFibulaPiecesFolder)
       moveNodeToFolder(fibulaPieceToMandibleAxisTransformNode, bonePiecesTransformFolder)
 
+  @timedStage()
   def tranformVesselsPiecesToMandible(self):
     vesselsPiecesTransformFolder = getFolder("Vessels Pieces Transforms", reset = True)
     transformedVesselsPiecesFolder = getFolder("Transformed Vessels Pieces", reset = True)
@@ -5256,6 +5531,210 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     
     removeFolder(mandiblePlaneTransformsFolder)
   
+  def getPlanInputs(self):
+    """
+    Copy the inputs of the plan that the mandible planes placement depends on to numpy arrays:
+    mandibular curve points, resected mandible bone points, fibula radius and available fibula
+    length, spacing parameters and the current planes positions over the curve (as arc lengths).
+    The returned dict does not reference any MRML node so it can be used by worker processes.
+    """
+    parameterNode = self.getParameterNode()
+    mandibularCurve = parameterNode.GetNodeReference("mandibleCurve")
+    fibulaLine = parameterNode.GetNodeReference("fibulaLine")
+    mandibleModelNode = parameterNode.GetNodeReference("decimatedMandibleModelNode")
+    fibulaModelNode = parameterNode.GetNodeReference("decimatedFibulaModelNode")
+    minimumSegmentLength = self.getFloatParameter("minimumFibulaSegmentLength_mm")
+    safeDistanceToFibulaTip = self.getFloatParameter("safeDistanceToFibulaTip_mm")
+    initialSpace = self.getFloatParameter("initialSpace_mm")
+    additionalBetweenSpaceOfFibulaPlanes = self.getFloatParameter("additionalBetweenSpaceOfFibulaPlanes_mm")
+    planeList = createListFromFolderName("Mandibular planes")
+
+    if (
+      mandibularCurve is None or fibulaLine is None or
+      mandibleModelNode is None or fibulaModelNode is None or
+      fibulaLine.GetNumberOfControlPoints() < 2
+    ):
+      slicer.util.errorDisplay("Please create the bone models, the mandibular curve and the fibula line first.")
+      return None
+    if len(planeList) < 2:
+      slicer.util.errorDisplay("Please add at least the first and the last mandible planes (the resection margins) first.")
+      return None
+
+    curvePoints = slicer.util.arrayFromMarkupsCurvePoints(mandibularCurve, world=True).astype(float)
+    cumulativeArcLengths = getCumulativeArcLengths(curvePoints)
+    planesArcLengths = []
+    for planeNode in planeList:
+      origin = np.zeros(3)
+      planeNode.GetOrigin(origin)
+      planesArcLengths.append(getArcLengthOfClosestCurvePoint(curvePoints, cumulativeArcLengths, origin))
+    planesArcLengths = np.array(planesArcLengths)
+    startArcLength = planesArcLengths.min()
+    endArcLength = planesArcLengths.max()
+
+    lineStartPosition = np.zeros(3)
+    lineEndPosition = np.zeros(3)
+    fibulaLine.GetNthControlPointPositionWorld(0, lineStartPosition)
+    fibulaLine.GetNthControlPointPositionWorld(1, lineEndPosition)
+    fibulaRadius, availableFibulaLength = getFibulaRadiusAndAvailableLength(
+      slicer.util.arrayFromModelPoints(fibulaModelNode).astype(float),
+      lineStartPosition, lineEndPosition, safeDistanceToFibulaTip
+    )
+    if fibulaRadius is None:
+      slicer.util.errorDisplay("The fibula line does not go through the fibula model.")
+      return None
+
+    mandiblePoints = slicer.util.arrayFromModelPoints(mandibleModelNode).astype(float)
+    resectedBonePoints = getPointsAlongCurveSection(
+      mandiblePoints, curvePoints, cumulativeArcLengths, startArcLength, endArcLength, 4*fibulaRadius
+    )
+
+    return {
+      "curvePoints": curvePoints,
+      "resectedBonePoints": resectedBonePoints,
+      "planesArcLengths": planesArcLengths,
+      "startArcLength": startArcLength,
+      "endArcLength": endArcLength,
+      "fibulaRadius": fibulaRadius,
+      "availableFibulaLength": availableFibulaLength,
+      "minimumSegmentLength": minimumSegmentLength,
+      "initialSpace": initialSpace,
+      "betweenSpace": additionalBetweenSpaceOfFibulaPlanes,
+    }
+
+  @saveExecutedMethodWithTelemetry
+  def optimizeMandiblePlanesPlacement(self, numberOfSegments):
+    """
+    Place the inner mandible planes between the first and the last ones (the resection margins)
+    so that the fibula segments maximize the contact with the resected mandible bone and follow
+    the mandibular curve while each segment is at least minimumFibulaSegmentLength_mm long and all
+    of them fit in the fibula keeping safeDistanceToFibulaTip_mm. Candidates are evaluated in
+    batches over arrays copied from the models, the scene is only modified to apply the best one.
+    Returns the metrics of the chosen placement.
+    """
+    updateOnMandiblePlanesMovementChecked = self.getBoolParameter("updateOnMandiblePlanesMovement")
+    planeList = createListFromFolderName("Mandibular planes")
+
+    if numberOfSegments < 1:
+      return None
+    planInputs = self.getPlanInputs()
+    if planInputs is None:
+      return None
+
+    curvePoints = planInputs["curvePoints"]
+    cumulativeArcLengths = getCumulativeArcLengths(curvePoints)
+    planesOrder = np.argsort(planInputs["planesArcLengths"])
+    availableFibulaLength = planInputs["availableFibulaLength"]
+
+    bestKnotsArcLengths, metrics = optimizeMandiblePlanesArcLengths(
+      curvePoints, planInputs["startArcLength"], planInputs["endArcLength"], numberOfSegments,
+      planInputs["resectedBonePoints"], planInputs["fibulaRadius"], planInputs["minimumSegmentLength"],
+      availableFibulaLength, planInputs["initialSpace"], planInputs["betweenSpace"],
+      initialKnotsArcLengths=np.sort(planInputs["planesArcLengths"])
+    )
+    if not metrics["feasible"]:
+      logging.warning(
+        "No placement of the mandible planes satisfies the minimum segment length and the available fibula length, "
+        "the closest one is applied"
+      )
+
+    origins = getCurvePointsAtArcLengths(curvePoints, cumulativeArcLengths, bestKnotsArcLengths)
+    normals = getBisectorNormals(origins)
+
+    self.removeMandiblePlaneObservers()
+
+    innerPlanes = [planeList[index] for index in planesOrder[1:-1]]
+    while len(innerPlanes) > numberOfSegments-1:
+      slicer.mrmlScene.RemoveNode(innerPlanes.pop())
+    while len(innerPlanes) < numberOfSegments-1:
+      innerPlanes.append(self.createMandiblePlaneNode())
+
+    for planeNode, origin, normal in zip(innerPlanes, origins[1:-1], normals):
+      self.setMandiblePlaneOriginAndNormal(planeNode, origin, normal)
+      for i in range(3):
+        planeNode.SetNthControlPointVisibility(i,False)
+
+    self.reorderMandiblePlanes()
+    self.addMandiblePlaneObservers()
+
+    logging.info(
+      f"Mandible planes placed after evaluating {metrics['numberOfEvaluatedCandidates']} candidates: "
+      f"bone contact {metrics['boneContact']:.2f}, segments lengths {np.round(metrics['segmentsLengths'], 1)} mm, "
+      f"needed fibula length {metrics['neededFibulaLength']:.1f} of {availableFibulaLength:.1f} mm"
+    )
+
+    if updateOnMandiblePlanesMovementChecked:
+      self.onGenerateFibulaPlanesTimerTimeout()
+
+    return metrics
+
+  def comparePlanVariants(self, variants, onFinished=None):
+    """
+    Evaluate alternative plans side by side without modifying the scene. Each variant is a dict with
+    a "name" and either a "numberOfSegments" (the planes placement is optimized for it) or the
+    "knotsArcLengths" of the planes over the mandibular curve. Variants are evaluated concurrently in
+    worker processes over a copy of the current plan inputs, this method returns at once and the GUI
+    stays responsive meanwhile. When all of them are done the metrics (segments lengths, bone contact,
+    pieces gaps, ...) are logged, kept in lastPlanVariantsResults and passed to onFinished(results),
+    in the same order as variants. Starting a new comparison cancels the running one.
+    Returns False if there is no plan to compare.
+    E.g. logic.comparePlanVariants([{"name": "3 segments", "numberOfSegments": 3}, {"name": "4 segments", "numberOfSegments": 4}])
+    """
+    planInputs = self.getPlanInputs()
+    if planInputs is None:
+      return False
+
+    variants = list(variants)
+    currentPlanIsIncluded = any(variant.get("name") == "Current plan" for variant in variants)
+    if not currentPlanIsIncluded:
+      variants.insert(0, {"name": "Current plan", "knotsArcLengths": np.sort(planInputs["planesArcLengths"]).tolist()})
+
+    self.cancelPlanVariantsComparison()
+    self.planVariantsEvaluation = PlanVariantsEvaluation(planInputs, variants)
+    self.planVariantsEvaluationFinishedCallback = onFinished
+    self.planVariantsEvaluationTimer.start()
+    return True
+
+  def isComparingPlanVariants(self):
+    return self.planVariantsEvaluation is not None
+
+  def cancelPlanVariantsComparison(self):
+    self.planVariantsEvaluationTimer.stop()
+    if self.planVariantsEvaluation is not None:
+      self.planVariantsEvaluation.cancel()
+    self.planVariantsEvaluation = None
+    self.planVariantsEvaluationFinishedCallback = None
+
+  def onPlanVariantsEvaluationTimerTimeout(self):
+    planVariantsEvaluation = self.planVariantsEvaluation
+    if planVariantsEvaluation is None:
+      self.planVariantsEvaluationTimer.stop()
+      return
+    try:
+      if not planVariantsEvaluation.update():
+        return
+    except Exception:
+      logging.exception("Plan variants comparison failed")
+      self.cancelPlanVariantsComparison()
+      return
+    onFinished = self.planVariantsEvaluationFinishedCallback
+    self.planVariantsEvaluationTimer.stop()
+    self.planVariantsEvaluation = None
+    self.planVariantsEvaluationFinishedCallback = None
+
+    results = planVariantsEvaluation.results
+    for result in results:
+      if "error" in result:
+        continue
+      logging.info(
+        f"{result['name']}: {result['numberOfSegments']} segments {np.round(result['segmentsLengths'], 1)} mm, "
+        f"bone contact {result['boneContact']:.2f}, pieces gaps {np.round(result['piecesGaps'], 1)} mm, "
+        f"fibula {result['neededFibulaLength']:.1f} of {result['availableFibulaLength']:.1f} mm"
+        + ("" if result["feasible"] else " (not feasible)")
+      )
+    self.lastPlanVariantsResults = results
+    if onFinished is not None:
+      onFinished(results)
+
   def setupMandiblePlaneStraightOverMandibleCurve(self,planeNode,temporalOrigin, mandibleCurve):
     closestCurvePoint = [0,0,0]
     closestCurvePointIndex = mandibleCurve.GetClosestPointPositionAlongCurveWorld(temporalOrigin,closestCurvePoint)
@@ -5263,6 +5742,13 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     mandibleCurve.GetCurvePointToWorldTransformAtPointIndex(closestCurvePointIndex,matrix)
     mandiblePlaneStraightOrigin = np.array([matrix.GetElement(0,3),matrix.GetElement(1,3),matrix.GetElement(2,3)])
     mandiblePlaneStraightZ = np.array([matrix.GetElement(0,2),matrix.GetElement(1,2),matrix.GetElement(2,2)])
+    self.planeNodeAndObserver[0].RemoveObserver(self.planeNodeAndObserver[1])
+    self.planeNodeAndObserver = []
+    self.setMandiblePlaneOriginAndNormal(planeNode, mandiblePlaneStraightOrigin, mandiblePlaneStraightZ)
+
+  def setMandiblePlaneOriginAndNormal(self, planeNode, origin, normal):
+    origin = np.array(origin)
+    mandiblePlaneStraightZ = np.array(normal)/np.linalg.norm(normal)
     mandiblePlaneStraightY = [0,0,0]
     posterior = [0,-1,0]
     vtk.vtkMath.Cross(mandiblePlaneStraightZ, posterior, mandiblePlaneStraightY)
@@ -5272,12 +5758,16 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     mandiblePlaneStraightX = mandiblePlaneStraightX/np.linalg.norm(mandiblePlaneStraightX)
     dx = 25#Numbers choosen so the planes are visible enough
     dy = 25
-    self.planeNodeAndObserver[0].RemoveObserver(self.planeNodeAndObserver[1])
-    self.planeNodeAndObserver = []
     planeNode.SetNormal(mandiblePlaneStraightZ)
-    planeNode.SetNthControlPointPosition(0,mandiblePlaneStraightOrigin)
-    planeNode.SetNthControlPointPosition(1,mandiblePlaneStraightOrigin + mandiblePlaneStraightX*dx)
-    planeNode.SetNthControlPointPosition(2,mandiblePlaneStraightOrigin + mandiblePlaneStraightY*dy)
+    if planeNode.GetNumberOfControlPoints() < 3:
+      planeNode.RemoveAllControlPoints()
+      planeNode.AddControlPoint(vtk.vtkVector3d(origin))
+      planeNode.AddControlPoint(vtk.vtkVector3d(origin + mandiblePlaneStraightX*dx))
+      planeNode.AddControlPoint(vtk.vtkVector3d(origin + mandiblePlaneStraightY*dy))
+      return
+    planeNode.SetNthControlPointPosition(0,origin)
+    planeNode.SetNthControlPointPosition(1,origin + mandiblePlaneStraightX*dx)
+    planeNode.SetNthControlPointPosition(2,origin + mandiblePlaneStraightY*dy)
 
   def createFibulaAxisFromFibulaLineAndRightSideLegChecked(self,fibulaLine,rightSideLegIsDonor):
     lineStartPos = np.zeros(3)
@@ -5372,64 +5862,15 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
     if checkSecurityMarginOnMiterBoxCreationChecked:
       cutBonesList = createListFromFolderName("Cut Bones")
-      duplicateFibulaBonePiecesModelsFolder = getFolder("Duplicate Fibula Bone Pieces")
-      duplicateFibulaBonePiecesTransformsFolder = getFolder("Duplicate Fibula Bone Pieces Transforms")
-      
-      for i in range(0,len(cutBonesList)-1):
-        duplicateFibulaPiece = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','Duplicate ' + cutBonesList[i].GetName())
-        duplicateFibulaPiece.CreateDefaultDisplayNodes()
-        duplicateFibulaPiece.CopyContent(cutBonesList[i])
-
-        moveNodeToFolder(duplicateFibulaPiece, duplicateFibulaBonePiecesModelsFolder)
-
-      duplicateFibulaBonePiecesList = createListFromFolderName("Duplicate Fibula Bone Pieces")
-
-      for i in range(1,len(duplicateFibulaBonePiecesList)):
-        lineStartPos = np.zeros(3)
-        lineEndPos = np.zeros(3)
-        fibulaPlanesList[i*2].GetOrigin(lineStartPos)
-        fibulaPlanesList[i*2 +1].GetOrigin(lineEndPos)
-        #Create fibula axis:
-        fibulaZ = (lineEndPos - lineStartPos)/np.linalg.norm(lineEndPos - lineStartPos)
-
-        duplicateFibulaPieceTransformNode = slicer.vtkMRMLLinearTransformNode()
-        duplicateFibulaPieceTransformNode.SetName("Duplicate Fibula Piece Transform {0}".format(i))
-        slicer.mrmlScene.AddNode(duplicateFibulaPieceTransformNode)
-
-        duplicateFibulaPieceTransform = vtk.vtkTransform()
-        duplicateFibulaPieceTransform.PostMultiply()
-        duplicateFibulaPieceTransform.Translate(-i*(securityMarginOfFibulaPieces + 1e-2)*fibulaZ)
-
-        duplicateFibulaPieceTransformNode.SetMatrixTransformToParent(duplicateFibulaPieceTransform.GetMatrix())
-
-        duplicateFibulaBonePiecesList[i].SetAndObserveTransformNodeID(duplicateFibulaPieceTransformNode.GetID())
-        duplicateFibulaBonePieceTransformationSuccess = duplicateFibulaBonePiecesList[i].HardenTransform()
-        if not (duplicateFibulaBonePieceTransformationSuccess):
-          Exception('Hardening transforms was not successful')
-
-        moveNodeToFolder(duplicateFibulaPieceTransformNode, duplicateFibulaBonePiecesTransformsFolder)
+      fibulaPiecesClearances = getClearancesBetweenConsecutivePolyDatas(
+        [fibulaPiece.GetPolyData() for fibulaPiece in cutBonesList[0:-1]]
+      )
+      logging.info("Clearances between consecutive fibula pieces (mm): " + ", ".join(f"{clearance:.2f}" for clearance in fibulaPiecesClearances))
 
-      collisionDetected = False
-      for i in range(0,len(duplicateFibulaBonePiecesList) -1):
-        collisionDetection = vtk.vtkCollisionDetectionFilter()
-        collisionDetection.SetInputData(0, duplicateFibulaBonePiecesList[i].GetPolyData())
-        collisionDetection.SetInputData(1, duplicateFibulaBonePiecesList[i+1].GetPolyData())
-        matrix1 = vtk.vtkMatrix4x4()
-        collisionDetection.SetMatrix(0, matrix1)
-        collisionDetection.SetMatrix(1, matrix1)
-        collisionDetection.SetBoxTolerance(0.0)
-        collisionDetection.SetCellTolerance(0.0)
-        collisionDetection.SetNumberOfCellsPerNode(2)
-        collisionDetection.Update()
-        
-        if collisionDetection.GetNumberOfContacts() > 0:
-          collisionDetected = True
-          break
-      
-      removeFolder(duplicateFibulaBonePiecesTransformsFolder)
-      removeFolder(duplicateFibulaBonePiecesModelsFolder)
-      if collisionDetected:
+      if len(fibulaPiecesClearances) > 0 and min(fibulaPiecesClearances) < securityMarginOfFibulaPieces:
+        minimumClearanceIndex = int(np.argmin(fibulaPiecesClearances))
         slicer.util.errorDisplay(f"Planned fibula segments could overlap each other (the distance in between them do not satisfy the security margin of {securityMarginOfFibulaPieces}mm). " +
+            f"The clearance between fibula pieces {minimumClearanceIndex + 1} and {minimumClearanceIndex + 2} is {fibulaPiecesClearances[minimumClearanceIndex]:.2f}mm. " +
             "You can fix this by increasing 'between space' and pressing the update button")
         return
 
@@ -5458,6 +5899,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
     combineModelsLogic = combineModelsRobustLogic
     biggerMiterBoxInfoList = []
+    previewMiterBoxesBooleanJobs = []
     for i in range(len(fibulaPlanesList)):
       if useMoreExactVersionOfPositioningAlgorithmChecked:
         lineStartPos = np.zeros(3)
@@ -5562,15 +6004,14 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       moveNodeToFolder(lowResolutionBiggerMiterBoxModel, lowResolutionBiggerMiterBoxesModelsFolder)
 
       if miterBoxesGuideType == "Slot":
-        # previewMiterBoxes
+        # previewMiterBoxes, computed from the hardened boxes after the loop
         previewMiterBoxModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", previewMiterBoxName)
-        combineModelsLogic.process(
-          biggerMiterBoxModel, miterBoxModel, previewMiterBoxModel, 'difference'
-        )
+        previewMiterBoxModel.CreateDefaultDisplayNodes()
         previewMiterBoxDisplayNode = previewMiterBoxModel.GetDisplayNode()
         previewMiterBoxDisplayNode.AddViewNodeID(fibulaViewNode.GetID())
 
         moveNodeToFolder(previewMiterBoxModel, previewMiterBoxesModelsFolder)
+        previewMiterBoxesBooleanJobs.append((biggerMiterBoxModel, miterBoxModel, previewMiterBoxModel, 'difference'))
 
       normalToMiterBoxDirectionAndFibulaZ = [0,0,0]
       vtk.vtkMath.Cross(miterBoxDirection, fibulaZ, normalToMiterBoxDirectionAndFibulaZ)
@@ -5744,16 +6185,14 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       if miterBoxesGuideType == "Slot":
         miterBoxModel.SetAndObserveTransformNodeID(miterBoxToWorldChangeOfFrameTransformNode.GetID())
         miterBoxTransformationSuccess = miterBoxModel.HardenTransform()
-        previewMiterBoxModel.SetAndObserveTransformNodeID(miterBoxToWorldChangeOfFrameTransformNode.GetID())
-        previewMiterBoxTransformationSuccess = previewMiterBoxModel.HardenTransform()
-        if not (
-          miterBoxTransformationSuccess and 
-          previewMiterBoxTransformationSuccess
-        ):
+        if not (miterBoxTransformationSuccess):
           Exception('Hardening transforms was not successful')
 
       moveNodeToFolder(miterBoxToWorldChangeOfFrameTransformNode, miterBoxesTransformsFolder)
 
+    # the preview boxes of different planes are independent of each other
+    combineModelsLogic.processConcurrently(previewMiterBoxesBooleanJobs)
+
     if len(biggerMiterBoxInfoList) > 0:
       lineStartPos = np.zeros(3)
       lineEndPos = np.zeros(3)
@@ -5766,8 +6205,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       proximalBoxIndex = int(np.argmax(boxProjectionsList))
       donorLegLetter = "R" if rightSideLegIsDonor else "L"
 
-      for textLabel, boxIndex, faceSign in [("D", distalBoxIndex, -1.0), (donorLegLetter, proximalBoxIndex, 1.0)]:
-        info = biggerMiterBoxInfoList[boxIndex]
+      def getMiterBoxFaceCenter(info, faceSign):
         yFaceCenterOffset = 0.0
         if miterBoxesBoxType == "Adapted":
           # the adapted box has one of its local Z faces shifted by -delta along its local Y axis (see createAdaptedBox)
@@ -5779,11 +6217,17 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
             shiftedFaceSign = 1.0 if (comparisonVector/comparisonNorm) @ info["miterBoxAxisX"] > 0 else -1.0
             if faceSign == shiftedFaceSign:
               yFaceCenterOffset = -delta
-        faceCenter = np.array([0.0, yFaceCenterOffset, info["zCenterOffset"] + faceSign*info["biggerMiterBoxWidth"]/2])
-        faceNormal = np.array([0.0, 0.0, faceSign])
+        return np.array([0.0, yFaceCenterOffset, info["zCenterOffset"] + faceSign*info["biggerMiterBoxWidth"]/2])
+
+      placedTextLabels = BoundsSpatialHash(TEXT_LABELS_SPATIAL_HASH_CELL_SIZE)
+      for textLabel, boxIndex, faceSign in [("D", distalBoxIndex, -1.0), (donorLegLetter, proximalBoxIndex, 1.0)]:
+        info = biggerMiterBoxInfoList[boxIndex]
         textUp = np.array([0.0, 1.0, 0.0])
-        textLabelModel = self.createTextLabelModel(textLabel, fibulaTextLabelsMode, fibulaTextLabelsDepth,
-          faceCenter, faceNormal, textUp, "fibulaTextLabel_" + textLabel)
+        textLabelModel = self.createTextLabelModelAvoidingOverlaps(
+          placedTextLabels, slicer.util.arrayFromVTKMatrix(info["miterBoxToWorldChangeOfFrameMatrix"]),
+          [(getMiterBoxFaceCenter(info, sign), np.array([0.0, 0.0, sign])) for sign in [faceSign, -faceSign]],
+          textLabel, fibulaTextLabelsMode, fibulaTextLabelsDepth, textUp, "fibulaTextLabel_" + textLabel
+        )
 
         textLabelTransformNode = slicer.vtkMRMLLinearTransformNode()
         textLabelTransformNode.SetName("textLabelTemp_" + textLabel)
@@ -5969,9 +6413,36 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     interactionNode = slicer.mrmlScene.GetNodeByID("vtkMRMLInteractionNodeSingleton")
     interactionNode.SwitchToPersistentPlaceMode()
 
+  def nonDecimatedPreviewFitsInMemoryBudget(self):
+    """
+    The preview cuts a piece of the fibula (and vessels) for each segment, cuts the mandible
+    and transforms the pieces, so its footprint grows with the number of segments
+    """
+    parameterNode = self.getParameterNode()
+    numberOfSegments = max(1, len(createListFromFolderName("Mandibular planes")) - 1)
+    fibulaModelNode = parameterNode.GetNodeReference("fibulaModelNode")
+    mandibleModelNode = parameterNode.GetNodeReference("mandibleModelNode")
+    vesselsModelNode = parameterNode.GetNodeReference("vesselsModelNode")
+    fibulaSize = getPolyDataMemorySize(fibulaModelNode.GetPolyData()) if fibulaModelNode else 0
+    mandibleSize = getPolyDataMemorySize(mandibleModelNode.GetPolyData()) if mandibleModelNode else 0
+    vesselsSize = getPolyDataMemorySize(vesselsModelNode.GetPolyData()) if vesselsModelNode else 0
+    estimatedBytes = NON_DECIMATED_PREVIEW_MEMORY_FACTOR*(
+      (fibulaSize + vesselsSize)*numberOfSegments + 2*mandibleSize
+    )
+    return fitsInMemoryBudget(estimatedBytes, "Preview with non-decimated models")
+
+  def useNonDecimatedModelsForPreview(self):
+    """
+    The user choice unless the last VSP update had to use the decimated models to stay within the memory budget
+    """
+    return (
+      self.getParameterNode().GetParameter("useNonDecimatedModelsForPreview") == "True" and
+      not self.decimatedModelsAreForcedForPreview
+    )
+
   def getCurrentFibulaModel(self):
     parameterNode = self.getParameterNode()
-    useNonDecimatedModelsForPreviewChecked = parameterNode.GetParameter("useNonDecimatedModelsForPreview") == "True"
+    useNonDecimatedModelsForPreviewChecked = self.useNonDecimatedModelsForPreview()
     
     if useNonDecimatedModelsForPreviewChecked:
       fibulaModelNode = parameterNode.GetNodeReference("fibulaModelNode")
@@ -5982,7 +6453,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
   def getCurrentVesselsModel(self):
     parameterNode = self.getParameterNode()
-    useNonDecimatedModelsForPreviewChecked = parameterNode.GetParameter("useNonDecimatedModelsForPreview") == "True"
+    useNonDecimatedModelsForPreviewChecked = self.useNonDecimatedModelsForPreview()
     
     vesselsModelNode = parameterNode.GetNodeReference("vesselsModelNode")
     decimatedVesselsModelNode = parameterNode.GetNodeReference("decimatedVesselsModelNode")
@@ -5998,7 +6469,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
   def getCurrentMandibleModel(self):
     parameterNode = self.getParameterNode()
-    useNonDecimatedModelsForPreviewChecked = parameterNode.GetParameter("useNonDecimatedModelsForPreview") == "True"
+    useNonDecimatedModelsForPreviewChecked = self.useNonDecimatedModelsForPreview()
     
     if useNonDecimatedModelsForPreviewChecked:
       mandibleModelNode = parameterNode.GetNodeReference("mandibleModelNode")
@@ -6361,7 +6832,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
     self.updateNormalizationFibulaLineTransform(None)
   
-  @saveExecutedMethodWithTelemetry
+  @saveExecutedMethodWithTelemetry(monitorMemory=True)
   def makeBooleanOperationsToFibulaSurgicalGuideBase(self):
     parameterNode = self.getParameterNode()
     fibulaSurgicalGuideBaseModel = parameterNode.GetNodeReference("fibulaSurgicalGuideBaseModel")
@@ -6388,29 +6859,29 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     displayNode.SetColor(slicer.THREE_D_PRINTABLE_OBJECT_COLOR)
 
     for i in range(len(biggerMiterBoxesModelsList)):
-      combineModelsLogic.process(surgicalGuideModel, biggerMiterBoxesModelsList[i], surgicalGuideModel, 'union')
+      combineModelsLogic.process(surgicalGuideModel, biggerMiterBoxesModelsList[i], surgicalGuideModel, 'union', decimateInputsOverMemoryBudget = False)
 
     if fibulaTextLabelsMode == "Emboss":
       for i in range(len(fibulaTextLabelsModelsList)):
-        combineModelsLogic.process(surgicalGuideModel, fibulaTextLabelsModelsList[i], surgicalGuideModel, 'union')
+        combineModelsLogic.process(surgicalGuideModel, fibulaTextLabelsModelsList[i], surgicalGuideModel, 'union', decimateInputsOverMemoryBudget = False)
 
     if dentalImplantsPlanningAndFibulaDrillGuidesChecked:
       for i in range(len(biggerFibulaDentalImplantsCylindersModelsList)):
-        combineModelsLogic.process(surgicalGuideModel, biggerFibulaDentalImplantsCylindersModelsList[i], surgicalGuideModel, 'union')
+        combineModelsLogic.process(surgicalGuideModel, biggerFibulaDentalImplantsCylindersModelsList[i], surgicalGuideModel, 'union', decimateInputsOverMemoryBudget = False)
 
     for i in range(len(cylindersModelsList)):
-      combineModelsLogic.process(surgicalGuideModel, cylindersModelsList[i], surgicalGuideModel, 'difference')
+      combineModelsLogic.process(surgicalGuideModel, cylindersModelsList[i], surgicalGuideModel, 'difference', decimateInputsOverMemoryBudget = False)
 
     for i in range(len(miterBoxesModelsList)):
-      combineModelsLogic.process(surgicalGuideModel, miterBoxesModelsList[i], surgicalGuideModel, 'difference')
+      combineModelsLogic.process(surgicalGuideModel, miterBoxesModelsList[i], surgicalGuideModel, 'difference', decimateInputsOverMemoryBudget = False)
 
     if dentalImplantsPlanningAndFibulaDrillGuidesChecked:
       for i in range(len(fibulaDentalImplantsCylindersModelsList)):
-        combineModelsLogic.process(surgicalGuideModel, fibulaDentalImplantsCylindersModelsList[i], surgicalGuideModel, 'difference')
+        combineModelsLogic.process(surgicalGuideModel, fibulaDentalImplantsCylindersModelsList[i], surgicalGuideModel, 'difference', decimateInputsOverMemoryBudget = False)
 
     if fibulaTextLabelsMode == "Engrave":
       for i in range(len(fibulaTextLabelsModelsList)):
-        combineModelsLogic.process(surgicalGuideModel, fibulaTextLabelsModelsList[i], surgicalGuideModel, 'difference')
+        combineModelsLogic.process(surgicalGuideModel, fibulaTextLabelsModelsList[i], surgicalGuideModel, 'difference', decimateInputsOverMemoryBudget = False)
 
     if (
       surgicalGuideModel.GetPolyData().GetNumberOfPoints() <
@@ -6467,6 +6938,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
     biggerSawBoxesModelsFolder = getFolder("biggerSawBoxes Models", reset = True)
     sawBoxTextLabelsModelsFolder = getFolder("sawBoxTextLabels Models", reset = True)
+    placedTextLabels = BoundsSpatialHash(TEXT_LABELS_SPATIAL_HASH_CELL_SIZE)
     if sawBoxesGuideType == "Slot":  
       sawBoxesModelsFolder = getFolder("sawBoxes Models", reset = True)
       previewSawBoxesModelsFolder = getFolder("previewSawBoxes Models", reset = True)
@@ -6505,6 +6977,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
 
     combineModelsLogic = combineModelsRobustLogic
+    previewSawBoxesBooleanJobs = []
     for i in range(len(resectionPlanesList)):
       #sawBoxModel: the numbers are selected arbitrarily to make a box with the correct size then they'll be GUI set
       if i == 0:
@@ -6546,13 +7019,14 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
       biggerSawBoxDisplayNode.AddViewNodeID(mandibleViewNode.GetID())
 
       if sawBoxesGuideType == "Slot":
-        # previewSawBoxes
+        # previewSawBoxes, computed after the loop
         previewSawBoxModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", previewSawBoxName)
-        combineModelsLogic.process(biggerSawBoxModel, sawBoxModel, previewSawBoxModel, 'difference')
+        previewSawBoxModel.CreateDefaultDisplayNodes()
         previewSawBoxDisplayNode = previewSawBoxModel.GetDisplayNode()
         previewSawBoxDisplayNode.AddViewNodeID(mandibleViewNode.GetID())
 
         moveNodeToFolder(previewSawBoxModel, previewSawBoxesModelsFolder)
+        previewSawBoxesBooleanJobs.append((biggerSawBoxModel, sawBoxModel, previewSawBoxModel, 'difference'))
 
       #Create sawBox plane
       sawBoxPlane = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsPlaneNode", "sawBox Plane%d" % i)
@@ -6689,8 +7163,6 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
             sawBoxZCenterOffset = sawBoxSlotWidth
         else:
           sawBoxZCenterOffset = 0
-        faceCenter = np.array([0.0, 0.0, sawBoxZCenterOffset + faceSign*biggerSawBoxWidth/2])
-        faceNormal = np.array([0.0, 0.0, faceSign])
         # make the letter upright: world superior direction expressed in the
         # sawBox local frame, projected onto the label face (perpendicular to
         # the local Z faceNormal)
@@ -6701,13 +7173,22 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
           0.0,
         ])
         textUp = textUp/np.linalg.norm(textUp)
-        textLabelModel = self.createTextLabelModel(textLabel, mandibleTextLabelsMode, mandibleTextLabelsDepth,
-          faceCenter, faceNormal, textUp, "sawBoxTextLabel_" + textLabel)
+        textLabelModel = self.createTextLabelModelAvoidingOverlaps(
+          placedTextLabels, slicer.util.arrayFromVTKMatrix(sawBoxPlaneToWorldMatrix),
+          [
+            (np.array([0.0, 0.0, sawBoxZCenterOffset + sign*biggerSawBoxWidth/2]), np.array([0.0, 0.0, sign]))
+            for sign in [faceSign, -faceSign]
+          ],
+          textLabel, mandibleTextLabelsMode, mandibleTextLabelsDepth, textUp, "sawBoxTextLabel_" + textLabel
+        )
         textLabelModel.SetAndObserveTransformNodeID(transformNode.GetID())
         textLabelDisplayNode = textLabelModel.GetDisplayNode()
         textLabelDisplayNode.AddViewNodeID(mandibleViewNode.GetID())
         moveNodeToFolder(textLabelModel, sawBoxTextLabelsModelsFolder)
 
+    # the preview boxes of different planes are independent of each other
+    combineModelsLogic.processConcurrently(previewSawBoxesBooleanJobs)
+
     removeFolder(intersectionsFolder)
     removeFolder(pointsIntersectionsFolder)
 
@@ -6816,7 +7297,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     if updateOnDentalImplantPlanesMovement:
       self.updateFibuladentalImplantsTimer.start()
 
-  @saveExecutedMethodWithTelemetry
+  @saveExecutedMethodWithTelemetry(monitorMemory=True)
   def makeBooleanOperationsToMandibleSurgicalGuideBase(self):
     parameterNode = self.getParameterNode()
     mandibleSurgicalGuideBaseModel = parameterNode.GetNodeReference("mandibleSurgicalGuideBaseModel")
@@ -6851,27 +7332,27 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     self.filterOutUnconnectedModelPiecesAccordingToKindOfMandibleResection(surgicalGuideModel)
 
     for i in range(len(biggerSawBoxesModelsList)):
-      combineModelsLogic.process(surgicalGuideModel, biggerSawBoxesModelsList[i], surgicalGuideModel, 'union')
+      combineModelsLogic.process(surgicalGuideModel, biggerSawBoxesModelsList[i], surgicalGuideModel, 'union', decimateInputsOverMemoryBudget = False)
 
     if mandibleTextLabelsMode == "Emboss":
       for i in range(len(sawBoxTextLabelsModelsList)):
-        combineModelsLogic.process(surgicalGuideModel, sawBoxTextLabelsModelsList[i], surgicalGuideModel, 'union')
+        combineModelsLogic.process(surgicalGuideModel, sawBoxTextLabelsModelsList[i], surgicalGuideModel, 'union', decimateInputsOverMemoryBudget = False)
 
     if (
       mandibleBridgeModel and
       (kindOfMandibleResection == "Segmental Mandibulectomy")
     ):
-      combineModelsLogic.process(surgicalGuideModel, mandibleBridgeModel, surgicalGuideModel, 'union')
+      combineModelsLogic.process(surgicalGuideModel, mandibleBridgeModel, surgicalGuideModel, 'union', decimateInputsOverMemoryBudget = False)
 
     for i in range(len(cylindersModelsList)):
-      combineModelsLogic.process(surgicalGuideModel, cylindersModelsList[i], surgicalGuideModel, 'difference')
+      combineModelsLogic.process(surgicalGuideModel, cylindersModelsList[i], surgicalGuideModel, 'difference', decimateInputsOverMemoryBudget = False)
 
     for i in range(len(sawBoxesModelsList)):
-      combineModelsLogic.process(surgicalGuideModel, sawBoxesModelsList[i], surgicalGuideModel, 'difference')
+      combineModelsLogic.process(surgicalGuideModel, sawBoxesModelsList[i], surgicalGuideModel, 'difference', decimateInputsOverMemoryBudget = False)
 
     if mandibleTextLabelsMode == "Engrave":
       for i in range(len(sawBoxTextLabelsModelsList)):
-        combineModelsLogic.process(surgicalGuideModel, sawBoxTextLabelsModelsList[i], surgicalGuideModel, 'difference')
+        combineModelsLogic.process(surgicalGuideModel, sawBoxTextLabelsModelsList[i], surgicalGuideModel, 'difference', decimateInputsOverMemoryBudget = False)
 
     if surgicalGuideModel.GetPolyData().GetNumberOfPoints() == 0:
       slicer.mrmlScene.RemoveNode(surgicalGuideModel)
@@ -6921,50 +7402,45 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
   @saveExecutedMethodWithTelemetry
   def centerFibulaLine(self):
+    """
+    Move the fibula line ends to the centroids of the fibula cross sections at them until they
+    move less than positioningAlgorithmTolerance_mm. Returns the number of iterations used.
+    """
     parameterNode = self.getParameterNode()
     fibulaLine = parameterNode.GetNodeReference("fibulaLine")
     fibulaModelNode = parameterNode.GetNodeReference("fibulaModelNode")
-
-    intersectionsFolder = getFolder("Intersections")
+    positioningAlgorithmTolerance = self.getFloatParameter("positioningAlgorithmTolerance_mm")
 
     lineStartPos = np.zeros(3)
     lineEndPos = np.zeros(3)
     fibulaLine.GetNthControlPointPositionWorld(0, lineStartPos)
     fibulaLine.GetNthControlPointPositionWorld(1, lineEndPos)
 
-    numberOfRepetitionsOfPositioningAlgorithm = 5
-    for i in range(numberOfRepetitionsOfPositioningAlgorithm):
-      fibulaLineNorm = np.linalg.norm(lineEndPos-lineStartPos)
-      fibulaLineDirection = (lineEndPos-lineStartPos)/fibulaLineNorm
-
-      fibulaStartIntersectionModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','FibulaStartIntersection %d' % i)
-      fibulaEndIntersectionModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode','FibulaEndIntersection %d' % i)
-      fibulaStartIntersectionModel.CreateDefaultDisplayNodes()
-      fibulaEndIntersectionModel.CreateDefaultDisplayNodes()
-
-      moveNodeToFolder(fibulaStartIntersectionModel, intersectionsFolder)
-      moveNodeToFolder(fibulaEndIntersectionModel, intersectionsFolder)
-
-      getIntersectionBetweenModelAnd1PlaneWithNormalAndOrigin(fibulaModelNode,fibulaLineDirection,lineStartPos,fibulaStartIntersectionModel)
-      getIntersectionBetweenModelAnd1PlaneWithNormalAndOrigin(fibulaModelNode,fibulaLineDirection,lineEndPos,fibulaEndIntersectionModel)
-      lineStartPos = getCentroid(fibulaStartIntersectionModel)
-      lineEndPos = getCentroid(fibulaEndIntersectionModel)
-      if lineStartPos is None or lineEndPos is None:
-        removeFolder(intersectionsFolder)
-        raise slicer.util.errorDisplay("ERROR: Line has invalid direction, please re-draw it")
+    lineStartPos, lineEndPos, numberOfIterations, converged = centerLineInsideModel(
+      fibulaModelNode.GetPolyData(), lineStartPos, lineEndPos,
+      positioningAlgorithmTolerance, MAXIMUM_NUMBER_OF_ITERATIONS_OF_POSITIONING_ALGORITHM
+    )
+    if lineStartPos is None or lineEndPos is None:
+      slicer.util.errorDisplay("ERROR: Line has invalid direction, please re-draw it")
+      return None
+    if not converged:
+      logging.warning(f"Fibula line centering did not converge to {positioningAlgorithmTolerance}mm in {numberOfIterations} iterations")
+    logging.info(f"Fibula line centered in {numberOfIterations} iterations")
 
     fibulaLine.SetNthControlPointPosition(0,lineStartPos)
     fibulaLine.SetNthControlPointPosition(1,lineEndPos)
 
-    removeFolder(intersectionsFolder)
-
     fibulaNormalizationTransformChecked = parameterNode.GetParameter("fibulaNormalizationTransform") == "True"
     self.updateNormalizationFibulaLineTransform(fibulaNormalizationTransformChecked)
+    return numberOfIterations
 
-  def getNodesLinkedToFibula(self):
+  def getNodesLinkedToFibula(self, updateInverseMandiblePieces=True):
     parameterNode = self.getParameterNode()
     nodes = []
 
+    if updateInverseMandiblePieces:
+      self.updateInverseMandiblePiecesIfOutdated()
+
     for refKey in ["fibulaModelNode", "decimatedFibulaModelNode", "fibulaLine",
                    "fibulaSurgicalGuidePrototypeModel", "miterBoxDirectionLine",
                    "fibulaSurgicalGuideBaseModel", "vesselsModelNode", "decimatedVesselsModelNode"]:
@@ -7000,7 +7476,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
     return nodes
 
-  def updateNormalizationFibulaLineTransform(self, fibulaNormalizationTransformChecked):
+  def updateNormalizationFibulaLineTransform(self, fibulaNormalizationTransformChecked, updateInverseMandiblePieces=True):
     parameterNode = self.getParameterNode()
     fibulaLine = parameterNode.GetNodeReference("fibulaLine")
     
@@ -7039,7 +7515,7 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
         rotationTransform.Translate(lineCenter)
         fibulaNormalizationTransformNode.SetMatrixTransformToParent(rotationTransform.GetMatrix())
 
-    fibulaLinkedNodes = self.getNodesLinkedToFibula()
+    fibulaLinkedNodes = self.getNodesLinkedToFibula(updateInverseMandiblePieces)
     for node in fibulaLinkedNodes:
       node.SetAndObserveTransformNodeID(fibulaNormalizationTransformNode.GetID())
   
@@ -7051,10 +7527,8 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     yellowSliceLogic = slicer.app.layoutManager().sliceWidget('Yellow').sliceLogic()
     yellowSliceLogic.GetSliceCompositeNode().SetBackgroundVolumeID(scalarVolumeID)
 
-  @saveExecutedMethodWithTelemetry
+  @saveExecutedMethodWithTelemetry(monitorMemory=True)
   def create3DModelOfTheReconstruction(self):
-    import time
-    startTime = time.time()
     logging.info('Processing started')
 
     parameterNode = self.getParameterNode()
@@ -7182,6 +7656,62 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
     return
 
+  def exportModelsToFolderInBackground(self, modelNodes, folderPath, fileFormat="stl", onFinished=None):
+    """
+    Snapshot the given models and write them to folderPath from a worker thread.
+    A manifest with checksums is written when all files are done and
+    onBackgroundExportFinished is called, followed by onFinished(manifest) if given.
+    """
+    if self.meshExporter is None:
+      self.meshExporter = BackgroundMeshExporter()
+
+    def exportFinished(manifest):
+      self.onBackgroundExportFinished(manifest)
+      if onFinished is not None:
+        onFinished(manifest)
+
+    self.meshExporter.exportModels(modelNodes, folderPath, fileFormat, exportFinished)
+
+  def onBackgroundExportFinished(self, manifest):
+    self.lastExportManifest = manifest
+    if len(manifest["errors"]) > 0:
+      logging.warning(
+        f"Export to {manifest['folderPath']} finished with {len(manifest['errors'])} errors, "
+        f"{len(manifest['files'])} files written"
+      )
+    else:
+      logging.info(f"Export to {manifest['folderPath']} finished, {len(manifest['files'])} files written")
+
+  def exportSurgicalGuidesAndReconstructionPiecesToFolder(self, folderPath, fileFormat="stl", onFinished=None):
+    parameterNode = self.getParameterNode()
+
+    modelNodes = []
+    for referenceRole in ["fibulaSurgicalGuidePrototypeModel", "mandibleSurgicalGuidePrototypeModel", "mandibleReconstructionModel"]:
+      modelNode = parameterNode.GetNodeReference(referenceRole)
+      if modelNode is not None:
+        modelNodes.append(modelNode)
+    modelNodes += createListFromFolderName("Transformed Fibula Pieces")
+    self.updateInverseMandiblePiecesIfOutdated()
+    modelNodes += createListFromFolderName("Cut Mandible Pieces")
+
+    if len(modelNodes) == 0:
+      slicer.util.errorDisplay("There are no surgical guides or reconstruction pieces to export")
+      return
+
+    self.exportModelsToFolderInBackground(modelNodes, folderPath, fileFormat, onFinished)
+
+  def exportStageTimingsTrace(self, filePath):
+    """
+    Save the timings of the processing stages run on this session as a json trace,
+    it can be opened on chrome://tracing or ui.perfetto.dev
+    """
+    stageTimings.exportTrace(filePath)
+    logging.info("Processing stages timings:\n" + stageTimings.formatSummary(maximumDepth=2))
+    logging.info(f"Timings trace saved to {filePath}")
+
+  def resetStageTimings(self):
+    stageTimings.reset()
+
   def t2pd(self, text):
     """Convert a string to a vtkPolyData object."""
     fontPath = os.path.join(os.path.dirname(__file__), 'Resources/Fonts/OpenSans-Bold.ttf')
@@ -7189,10 +7719,26 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
   def createTextLabelModel(self, text, textLabelsMode, textLabelsDepth,
       faceCenter, faceNormal, textUp, modelName):
-    """Create a model node with extruded 3D text positioned over a box face.
+    """Create a model node with the text label polydata of createTextLabelPolyData, so the
+    model can observe the same transform node as the box it belongs to."""
+    textLabelPolyData = self.createTextLabelPolyData(text, textLabelsMode, textLabelsDepth,
+      faceCenter, faceNormal, textUp)
+    return self.createTextLabelModelFromPolyData(textLabelPolyData, modelName)
+
+  def createTextLabelModelFromPolyData(self, textLabelPolyData, modelName):
+    textLabelModel = slicer.mrmlScene.CreateNodeByClass('vtkMRMLModelNode')
+    textLabelModel.SetName(slicer.mrmlScene.GetUniqueNameByString(modelName))
+    slicer.mrmlScene.AddNode(textLabelModel)
+    textLabelModel.CreateDefaultDisplayNodes()
+    textLabelModel.SetAndObservePolyData(textLabelPolyData)
+    return textLabelModel
+
+  @timedStage()
+  def createTextLabelPolyData(self, text, textLabelsMode, textLabelsDepth,
+      faceCenter, faceNormal, textUp):
+    """Extruded 3D text positioned over a box face.
     faceCenter, faceNormal (pointing outward) and textUp are given in the
-    box-local frame and the output polydata is in that same frame, so the
-    model can observe the same transform node as the box it belongs to.
+    box-local frame and the output polydata is in that same frame.
     If textLabelsMode is "Emboss" the text protrudes from the face by
     textLabelsDepth, if it is "Engrave" the text sinks into the box by
     textLabelsDepth. Either way the text overlaps the box face by
@@ -7241,12 +7787,29 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     textToBoxTransformFilter.SetInputConnection(normalsFilter.GetOutputPort())
     textToBoxTransformFilter.SetTransform(textToBoxTransform)
     textToBoxTransformFilter.Update()
+    return textToBoxTransformFilter.GetOutput()
+
+  def createTextLabelModelAvoidingOverlaps(self, placedTextLabels, boxToWorldMatrix, facesCentersAndNormals,
+      text, textLabelsMode, textLabelsDepth, textUp, modelName):
+    """Create the text label on the first of the candidate box faces (faceCenter, faceNormal in the
+    box-local frame, see createTextLabelPolyData) where it does not overlap the labels already placed on
+    the guide. placedTextLabels is the BoundsSpatialHash with the world bounds of those labels, the new
+    label is added to it. If every face overlaps the label is left on the first one.
+    Only the polydata is made for the rejected faces, the model node is created for the chosen one."""
+    candidatesPolyDataAndBounds = []
+    for faceCenter, faceNormal in facesCentersAndNormals:
+      textLabelPolyData = self.createTextLabelPolyData(text, textLabelsMode, textLabelsDepth,
+        faceCenter, faceNormal, textUp)
+      textLabelBounds = getTransformedBounds(textLabelPolyData.GetBounds(), boxToWorldMatrix)
+      candidatesPolyDataAndBounds.append((textLabelPolyData, textLabelBounds))
+      if len(placedTextLabels.getIntersectingItems(textLabelBounds)) == 0:
+        break
+    else:
+      logging.warning(f"Text label {modelName} overlaps other text labels of the guide")
+      textLabelPolyData, textLabelBounds = candidatesPolyDataAndBounds[0]
 
-    textLabelModel = slicer.mrmlScene.CreateNodeByClass('vtkMRMLModelNode')
-    textLabelModel.SetName(slicer.mrmlScene.GetUniqueNameByString(modelName))
-    slicer.mrmlScene.AddNode(textLabelModel)
-    textLabelModel.CreateDefaultDisplayNodes()
-    textLabelModel.SetAndObservePolyData(textToBoxTransformFilter.GetOutput())
+    textLabelModel = self.createTextLabelModelFromPolyData(textLabelPolyData, modelName)
+    placedTextLabels.insert(textLabelModel.GetID(), textLabelBounds)
     return textLabelModel
 
   def createPlateCurve(self):
@@ -7367,187 +7930,32 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
 
     plateCurveResampled.ResampleCurveWorld(10)
 
+    curvePoints = slicer.util.arrayFromMarkupsCurvePoints(plateCurveResampled)
 
-    cellArray = vtk.vtkCellArray()
-    points = vtk.vtkPoints()
-    pointID = 0
-
-    startIndex = 0
-    curveMatrix = vtk.vtkMatrix4x4()
-    plateCurveResampled.GetCurvePointToWorldTransformAtPointIndex(startIndex,curveMatrix)
-    plateCurveResampledX = np.array([curveMatrix.GetElement(0,0),curveMatrix.GetElement(1,0),curveMatrix.GetElement(2,0)])
-    plateCurveResampledY = np.array([curveMatrix.GetElement(0,1),curveMatrix.GetElement(1,1),curveMatrix.GetElement(2,1)])
-    plateCurveResampledZ = np.array([curveMatrix.GetElement(0,2),curveMatrix.GetElement(1,2),curveMatrix.GetElement(2,2)])
-    plateCurveResampledOrigin = np.array([curveMatrix.GetElement(0,3),curveMatrix.GetElement(1,3),curveMatrix.GetElement(2,3)])
+    slicer.mrmlScene.RemoveNode(plateCurveResampled)
 
-    
     normalsOfMandibleReconstructionModel = slicer.util.arrayFromModelPointData(mandibleReconstructionModel, 'Normals')
     
     pointsLocator = vtk.vtkPointLocator()
     pointsLocator.SetDataSet(mandibleReconstructionModel.GetPolyData())
     pointsLocator.BuildLocator()
 
-    
-    pointIDOfClosestPoint = pointsLocator.FindClosestPoint(plateCurveResampledOrigin)
+    pointIDOfClosestPoint = pointsLocator.FindClosestPoint(curvePoints[0])
     normalAtPointID = normalsOfMandibleReconstructionModel[pointIDOfClosestPoint]
-    
-    vectorSimilarToPlateCurveY = [0,0,0]
-    vtk.vtkMath.Cross(plateCurveResampledZ, normalAtPointID, vectorSimilarToPlateCurveY)
-    vectorSimilarToPlateCurveY = vectorSimilarToPlateCurveY/np.linalg.norm(vectorSimilarToPlateCurveY)
-
-    epsilon = 0.0001
-    angleRadians = vtk.vtkMath.AngleBetweenVectors(plateCurveResampledY,vectorSimilarToPlateCurveY)
-    if not (vtk.vtkMath.Dot(plateCurveResampledY,vectorSimilarToPlateCurveY) >= 1.0 - epsilon):
-      rotationAxis = [0,0,0]
-      vtk.vtkMath.Cross(plateCurveResampledY, vectorSimilarToPlateCurveY, rotationAxis)
-      if (vtk.vtkMath.Norm(rotationAxis) < epsilon):
-        #plateCurveResampledY + vectorSimilarToPlateCurveY are facing opposite directions.
-        rotationAxis = np.copy(plateCurveResampledZ) 
-      rotationAxis = rotationAxis/np.linalg.norm(rotationAxis)
-    else:
-      rotationAxis = np.copy(plateCurveResampledZ)
-
-    if vtk.vtkMath.Dot(plateCurveResampledZ,rotationAxis) < 0:
-      rotationAxisMultiplier = -1
-    else:
-      rotationAxisMultiplier = 1
-
-
-    curveToWorldTransform = vtk.vtkTransform()
-    curveToWorldTransform.PostMultiply()
-    curveToWorldTransform.Concatenate(curveMatrix)
-    #rotate around plateCurveResampledOrigin
-    curveToWorldTransform.Translate(-plateCurveResampledOrigin)
-    curveToWorldTransform.RotateWXYZ(vtk.vtkMath.DegreesFromRadians(angleRadians), rotationAxisMultiplier*plateCurveResampledZ)
-    curveToWorldTransform.Translate(plateCurveResampledOrigin)
-    curveToWorldTransform.TransformVector([1,0,0],plateCurveResampledX)
-    #give offset to be away of the mandibleReconstruction
-    curveToWorldTransform.Translate(plateCurveResampledX*plateCrossSectionalWidth/2)
-
-    firstTransformedPolygonPoints = []
-    for i in range(len(polygonPoints)):
-      transformedPolygonPoint = np.zeros(3)
-      curveToWorldTransform.TransformPoint(np.append(polygonPoints[i], 0.0), transformedPolygonPoint)
-      firstTransformedPolygonPoints.append(transformedPolygonPoint)
-
-    polygon = vtk.vtkPolygon()
-    polygon.GetPointIds().SetNumberOfIds(len(firstTransformedPolygonPoints))
-    for i in range(len(firstTransformedPolygonPoints)):
-        points.InsertNextPoint(firstTransformedPolygonPoints[i])
-        polygon.GetPointIds().SetId(i, pointID)
-        pointID += 1
-
-    cellArray.InsertNextCell(polygon)
-
-    curvePoints = slicer.util.arrayFromMarkupsCurvePoints(plateCurveResampled)
-
-    for j in range(1,len(curvePoints)):
-      curvePoint = curvePoints[j]
-      
-      secondTransformedPolygonPoints = []
-      
-      closestCurvePoint = [0,0,0]
-      closestCurvePointIndex = plateCurveResampled.GetClosestPointPositionAlongCurveWorld(curvePoint,closestCurvePoint)
-      
-      curveMatrix = vtk.vtkMatrix4x4()
-      plateCurveResampled.GetCurvePointToWorldTransformAtPointIndex(closestCurvePointIndex,curveMatrix)
-      plateCurveResampledX = np.array([curveMatrix.GetElement(0,0),curveMatrix.GetElement(1,0),curveMatrix.GetElement(2,0)])
-      plateCurveResampledZ = np.array([curveMatrix.GetElement(0,2),curveMatrix.GetElement(1,2),curveMatrix.GetElement(2,2)])
-      plateCurveResampledOrigin = np.array([curveMatrix.GetElement(0,3),curveMatrix.GetElement(1,3),curveMatrix.GetElement(2,3)])
-
-      curveToWorldTransform = vtk.vtkTransform()
-      curveToWorldTransform.PostMultiply()
-      curveToWorldTransform.Concatenate(curveMatrix)
-      #rotate around plateCurveResampledOrigin
-      curveToWorldTransform.Translate(-plateCurveResampledOrigin)
-      curveToWorldTransform.RotateWXYZ(vtk.vtkMath.DegreesFromRadians(angleRadians), rotationAxisMultiplier*plateCurveResampledZ)
-      curveToWorldTransform.Translate(plateCurveResampledOrigin)
-      curveToWorldTransform.TransformVector([1,0,0],plateCurveResampledX)
-      #give offset to be away of the mandibleReconstruction
-      curveToWorldTransform.Translate(plateCurveResampledX*plateCrossSectionalWidth/2)
-      
-      for i in range(len(polygonPoints)):
-        transformedPolygonPoint = np.zeros(3)
-        curveToWorldTransform.TransformPoint(np.append(polygonPoints[i], 0.0), transformedPolygonPoint)
-        secondTransformedPolygonPoints.append(transformedPolygonPoint)
-
-      if self.pointsOverlap(firstTransformedPolygonPoints,secondTransformedPolygonPoints) == True:
-        continue
-      
-      for i in range(len(secondTransformedPolygonPoints)):
-        points.InsertNextPoint(secondTransformedPolygonPoints[i])
-        pointID += 1
-
-      for k in range(len(firstTransformedPolygonPoints)):
-        polygon = vtk.vtkPolygon()
-        polygon.GetPointIds().SetNumberOfIds(3)
-        polygon.GetPointIds().SetId(0, k + pointID - len(secondTransformedPolygonPoints))
-        polygon.GetPointIds().SetId(2, k + pointID - 2*len(secondTransformedPolygonPoints))
-        if k!=(len(firstTransformedPolygonPoints) -1):
-          polygon.GetPointIds().SetId(1, k + 1 + pointID - len(secondTransformedPolygonPoints))
-        else:
-          polygon.GetPointIds().SetId(1, pointID - len(secondTransformedPolygonPoints))
-        
-        cellArray.InsertNextCell(polygon)
-        
-        polygon = vtk.vtkPolygon()
-        polygon.GetPointIds().SetNumberOfIds(3)
-        polygon.GetPointIds().SetId(0, k + pointID - 2*len(secondTransformedPolygonPoints))
-        if k!=(len(firstTransformedPolygonPoints) -1):
-          polygon.GetPointIds().SetId(1, k + 1 + pointID - len(secondTransformedPolygonPoints))
-          polygon.GetPointIds().SetId(2, k + 1 + pointID - 2*len(secondTransformedPolygonPoints))
-        else:
-          polygon.GetPointIds().SetId(1, pointID - len(secondTransformedPolygonPoints))
-          polygon.GetPointIds().SetId(2, pointID - 2*len(secondTransformedPolygonPoints))
-        
-        cellArray.InsertNextCell(polygon)
-      
-      firstTransformedPolygonPoints = secondTransformedPolygonPoints.copy()
-
-      if j == (len(curvePoints)-1):
-        polygon = vtk.vtkPolygon()
-        polygon.GetPointIds().SetNumberOfIds(len(polygonPoints))
-        for i in range(len(polygonPoints)):
-            polygon.GetPointIds().SetId(i, pointID-len(polygonPoints) +i)
-        
-        cellArray.InsertNextCell(polygon)
 
-    polydata = vtk.vtkPolyData()
-    polydata.SetPoints(points)
-    polydata.SetPolys(cellArray)
-
-    triangleFilter = vtk.vtkTriangleFilter()
-    triangleFilter.SetInputData(polydata)
-    triangleFilter.Update()
+    # the cross section X axis starts along the surface normal of the reconstruction and
+    # the profile is offset along it so the plate lies over the bone instead of inside it
+    profilePointsXY = np.array(polygonPoints) + np.array([plateCrossSectionalWidth/2, 0.])
+    platePoints, plateTriangles = sweepProfileAlongCurve(
+      profilePointsXY, curvePoints, normalAtPointID,
+      tipsBevelRadius=(plateTipsBevelRadius/100)*plateCrossSectionalLength
+    )
 
     extrusionModel = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
     slicer.mrmlScene.AddNode(extrusionModel)
     extrusionModel.SetName(slicer.mrmlScene.GetUniqueNameByString('customTitaniumPlatePrototype'))
     extrusionModel.CreateDefaultDisplayNodes()
-    extrusionModel.SetAndObservePolyData(triangleFilter.GetOutput())
-
-    slicer.mrmlScene.RemoveNode(plateCurveResampled)
-
-  def pointsOverlap(self,firstPolygonPoints,secondPolygonPoints):
-    firstPolygonPoints_np = np.array(firstPolygonPoints, dtype="float")
-    secondPolygonPoints_np = np.array(secondPolygonPoints, dtype="float")
-    centroidFirstPolygonPoints = np.average(firstPolygonPoints_np, axis=0)
-    centroidSecondPolygonPoints = np.average(firstPolygonPoints_np, axis=0)
-    defaultDirection = (
-      (centroidSecondPolygonPoints - centroidFirstPolygonPoints) / 
-      np.linalg.norm(centroidSecondPolygonPoints - centroidFirstPolygonPoints)
-    )
-    
-    for i in range(len(firstPolygonPoints_np)):
-      firstPolygonPoint = firstPolygonPoints_np[i]
-      for j in range(len(secondPolygonPoints_np)):
-        secondPolygonPoint = secondPolygonPoints_np[j]
-        direction = secondPolygonPoint - firstPolygonPoint
-        projectedOrientedDistance = defaultDirection @ direction.T
-        if projectedOrientedDistance < 0:
-          return True
-    
-    return False
+    extrusionModel.SetAndObservePolyData(createPolyDataFromPointsAndTriangles(platePoints, plateTriangles))
   
   def createAlmostQuarterArcFromPointsAndCenter(self,pointStartXY,pointEndXY,centerXY,nOfsegments):
     if nOfsegments <= 1:
@@ -7577,7 +7985,16 @@ class BoneReconstructionPlannerLogic(ScriptedLoadableModuleLogic):
     return almostQuarterArcPoints
 
   def createLineFromPointsAndDistanceBetweenPoints(self,pointStartXY,pointEndXY,arcSegmentLength):
-    return []
+    # evenly spaced points between (and not including) pointStartXY and pointEndXY that are at most arcSegmentLength apart
+    pointStartXY = np.array(pointStartXY, dtype=float)
+    pointEndXY = np.array(pointEndXY, dtype=float)
+    lineLength = np.linalg.norm(pointEndXY - pointStartXY)
+    if arcSegmentLength <= 0 or lineLength <= arcSegmentLength:
+      return []
+
+    nOfsegments = int(np.ceil(lineLength/arcSegmentLength))
+    parameters = np.arange(1, nOfsegments)/nOfsegments
+    return list(pointStartXY + parameters[:, None]*(pointEndXY - pointStartXY))
 
 #
 # BoneReconstructionPlannerTest
@@ -7619,6 +8036,7 @@ class BoneReconstructionPlannerTest(ScriptedLoadableModuleTest):
     self.section_SetMandibularCurve()
     self.section_SetFibulaLine()
     self.section_AddMandiblePlanes()
+    self.section_ComputeInverseMandiblePiecesOnDemand()
     #self.section_SimulateAndImproveMandibleReconstruction()
     #self.section_createMiterBoxesFromCorrespondingLine()
     ##self.section_prepareGuideBaseForFibulaGuide()
@@ -7706,6 +8124,79 @@ class BoneReconstructionPlannerTest(ScriptedLoadableModuleTest):
 
     self.delayDisplay('Test data imported correctly')
 
+  def test_ExtractFurthestRegion(self):
+    self.delayDisplay("Starting the ExtractFurthestRegionTest")
+
+    sphereCentersX = [0, 10, 30]
+    appendFilter = vtk.vtkAppendPolyData()
+    for sphereCenterX in sphereCentersX:
+      sphereSource = vtk.vtkSphereSource()
+      sphereSource.SetCenter(sphereCenterX, 0, 0)
+      sphereSource.SetRadius(1)
+      sphereSource.Update()
+      appendFilter.AddInputData(sphereSource.GetOutput())
+    appendFilter.Update()
+    spheresPolyData = appendFilter.GetOutput()
+
+    labeledPolyData, pointsRegionIds, numberOfRegions = labelConnectedRegions(spheresPolyData)
+    self.assertEqual(numberOfRegions, len(sphereCentersX))
+    self.assertEqual(len(pointsRegionIds), labeledPolyData.GetNumberOfPoints())
+
+    plane = vtk.vtkPlane()
+    plane.SetOrigin(0, 0, 0)
+    plane.SetNormal(0, 0, 1)
+    cutter = vtk.vtkCutter()
+    cutter.SetInputData(spheresPolyData)
+    cutter.SetCutFunction(plane)
+    cutter.Update()
+    intersectionPolyData = cutter.GetOutput()
+
+    # surfaces and the line contours of a plane cut
+    for polyData in [spheresPolyData, intersectionPolyData]:
+      furthestRegion = extractFurthestRegion(polyData, [0, 0, 0])
+      self.assertGreater(furthestRegion.GetNumberOfCells(), 0)
+      bounds = furthestRegion.GetBounds()
+      self.assertTrue(
+        np.allclose(
+          [(bounds[0]+bounds[1])/2, (bounds[2]+bounds[3])/2],
+          [sphereCentersX[-1], 0],
+          atol=0.1
+        )
+      )
+
+    self.assertEqual(extractFurthestRegion(vtk.vtkPolyData(), [0, 0, 0]).GetNumberOfPoints(), 0)
+
+    self.delayDisplay("ExtractFurthestRegionTest successful")
+
+  def test_ClearanceBetweenPolyDatas(self):
+    self.delayDisplay("Starting the ClearanceBetweenPolyDatasTest")
+
+    def createBoxPolyData(xMin, xMax, yMin=0, yMax=10):
+      cubeSource = vtk.vtkCubeSource()
+      cubeSource.SetBounds(xMin, xMax, yMin, yMax, 0, 10)
+      triangleFilter = vtk.vtkTriangleFilter()
+      triangleFilter.SetInputConnection(cubeSource.GetOutputPort())
+      triangleFilter.Update()
+      return triangleFilter.GetOutput()
+
+    boxPolyData = createBoxPolyData(0, 10)
+    # separated, touching and overlapping boxes of 10mm
+    for secondBoxXMin, expectedClearance in [(13, 3.), (10.5, 0.5), (10, 0.), (9, -1.), (8, -2.)]:
+      secondBoxPolyData = createBoxPolyData(secondBoxXMin, secondBoxXMin + 10)
+      self.assertAlmostEqual(getClearanceBetweenPolyDatas(boxPolyData, secondBoxPolyData), expectedClearance, delta=0.1)
+      self.assertAlmostEqual(getClearanceBetweenPolyDatas(secondBoxPolyData, boxPolyData), expectedClearance, delta=0.1)
+
+    # a bar that crosses the box with none of the points of one inside the other
+    barPolyData = createBoxPolyData(-5, 15, 4, 6)
+    self.assertAlmostEqual(getClearanceBetweenPolyDatas(boxPolyData, barPolyData), -4., delta=0.1)
+
+    self.assertEqual(
+      getClearancesBetweenConsecutivePolyDatas([boxPolyData, createBoxPolyData(13, 23), createBoxPolyData(23.5, 33.5)]),
+      [3., 0.5]
+    )
+
+    self.delayDisplay("ClearanceBetweenPolyDatasTest successful")
+
   def section_LoadSampleData(self):
     # Get input data
     import SampleData
@@ -8158,6 +8649,39 @@ class BoneReconstructionPlannerTest(ScriptedLoadableModuleTest):
 
     self.delayDisplay("AddMandibularPlanesTest successful")
 
+  def section_ComputeInverseMandiblePiecesOnDemand(self):
+    self.delayDisplay("Starting the ComputeInverseMandiblePiecesOnDemandTest")
+
+    self.logicBRP.onGenerateFibulaPlanesTimerTimeout()
+    self.assertTrue(self.logicBRP.inverseMandiblePiecesAreOutdated)
+
+    # any consumer of the inverse mandible pieces computes them
+    self.logicBRP.getNodesLinkedToFibula()
+    self.assertFalse(self.logicBRP.inverseMandiblePiecesAreOutdated)
+
+    numberOfMandibleSegments = len(createListFromFolderName("Mandibular planes")) - 1
+    for folderName in ["Cut Mandible Pieces", "Full Mandibles"]:
+      piecesList = createListFromFolderName(folderName)
+      self.assertEqual(len(piecesList), numberOfMandibleSegments)
+      for pieceModelNode in piecesList:
+        self.assertGreater(pieceModelNode.GetPolyData().GetNumberOfPoints(), 0)
+
+    self.logicBRP.updateInverseMandiblePiecesIfOutdated(transformToFibula=True)
+    transformedMandiblePiecesList = createListFromFolderName("Transformed Mandible Pieces")
+    self.assertEqual(len(transformedMandiblePiecesList), numberOfMandibleSegments)
+    for pieceModelNode in transformedMandiblePiecesList:
+      self.assertGreater(pieceModelNode.GetPolyData().GetNumberOfPoints(), 0)
+      self.assertEqual(
+        pieceModelNode.GetTransformNodeID(),
+        self.logicBRP.getParameterNode().GetNodeReferenceID("fibulaNormalizationTransformNode")
+      )
+
+    # the next VSP update only marks them as outdated again
+    self.logicBRP.onGenerateFibulaPlanesTimerTimeout()
+    self.assertTrue(self.logicBRP.inverseMandiblePiecesAreOutdated)
+
+    self.delayDisplay("ComputeInverseMandiblePiecesOnDemandTest successful")
+
   def section_AddFibulaLineAndCenterIt(self):
     self.delayDisplay("Starting the AddFibulaLineAndCenterItTest")
 
@@ -0,0 +1,388 @@
+"""
+Performance benchmark of the BoneReconstructionPlanner logic over synthetic bones.
+
+Procedural fibula-like and mandible-like meshes are generated at several resolutions
+and the same stages of BoneReconstructionPlannerTest are run on them through the logic
+(no sample data download, no widget, no delayDisplay). Wall time and peak memory of each
+stage are saved in a json report so results of different releases can be compared.
+
+Run it headless with:
+  Slicer --no-main-window --python-script BoneReconstructionPlannerBenchmark.py --output report.json
+or from the Slicer python console, after adding this folder to sys.path, with:
+  import BoneReconstructionPlannerBenchmark
+  BoneReconstructionPlannerBenchmark.runBenchmark(["coarse"], "report.json")
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import vtk, slicer
+
+from BoneReconstructionPlanner import BoneReconstructionPlannerLogic
+from BRPLib.helperFunctions import createListFromFolderName
+from BRPLib.memoryBudget import PeakMemoryMonitor, getAvailableMemory
+from BRPLib.stageTimings import stageTimings
+
+# numberOfSides of the tubes and numberOfCenterlinePoints of the bones for each resolution
+BENCHMARK_RESOLUTIONS = {
+  "coarse": {"numberOfSides": 16, "numberOfCenterlinePoints": 60},
+  "medium": {"numberOfSides": 48, "numberOfCenterlinePoints": 240},
+  "fine": {"numberOfSides": 128, "numberOfCenterlinePoints": 960},
+}
+
+FIBULA_CENTER = np.array([-95., -10., -20.])
+FIBULA_LENGTH = 340.
+FIBULA_RADIUS = 7.
+MANDIBLE_ARCH_X_LIMIT = 50.
+MANDIBLE_RADIUS = 9.
+
+# x coordinates (over the mandible arch) of the control points of the mandibular curve and of the mandible planes,
+# similar to the ones used by BoneReconstructionPlannerTest over the sample data
+MANDIBULAR_CURVE_POINTS_X = [43., 33., 20., 4., -15., -31., -44.]
+MANDIBLE_PLANES_X = [39., -29., 21., -9.5]
+
+#
+# Synthetic bones
+#
+
+def getMandibleArchPoint(x):
+  """
+  Point over a parabolic arch similar to the mandibular curve of the sample data
+  """
+  return np.array([x, 110. - 0.03*x**2, -83. + 0.01*x**2])
+
+def getMandibleArchTangent(x):
+  tangent = np.array([1., -0.06*x, 0.02*x])
+  return tangent/np.linalg.norm(tangent)
+
+def createTubeMesh(centerlinePoints, radii, numberOfSides):
+  """
+  Closed triangulated tube around the polyline centerlinePoints, with a radius per point
+  """
+  points = vtk.vtkPoints()
+  polyLine = vtk.vtkPolyLine()
+  polyLine.GetPointIds().SetNumberOfIds(len(centerlinePoints))
+  radiusArray = vtk.vtkDoubleArray()
+  radiusArray.SetName("radius")
+  for i, (point, radius) in enumerate(zip(centerlinePoints, radii)):
+    points.InsertNextPoint(point)
+    polyLine.GetPointIds().SetId(i, i)
+    radiusArray.InsertNextValue(radius)
+  lines = vtk.vtkCellArray()
+  lines.InsertNextCell(polyLine)
+  centerline = vtk.vtkPolyData()
+  centerline.SetPoints(points)
+  centerline.SetLines(lines)
+  centerline.GetPointData().SetScalars(radiusArray)
+
+  tubeFilter = vtk.vtkTubeFilter()
+  tubeFilter.SetInputData(centerline)
+  tubeFilter.SetNumberOfSides(numberOfSides)
+  tubeFilter.SetVaryRadiusToVaryRadiusByAbsoluteScalar()
+  tubeFilter.CappingOn()
+
+  triangleFilter = vtk.vtkTriangleFilter()
+  triangleFilter.SetInputConnection(tubeFilter.GetOutputPort())
+
+  cleanFilter = vtk.vtkCleanPolyData()
+  cleanFilter.SetInputConnection(triangleFilter.GetOutputPort())
+
+  normalsFilter = vtk.vtkPolyDataNormals()
+  normalsFilter.SetInputConnection(cleanFilter.GetOutputPort())
+  normalsFilter.AutoOrientNormalsOn()
+  normalsFilter.Update()
+
+  mesh = vtk.vtkPolyData()
+  mesh.DeepCopy(normalsFilter.GetOutput())
+  return mesh
+
+def createFibulaLikeMesh(numberOfSides, numberOfCenterlinePoints):
+  """
+  Long, slightly bowed tube that is thinner in the middle of the diaphysis, along the z axis
+  """
+  t = np.linspace(-0.5, 0.5, numberOfCenterlinePoints)
+  centerlinePoints = np.zeros((numberOfCenterlinePoints, 3))
+  centerlinePoints[:,0] = 3.*np.cos(np.pi*t)
+  centerlinePoints[:,1] = 1.5*np.sin(2*np.pi*t)
+  centerlinePoints[:,2] = FIBULA_LENGTH*t
+  centerlinePoints += FIBULA_CENTER
+  radii = FIBULA_RADIUS*(0.8 + 0.6*t**2)
+  return createTubeMesh(centerlinePoints, radii, numberOfSides)
+
+def createMandibleLikeMesh(numberOfSides, numberOfCenterlinePoints):
+  """
+  Tube along the mandible arch that gets thicker towards the rami
+  """
+  x = np.linspace(MANDIBLE_ARCH_X_LIMIT, -MANDIBLE_ARCH_X_LIMIT, numberOfCenterlinePoints)
+  centerlinePoints = np.array([getMandibleArchPoint(xi) for xi in x])
+  radii = MANDIBLE_RADIUS*(1. + 0.2*(x/MANDIBLE_ARCH_X_LIMIT)**2)
+  return createTubeMesh(centerlinePoints, radii, numberOfSides)
+
+def addSegmentationFromMesh(mesh, name):
+  segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", name)
+  segmentationNode.CreateDefaultDisplayNodes()
+  segmentationNode.GetSegmentation().SetSourceRepresentationName(
+    slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+  )
+  segmentID = segmentationNode.AddSegmentFromClosedSurfaceRepresentation(mesh, name)
+  return segmentationNode, segmentID
+
+def addScalarVolumeAroundMesh(mesh, name, spacing=2.):
+  """
+  Small empty volume covering the mesh, the logic uses the current volume to choose the markups shown in the red slice
+  """
+  bounds = np.array(mesh.GetBounds())
+  dimensions = np.ceil((bounds[1::2] - bounds[0::2])/spacing).astype(int) + 1
+  imageData = vtk.vtkImageData()
+  imageData.SetDimensions(*dimensions)
+  imageData.AllocateScalars(vtk.VTK_SHORT, 1)
+  imageData.GetPointData().GetScalars().Fill(0)
+  volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", name)
+  volumeNode.SetOrigin(*bounds[0::2])
+  volumeNode.SetSpacing(spacing, spacing, spacing)
+  volumeNode.SetAndObserveImageData(imageData)
+  return volumeNode
+
+def ensureViewNodes():
+  """
+  Without the main window there is no layout manager to create the views the logic adds its display nodes to
+  """
+  for singletonTag in [slicer.MANDIBLE_VIEW_SINGLETON_TAG, slicer.FIBULA_VIEW_SINGLETON_TAG]:
+    if slicer.mrmlScene.GetSingletonNode(singletonTag, "vtkMRMLViewNode") is None:
+      viewNode = slicer.vtkMRMLViewNode()
+      viewNode.SetSingletonTag(singletonTag)
+      viewNode.SetLayoutName(singletonTag)
+      slicer.mrmlScene.AddNode(viewNode)
+    viewNode = slicer.mrmlScene.GetSingletonNode(singletonTag, "vtkMRMLViewNode")
+    if slicer.modules.cameras.logic().GetViewActiveCameraNode(viewNode) is None:
+      cameraNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLCameraNode")
+      cameraNode.SetLayoutName(viewNode.GetLayoutName())
+  if slicer.mrmlScene.GetSingletonNode("Red", "vtkMRMLSliceNode") is None:
+    sliceNode = slicer.vtkMRMLSliceNode()
+    sliceNode.SetSingletonTag("Red")
+    sliceNode.SetLayoutName("Red")
+    slicer.mrmlScene.AddNode(sliceNode)
+
+def toMegabytes(sizeInBytes):
+  return None if sizeInBytes is None else round(sizeInBytes/(1024*1024), 2)
+
+#
+# Benchmark
+#
+
+class BoneReconstructionPlannerBenchmark:
+  """
+  Runs the planning stages of BoneReconstructionPlannerTest over synthetic bones of each resolution
+  and collects wall time and peak memory of every stage.
+  """
+  def __init__(self, resolutions=None):
+    self.resolutions = list(resolutions or BENCHMARK_RESOLUTIONS.keys())
+    self.logic = None
+    self.stagesResults = []
+
+  @contextmanager
+  def measureStage(self, name):
+    slicer.app.processEvents()
+    memoryMonitor = PeakMemoryMonitor()
+    memoryMonitor.start()
+    startTime = time.perf_counter()
+    result = {"name": name}
+    try:
+      yield
+    except Exception as e:
+      result["error"] = str(e)
+      raise
+    finally:
+      result["wallTime_s"] = round(time.perf_counter() - startTime, 4)
+      peakMemoryUsage = memoryMonitor.stop()
+      result["peakMemory_MB"] = toMegabytes(peakMemoryUsage)
+      if peakMemoryUsage is not None and memoryMonitor.startMemoryUsage is not None:
+        result["peakMemoryIncrease_MB"] = toMegabytes(peakMemoryUsage - memoryMonitor.startMemoryUsage)
+      self.stagesResults.append(result)
+      logging.info(f"Benchmark stage {name}: {result['wallTime_s']:.2f} s, peak memory {result['peakMemory_MB']} MB")
+
+  def setUp(self):
+    slicer.mrmlScene.Clear()
+    ensureViewNodes()
+    self.logic = BoneReconstructionPlannerLogic()
+    parameterNode = self.logic.getParameterNode()
+    self.logic.setDefaultParameters(parameterNode)
+
+  def runCase(self, resolutionName):
+    resolution = BENCHMARK_RESOLUTIONS[resolutionName]
+    self.setUp()
+    self.stagesResults = []
+    stageTimings.reset()
+    caseResult = {"resolution": resolutionName, **resolution, "stages": self.stagesResults}
+
+    try:
+      with self.measureStage("CreateSyntheticBones"):
+        self.section_CreateSyntheticBones(resolution)
+      caseResult["fibulaNumberOfPoints"] = self.fibulaMesh.GetNumberOfPoints()
+      caseResult["mandibleNumberOfPoints"] = self.mandibleMesh.GetNumberOfPoints()
+
+      for name, section in [
+        ("MakeBoneModels", self.section_MakeBoneModels),
+        ("SetMandibularCurve", self.section_SetMandibularCurve),
+        ("SetFibulaLine", self.section_SetFibulaLine),
+        ("AddMandiblePlanes", self.section_AddMandiblePlanes),
+        ("GenerateVSP", self.section_GenerateVSP),
+        ("MoveMandiblePlaneAndUpdateVSP", self.section_MoveMandiblePlaneAndUpdateVSP),
+        ("MandiblePlanesPositioningForMaximumBoneContact", self.section_MandiblePlanesPositioningForMaximumBoneContact),
+        ("MakeAllMandiblePlanesRotateTogether", self.section_MakeAllMandiblePlanesRotateTogether),
+        ("CreateMiterBoxesFromCorrespondingLine", self.section_CreateMiterBoxesFromCorrespondingLine),
+        ("CreateSawBoxesFromMandiblePlanes", self.section_CreateSawBoxesFromMandiblePlanes),
+      ]:
+        with self.measureStage(name):
+          section()
+    except Exception as e:
+      logging.exception(f"Benchmark case {resolutionName} stopped")
+      caseResult["error"] = str(e)
+
+    caseResult["totalWallTime_s"] = round(sum(stage["wallTime_s"] for stage in self.stagesResults), 4)
+    # nested timings of the logic methods run by the stages
+    caseResult["processingStages"] = stageTimings.getSummary()
+    return caseResult
+
+  def run(self):
+    report = {
+      "createdBy": "BoneReconstructionPlannerBenchmark",
+      "date": datetime.datetime.now().isoformat(timespec="seconds"),
+      "slicerVersion": slicer.app.applicationVersion,
+      "slicerRevision": slicer.app.revision,
+      "platform": platform.platform(),
+      "processor": platform.processor(),
+      "numberOfCPUs": os.cpu_count(),
+      "availableMemory_MB": toMegabytes(getAvailableMemory()),
+      "cases": [],
+    }
+    for resolutionName in self.resolutions:
+      report["cases"].append(self.runCase(resolutionName))
+    slicer.mrmlScene.Clear()
+    return report
+
+  def section_CreateSyntheticBones(self, resolution):
+    self.fibulaMesh = createFibulaLikeMesh(**resolution)
+    self.mandibleMesh = createMandibleLikeMesh(**resolution)
+    fibulaSegmentation, fibulaSegmentID = addSegmentationFromMesh(self.fibulaMesh, "FibulaSegmentation")
+    mandibleSegmentation, mandibleSegmentID = addSegmentationFromMesh(self.mandibleMesh, "MandibleSegmentation")
+    self.fibulaVolume = addScalarVolumeAroundMesh(self.fibulaMesh, "CTFibula")
+    self.mandibleVolume = addScalarVolumeAroundMesh(self.mandibleMesh, "CTMandible")
+
+    parameterNode = self.logic.getParameterNode()
+    wasModified = parameterNode.StartModify()
+    parameterNode.SetNodeReferenceID("currentScalarVolume", self.mandibleVolume.GetID())
+    parameterNode.SetNodeReferenceID("fibulaSegmentation", fibulaSegmentation.GetID())
+    parameterNode.SetParameter("fibulaSegment", fibulaSegmentID)
+    parameterNode.SetNodeReferenceID("mandibularSegmentation", mandibleSegmentation.GetID())
+    parameterNode.SetParameter("mandibularSegment", mandibleSegmentID)
+    parameterNode.SetParameter("donorLeg", "Right")
+    parameterNode.SetParameter("updateOnMandiblePlanesMovement", "False")
+    parameterNode.EndModify(wasModified)
+
+  def section_MakeBoneModels(self):
+    self.logic.makeModels()
+
+  def section_SetMandibularCurve(self):
+    mandibularCurveNode = self.logic.getMandibularCurve()
+    wasModified = mandibularCurveNode.StartModify()
+    for x in MANDIBULAR_CURVE_POINTS_X:
+      mandibularCurveNode.AddControlPoint(*getMandibleArchPoint(x))
+    mandibularCurveNode.EndModify(wasModified)
+
+  def section_SetFibulaLine(self):
+    fibulaLineNode = self.logic.getFibulaLine()
+    safeDistanceToFibulaTip = self.logic.getFloatParameter("safeDistanceToFibulaTip_mm")
+    halfLength = FIBULA_LENGTH/2 - safeDistanceToFibulaTip
+    wasModified = fibulaLineNode.StartModify()
+    fibulaLineNode.RemoveAllControlPoints()
+    fibulaLineNode.AddControlPoint(*(FIBULA_CENTER - [0, 0, halfLength]))
+    fibulaLineNode.AddControlPoint(*(FIBULA_CENTER + [0, 0, halfLength]))
+    fibulaLineNode.EndModify(wasModified)
+
+  def section_AddMandiblePlanes(self):
+    # kept in creation order, the folder is reordered along the mandibular curve
+    self.mandiblePlaneNodes = []
+    for x in MANDIBLE_PLANES_X:
+      planeNode = self.logic.createMandiblePlaneNode()
+      self.logic.setMandiblePlaneOriginAndNormal(planeNode, getMandibleArchPoint(x), getMandibleArchTangent(x))
+      self.mandiblePlaneNodes.append(planeNode)
+    if len(createListFromFolderName("Mandibular planes")) != len(MANDIBLE_PLANES_X):
+      raise RuntimeError("Mandible planes were not created")
+
+  def section_GenerateVSP(self):
+    self.logic.onGenerateFibulaPlanesTimerTimeout()
+    if len(createListFromFolderName("Fibula planes")) == 0:
+      raise RuntimeError("The virtual surgical plan was not generated")
+
+  def section_MoveMandiblePlaneAndUpdateVSP(self):
+    # each plane is moved a little from its own position, so the plan stays valid
+    for planeNode, x in zip(self.mandiblePlaneNodes, MANDIBLE_PLANES_X):
+      movedX = x + 2.
+      tiltedNormal = getMandibleArchTangent(movedX) + np.array([0., 0., 0.15])
+      self.logic.setMandiblePlaneOriginAndNormal(planeNode, getMandibleArchPoint(movedX), tiltedNormal)
+      self.logic.onGenerateFibulaPlanesTimerTimeout()
+
+  def section_MandiblePlanesPositioningForMaximumBoneContact(self):
+    parameterNode = self.logic.getParameterNode()
+    parameterNode.SetParameter("mandiblePlanesPositioningForMaximumBoneContact", "True")
+    self.logic.onGenerateFibulaPlanesTimerTimeout()
+
+  def section_MakeAllMandiblePlanesRotateTogether(self):
+    parameterNode = self.logic.getParameterNode()
+    parameterNode.SetParameter("makeAllMandiblePlanesRotateTogether", "True")
+    self.logic.onGenerateFibulaPlanesTimerTimeout()
+
+  def section_CreateMiterBoxesFromCorrespondingLine(self):
+    parameterNode = self.logic.getParameterNode()
+    sliceOffset = FIBULA_CENTER[2]
+    miterBoxLine = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsLineNode", "miterBoxLine")
+    miterBoxLine.CreateDefaultDisplayNodes()
+    miterBoxLine.AddControlPoint(FIBULA_CENTER[0], FIBULA_CENTER[1], sliceOffset)
+    miterBoxLine.AddControlPoint(FIBULA_CENTER[0] - 12., FIBULA_CENTER[1] - 2., sliceOffset)
+
+    wasModified = parameterNode.StartModify()
+    parameterNode.SetNodeReferenceID("currentScalarVolume", self.fibulaVolume.GetID())
+    parameterNode.SetParameter("checkSecurityMarginOnMiterBoxCreation", "False")
+    parameterNode.SetNodeReferenceID("miterBoxDirectionLine", miterBoxLine.GetID())
+    parameterNode.EndModify(wasModified)
+    self.logic.createMiterBoxesFromFibulaPlanes()
+
+  def section_CreateSawBoxesFromMandiblePlanes(self):
+    self.logic.createSawBoxesFromFirstAndLastMandiblePlanes()
+
+def runBenchmark(resolutions=None, outputPath=None):
+  report = BoneReconstructionPlannerBenchmark(resolutions).run()
+  if outputPath:
+    with open(outputPath, "w") as reportFile:
+      json.dump(report, reportFile, indent=2)
+    logging.info(f"Benchmark report saved to {outputPath}")
+  return report
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Benchmark the BoneReconstructionPlanner logic over synthetic bones")
+  parser.add_argument("--output", default="BoneReconstructionPlannerBenchmark.json", help="path of the json report")
+  parser.add_argument(
+    "--resolutions", default=",".join(BENCHMARK_RESOLUTIONS.keys()),
+    help="comma separated list of resolutions to run, from: " + ", ".join(BENCHMARK_RESOLUTIONS.keys())
+  )
+  args, _ = parser.parse_known_args(argv)
+  resolutions = [resolution.strip() for resolution in args.resolutions.split(",") if resolution.strip()]
+  unknownResolutions = [resolution for resolution in resolutions if resolution not in BENCHMARK_RESOLUTIONS]
+  if unknownResolutions:
+    parser.error("unknown resolutions: " + ", ".join(unknownResolutions))
+
+  report = runBenchmark(resolutions, args.output)
+  failedCases = [case["resolution"] for case in report["cases"] if "error" in case]
+  return 1 if failedCases else 0
+
+if __name__ == "__main__":
+  slicer.util.exit(main(sys.argv[1:]))